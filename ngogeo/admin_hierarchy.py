@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Administrative hierarchy of all countries as flat arrays.
+
+Units of the geonames admin1/admin2 code tables are sorted by key ('FR.84', 'FR.84.42') so that the children of
+a unit are a contiguous range of the arrays. The ADM relations of hierarchy.zip are kept as an edge list sorted
+by parent geonameid, to enumerate the children of units below admin2.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import numpy as np
+import pandas as pd
+
+from ngoschema.loaders import static_module_loader
+from ngogeo import settings as geo_settings
+from .geonames.loaders import load_admin_codes, load_hierarchy
+from .single_flight import single_flight
+
+hierarchy_folder = static_module_loader.subfolder('ngogeo').joinpath(geo_settings.CACHE_STATIC_FOLDER,
+                                                                     'admin_hierarchy')
+
+_ARRAYS = ('keys', 'names', 'geonameids', 'levels', 'edge_parents', 'edge_children')
+
+_hierarchy = None
+
+
+class AdminHierarchy(object):
+
+    def __init__(self, keys, names, geonameids, levels, edge_parents, edge_children):
+        self.keys = keys
+        self.names = names
+        self.geonameids = geonameids
+        self.levels = levels
+        self.edge_parents = edge_parents
+        self.edge_children = edge_children
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {len(self.keys)} admin units, {len(self.edge_parents)} relations>'
+
+    @classmethod
+    def build(cls):
+        units = pd.concat([load_admin_codes(1).assign(level=1), load_admin_codes(2).assign(level=2)])
+        units = units.drop_duplicates('code').sort_values('code')
+        edges = load_hierarchy()
+        edges = edges[edges['type'] == 'ADM'].sort_values(['parent', 'child'])
+        return cls(units['code'].to_numpy(dtype=str), units['name'].to_numpy(dtype=str),
+                   units['geonameid'].fillna(-1).to_numpy(dtype=np.int64), units['level'].to_numpy(dtype=np.int8),
+                   edges['parent'].to_numpy(dtype=np.int64), edges['child'].to_numpy(dtype=np.int64))
+
+    def save(self, folder):
+        folder.mkdir(parents=True, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(folder.joinpath(f'{name}.npy'), getattr(self, name))
+        with folder.joinpath('admin_hierarchy.json').open('w') as f:
+            json.dump(dict(units=len(self.keys), relations=len(self.edge_parents)), f)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        return cls(*[np.load(folder.joinpath(f'{name}.npy'), mmap_mode=mmap_mode) for name in _ARRAYS])
+
+    def position(self, key):
+        """Returns the position of the unit of key 'CC.A1' or 'CC.A1.A2', -1 if unknown."""
+        i = int(np.searchsorted(self.keys, key))
+        return i if i < len(self.keys) and self.keys[i] == key else -1
+
+    def children(self, key):
+        """Returns the keys of the direct children of a country code or admin key."""
+        # keys starting with 'key.' lie between 'key.' and 'key/'
+        lo, hi = np.searchsorted(self.keys, [key + '.', key + '/'])
+        level = key.count('.') + 1
+        return self.keys[lo:hi][self.levels[lo:hi] == level]
+
+    def name(self, key):
+        i = self.position(key)
+        return str(self.names[i]) if i >= 0 else None
+
+    def geonameid(self, key):
+        i = self.position(key)
+        return int(self.geonameids[i]) if i >= 0 and self.geonameids[i] >= 0 else None
+
+    def child_geonameids(self, geonameid):
+        """Returns the geonameids of the administrative children of a geonameid."""
+        lo, hi = np.searchsorted(self.edge_parents, [geonameid, geonameid + 1])
+        return self.edge_children[lo:hi]
+
+
+def get_admin_hierarchy(rebuild=False):
+    """Returns the admin hierarchy, memory-mapped from cache or built and persisted first."""
+
+    def load():
+        global _hierarchy
+        if _hierarchy is not None and not rebuild:
+            return _hierarchy
+        if hierarchy_folder.joinpath('admin_hierarchy.json').exists() and not rebuild:
+            hierarchy = AdminHierarchy.load(hierarchy_folder)
+        else:
+            hierarchy = AdminHierarchy.build()
+            hierarchy.save(hierarchy_folder)
+        _hierarchy = hierarchy
+        return hierarchy
+
+    if _hierarchy is None or rebuild:
+        return single_flight('admin_hierarchy', load)
+    return _hierarchy
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio counterparts of the blocking paths of ngogeo.
+
+Blocking i/o (dataset downloads, overpass queries, geolite2 reads) runs on an i/o thread pool and cpu bound loads
+(parsing datasets, building frames and indexes) on a separate cpu thread pool, so that slow downloads do not hold
+the threads of the loads. Concurrent awaits of the same dataset, query or ip share one call.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ngogeo import settings as geo_settings
+from . import territories
+from .single_flight import AsyncSingleFlight
+from .geonames.loaders import download_geonames
+from .postals import download_postals
+from .overpass import overpass_query as _overpass_query
+from .point_search import _search_elements, _search_elements_radius
+
+_executors = {}
+_executors_lock = threading.Lock()
+_flights = AsyncSingleFlight()
+
+
+def _executor(kind):
+    with _executors_lock:
+        if kind not in _executors:
+            if kind == 'io':
+                threads = geo_settings.AIO_IO_THREADS
+            else:
+                threads = geo_settings.AIO_CPU_THREADS or os.cpu_count()
+            _executors[kind] = ThreadPoolExecutor(threads, thread_name_prefix=f'ngogeo-{kind}')
+        return _executors[kind]
+
+
+async def run_io(fn, *args, **kwargs):
+    """Runs a blocking i/o call on the i/o executor."""
+    return await asyncio.get_running_loop().run_in_executor(_executor('io'), functools.partial(fn, *args, **kwargs))
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """Runs a cpu bound call on the cpu executor."""
+    return await asyncio.get_running_loop().run_in_executor(_executor('cpu'), functools.partial(fn, *args, **kwargs))
+
+
+def shutdown():
+    """Shuts the executors down, they are created again when needed."""
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=False)
+        _executors.clear()
+
+
+# datasets
+
+async def fetch_geonames(filename):
+    """Downloads geonames dump `filename` (country code, 'cities5000', ..) if needed, returns its path."""
+    return await _flights.do(('fetch', 'geonames', filename), lambda: run_io(download_geonames, filename))
+
+
+async def fetch_postals(filename):
+    """Downloads postal codes dump `filename` (country code) if needed, returns its paths (see download_postals)."""
+    return await _flights.do(('fetch', 'postals', filename), lambda: run_io(download_postals, filename))
+
+
+async def load(obj, prop):
+    """
+    Returns the lazy property `prop` of a territory (country.postals_gdf, ..), loaded on the cpu executor if it is
+    not loaded yet.
+    """
+    value = obj._dataValidated.get(prop)
+    if value is not None:
+        return value
+    return await _flights.do(('load', id(obj), prop), lambda: run_cpu(getattr, obj, prop))
+
+
+def _load_world(**kwargs):
+    world = territories.get_world(**kwargs)
+    world.countries_gdf
+    return world
+
+
+async def get_world(**kwargs):
+    """Returns the world of territories.get_world, its countries being loaded on the cpu executor."""
+    return await _flights.do(('world', tuple(sorted(kwargs.items()))), lambda: run_cpu(_load_world, **kwargs))
+
+
+async def get_country(country_code, datasets=('postals_gdf',), **options):
+    """
+    Returns a country of the world with `datasets` loaded concurrently (and their files downloaded first), country
+    options (with_geonames, ..) being set if given.
+    """
+    world = await get_world()
+    country = await run_cpu(world.get_country, country_code)
+    if country is None:
+        return None
+    for k, v in options.items():
+        if v is not None and getattr(country, k) != v:
+            setattr(country, k, v)
+    fetches = []
+    if 'postals_gdf' in datasets and country.with_postals:
+        fetches.append(fetch_postals(country.country_code))
+    if 'geonames_gdf' in datasets and country.with_geonames:
+        fetches.append(fetch_geonames(country.country_code))
+    await asyncio.gather(*fetches)
+    await asyncio.gather(*[load(country, prop) for prop in datasets])
+    return country
+
+
+# overpass
+
+async def overpass_query(query, key=None, cache=None, cache_only=None, url=None):
+    """Returns the raw response of an overpass query (see overpass.overpass_query)."""
+    return await _flights.do(('overpass', key or query),
+                             lambda: run_io(_overpass_query, query, key=key, cache=cache, cache_only=cache_only,
+                                            url=url))
+
+
+async def search_elements(bbox, element='node', crs=None, **kwargs):
+    """Searches OSM elements with tags kwargs in bbox (see point_search._search_elements)."""
+    return await run_io(_search_elements, bbox, element=element, crs=crs, **kwargs)
+
+
+async def search_elements_radius(point, radius, point_crs=None, element='node', crs=None, **kwargs):
+    return await run_io(_search_elements_radius, point, radius, point_crs=point_crs, element=element, crs=crs,
+                        **kwargs)
+
+
+# ip
+
+class IpLookup(object):
+    """
+    Asynchronous lookups of a geolite2 database, read on the i/o executor. Records are cached by the database
+    (see IpUtilsFile.record) and concurrent lookups of a same ip share one read.
+    """
+
+    def __init__(self, ip_utils=None):
+        if ip_utils is None:
+            from .ip_utils import IpUtilsCity
+            ip_utils = IpUtilsCity()
+        self.ip_utils = ip_utils
+        self._flights = AsyncSingleFlight()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.ip_utils.__class__.__name__}>'
+
+    async def record(self, ip):
+        """Returns the record of an ip (tuple of ip_utils._fields) or None."""
+        return await self._flights.do(ip, lambda: run_io(self.ip_utils.record, ip))
+
+    async def lookup(self, ip):
+        """Returns the record of an ip as a dict, None if not found."""
+        record = await self.record(ip)
+        return dict(zip(self.ip_utils._fields, record)) if record is not None else None
+
+    async def lookup_batch(self, ips, processes=None):
+        """Same output as IpUtilsFile.lookup_batch."""
+        return await run_io(self.ip_utils.lookup_batch, ips, processes=processes)
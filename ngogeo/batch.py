@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Batch geocoding and reverse geocoding of tables over worker processes.
+
+Input rows are partitioned by country and the partitions of a country are routed to the workers already holding it,
+so that each worker only loads the datasets of its countries (a country is replicated to another worker only when
+its workers are busy). Chunks are processed concurrently and their results are yielded in input order, with at
+most `max_pending` chunks in flight.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from ngogeo import settings as geo_settings
+from .territories import get_world
+from .point_search import _make_points_to_crs
+from .distances import haversine_km
+
+INPUT_COLUMNS = ('country', 'postal_code', 'name', 'longitude', 'latitude')
+RESULT_COLUMNS = ('country_code', 'geonameid', 'city', 'admin1code', 'admin2code', 'admin3code', 'postal_code',
+                  'longitude', 'latitude', 'distance_km', 'match')
+_FLOAT_COLUMNS = ('longitude', 'latitude', 'distance_km')
+
+
+def _results(n, country_code):
+    res = {c: np.full(n, np.nan) if c in _FLOAT_COLUMNS else np.full(n, None, dtype=object) for c in RESULT_COLUMNS}
+    res['country_code'][:] = country_code
+    return res
+
+
+def _results_frame(res, index):
+    frame = pd.DataFrame(res, index=index)
+    frame['geonameid'] = frame['geonameid'].astype(pd.Int64Dtype())
+    return frame
+
+
+def _set_places(res, rows, places, columns=('geonameid', 'admin1code', 'admin2code', 'admin3code')):
+    for c in columns:
+        res[c][rows] = places[c].to_numpy(dtype=object)
+    res['city'][rows] = places['name'].to_numpy(dtype=object)
+    res['longitude'][rows] = places['longitude'].to_numpy(dtype=float)
+    res['latitude'][rows] = places['latitude'].to_numpy(dtype=float)
+
+
+def geocode_partition(country, frame):
+    """
+    Geocodes rows of a same country with postal_code and/or name columns. Names resolve to the most populated
+    homonym, preferably in the postal code of the row, otherwise postal codes resolve to their centroid.
+    """
+    res = _results(len(frame), country.country_code)
+    city_postals = country.city_postals()
+    if 'postal_code' in frame.columns and country.postals_gdf is not None:
+        postals = country.postals_gdf
+        codes = frame['postal_code'].astype('string').str.strip().str.upper()
+        pos = postals.index.get_indexer(codes.fillna(''))
+        rows = np.flatnonzero(pos >= 0)
+        hit = postals.iloc[pos[rows]]
+        res['postal_code'][rows] = hit.index.to_numpy(dtype=object)
+        res['longitude'][rows] = hit['longitude'].to_numpy(dtype=float)
+        res['latitude'][rows] = hit['latitude'].to_numpy(dtype=float)
+        res['match'][rows] = 'postal'
+    places = country.places_gdf()
+    if 'name' in frame.columns and places is not None and len(places):
+        # names are matched on the codes of the normalized place names of the country name index
+        name_index = country.name_index()
+        candidates = pd.DataFrame({'row': np.arange(len(frame)), 'code': name_index.lookup(frame['name']),
+                                   'postal': res['postal_code']})
+        keys = pd.DataFrame({'code': name_index.codes, 'place': np.arange(len(places)),
+                             'population': places['population'].fillna(0).to_numpy()})
+        matches = candidates[candidates['code'] >= 0].merge(keys, on='code')
+        gids = places['geonameid'].to_numpy()[matches['place'].to_numpy()]
+        place_postals = city_postals.postal_codes(gids) if city_postals is not None else np.full(len(gids), None)
+        matches['same_postal'] = matches['postal'].notna().to_numpy() & (matches['postal'].to_numpy() == place_postals)
+        matches['place_postal'] = place_postals
+        matches = matches.sort_values(['row', 'same_postal', 'population'], ascending=[True, False, False])
+        matches = matches.drop_duplicates('row')
+        rows = matches['row'].to_numpy()
+        _set_places(res, rows, places.iloc[matches['place'].to_numpy()])
+        no_postal = pd.isna(res['postal_code'][rows])
+        res['postal_code'][rows[no_postal]] = matches['place_postal'].to_numpy()[no_postal]
+        res['match'][rows] = np.where(matches['same_postal'].to_numpy(), 'name+postal', 'name')
+    return _results_frame(res, frame.index)
+
+
+def reverse_partition(country, frame):
+    """Reverse geocodes rows of a same country with longitude/latitude columns (WGS84) to their nearest place."""
+    res = _results(len(frame), country.country_code)
+    places = country.places_gdf()
+    lons = frame['longitude'].to_numpy(dtype=float)
+    lats = frame['latitude'].to_numpy(dtype=float)
+    valid = np.flatnonzero(np.isfinite(lons) & np.isfinite(lats))
+    if places is not None and len(places) and len(valid):
+        points = _make_points_to_crs((lons[valid], lats[valid]), point_crs=geo_settings.WSG84_CRS,
+                                     dest_crs=places.crs, as_points=True)
+        inputs, nearest = places.sindex.nearest(points, return_all=False)
+        rows = valid[inputs]
+        hit = places.iloc[nearest]
+        _set_places(res, rows, hit)
+        res['distance_km'][rows] = haversine_km(lons[rows], lats[rows], res['longitude'][rows], res['latitude'][rows])
+        city_postals = country.city_postals()
+        if city_postals is not None:
+            res['postal_code'][rows] = city_postals.postal_codes(hit['geonameid'].to_numpy())
+        res['match'][rows] = 'nearest'
+    return _results_frame(res, frame.index)
+
+
+PARTITION_OPS = {'geocode': geocode_partition, 'reverse': reverse_partition}
+
+
+def run_partition(op, country_code, frame, **options):
+    """Runs operation `op` on the rows of a country, country options (with_geonames, ..) being set if given."""
+    country = get_world().get_country(country_code)
+    if country is None:
+        return _results_frame(_results(len(frame), None), frame.index)
+    for k, v in options.items():
+        if v is not None and getattr(country, k) != v:
+            setattr(country, k, v)
+    return PARTITION_OPS[op](country, frame)
+
+
+def _country_codes(world, values):
+    """ISO2 codes of a series of ISO2/ISO3 codes, geonameids or country names, None if unknown."""
+    codes, uniques = pd.factorize(values)
+
+    def code(v):
+        if isinstance(v, str):
+            v = v.strip()
+            if len(v) <= 3:
+                return world.to_country_code(v.upper())
+            country = world.find_by_name(v)
+            return country.country_code if country is not None else None
+        return world.to_country_code(int(v))
+
+    mapped = np.array([code(v) for v in uniques] + [None], dtype=object)
+    return mapped[codes]
+
+
+class BatchEngine(object):
+
+    def __init__(self, workers=None, max_pending=None, chunk_size=None, columns=None, **options):
+        """
+        Batch engine over `workers` processes (0 to run in the calling process), reading chunks of `chunk_size`
+        rows with at most `max_pending` chunks in flight. `columns` maps the input columns (INPUT_COLUMNS) to the
+        names used in the input tables, `options` are country options such as with_geonames.
+        """
+        workers = geo_settings.BATCH_WORKERS if workers is None else workers
+        self.workers = os.cpu_count() if workers is None else workers
+        max_pending = geo_settings.BATCH_MAX_PENDING if max_pending is None else max_pending
+        self.max_pending = max_pending or max(2 * self.workers, 1)
+        self.chunk_size = chunk_size or geo_settings.BATCH_CHUNK_SIZE
+        self.columns = dict(zip(INPUT_COLUMNS, INPUT_COLUMNS), **(columns or {}))
+        self.options = options
+        self._executors = [None] * self.workers
+        self._inflight = [0] * self.workers
+        self._holders = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.workers} workers>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        for executor in self._executors:
+            if executor is not None:
+                executor.shutdown()
+        self._executors = [None] * self.workers
+
+    def countries(self, worker):
+        """Returns the countries routed to a worker."""
+        return [cc for cc, holders in self._holders.items() if worker in holders]
+
+    def _route(self, country_code):
+        # workers holding the country are preferred, an idle worker gets it only if they are all busy
+        with self._lock:
+            holders = self._holders.setdefault(country_code, [])
+            best = min(holders, key=lambda w: self._inflight[w]) if holders else None
+            if best is None or self._inflight[best] > 0:
+                idle = min(range(self.workers), key=lambda w: (self._inflight[w], len(self.countries(w))))
+                if best is None or self._inflight[idle] < self._inflight[best]:
+                    holders.append(idle)
+                    best = idle
+            self._inflight[best] += 1
+            return best
+
+    def _done(self, worker):
+        with self._lock:
+            self._inflight[worker] -= 1
+
+    def _submit(self, op, country_code, frame):
+        worker = self._route(country_code)
+        if self._executors[worker] is None:
+            self._executors[worker] = ProcessPoolExecutor(max_workers=1)
+        future = self._executors[worker].submit(run_partition, op, country_code, frame, **self.options)
+        future.add_done_callback(lambda f: self._done(worker))
+        return future
+
+    def _partition(self, op, chunk):
+        names = {v: k for k, v in self.columns.items()}
+        frame = chunk[[c for c in chunk.columns if c in names]].rename(columns=names)
+        frame.index = np.arange(len(frame))
+        world = get_world()
+        if 'country' in frame.columns:
+            codes = _country_codes(world, frame['country'])
+        elif op == 'reverse' and world.with_shapes:
+            codes = np.full(len(frame), None, dtype=object)
+        else:
+            raise ValueError(f'{op} needs a {self.columns["country"]!r} column.')
+        # coordinates without a (known) country are located by the country grid
+        missing = pd.isna(codes)
+        if op == 'reverse' and world.with_shapes and missing.any():
+            codes[missing] = world.country_grid().locate_labels(frame['longitude'].to_numpy(dtype=float)[missing],
+                                                                frame['latitude'].to_numpy(dtype=float)[missing])
+        codes = pd.Series(codes, index=frame.index)
+        return [(cc, frame.loc[rows]) for cc, rows in codes.groupby(codes, sort=False).groups.items()]
+
+    def _chunks(self, data):
+        if isinstance(data, pd.DataFrame):
+            for i in range(0, len(data), self.chunk_size):
+                yield data.iloc[i:i + self.chunk_size]
+        else:
+            yield from data
+
+    def run(self, op, data):
+        """
+        Runs operation 'geocode' or 'reverse' on a dataframe or an iterable of dataframe chunks, and yields the
+        results of each chunk (RESULT_COLUMNS, indexed as the chunk) in input order.
+        """
+        pending = deque()
+        for chunk in self._chunks(data):
+            parts = self._partition(op, chunk)
+            if self.workers:
+                tasks = [self._submit(op, cc, part) for cc, part in parts]
+            else:
+                tasks = [run_partition(op, cc, part, **self.options) for cc, part in parts]
+            pending.append((chunk.index, tasks))
+            # backpressure: input is read further only once the oldest chunks are done
+            while len(pending) >= self.max_pending:
+                yield self._collect(*pending.popleft())
+        while pending:
+            yield self._collect(*pending.popleft())
+
+    def _collect(self, index, tasks):
+        results = [t.result() if self.workers else t for t in tasks]
+        res = pd.concat(results) if results else _results_frame(_results(0, None), pd.RangeIndex(0))
+        res = res.reindex(np.arange(len(index)))
+        res.index = index
+        return res
+
+    def geocode(self, data):
+        return self.run('geocode', data)
+
+    def reverse(self, data):
+        return self.run('reverse', data)
+
+
+def geocode(frame, workers=None, **kwargs):
+    """Geocodes a dataframe, see BatchEngine for the options."""
+    with BatchEngine(workers=workers, **kwargs) as engine:
+        return pd.concat(list(engine.geocode(frame)))
+
+
+def reverse_geocode(frame, workers=None, **kwargs):
+    """Reverse geocodes a dataframe of longitude/latitude, see BatchEngine for the options."""
+    with BatchEngine(workers=workers, **kwargs) as engine:
+        return pd.concat(list(engine.reverse(frame)))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+City <-> postal code <-> admin codes mapping of a country.
+
+Cities and postal places are joined once on their normalized names, then the postal state/county/community code
+of each geonames admin unit is the most frequent one among its cities. The table is cached on disk per country, and
+rebuilt when the source files of the cities or of the postal codes change.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import numpy as np
+import pandas as pd
+
+from ngoschema.loaders import static_module_loader
+from ngogeo import settings as geo_settings
+from .dataset_cache import get_dataset_cache
+
+city_postals_folder = static_module_loader.subfolder('ngogeo').joinpath(geo_settings.CACHE_STATIC_FOLDER,
+                                                                        'city_postals')
+
+ADMIN_KEYS = ('admin1code', 'admin2code', 'admin3code')
+POSTAL_ADMIN_KEYS = ('state_code', 'county_code', 'community_code')
+COLUMNS = ('geonameid', ) + ADMIN_KEYS + ('postal_code', ) + POSTAL_ADMIN_KEYS
+
+
+def _name_key(names):
+    names = names.astype(str).str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+    return names.str.lower().str.replace(r'[^a-z0-9]+', ' ', regex=True).str.strip()
+
+
+class CityPostals(object):
+
+    def __init__(self, table):
+        self.table = table
+        self._admin_codes = {}
+        self._postal_codes = None
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {len(self.table)} cities>'
+
+    @property
+    def nbytes(self):
+        return int(self.table.memory_usage(deep=True).sum())
+
+    @classmethod
+    def build(cls, cities, postals):
+        """Joins cities (geonames) and unique postal codes (place names separated by ', ') of a country."""
+        postals = postals if 'postal_code' in postals.columns else postals.reset_index()
+        places = pd.DataFrame(postals[['postal_code', 'place_name'] + list(POSTAL_ADMIN_KEYS)])
+        places['place_name'] = places['place_name'].astype(str).str.split(', ')
+        places = places.explode('place_name')
+        places['key'] = _name_key(places['place_name'])
+        keys = _name_key(cities['name']).to_numpy()
+        cities = pd.DataFrame(cities[['geonameid'] + list(ADMIN_KEYS)])
+        cities['key'] = keys
+        table = cities.merge(places.drop(columns='place_name'), on='key').drop(columns='key')
+        # homonyms: keep the places in the county of the admin2 according to its unambiguous cities, then prefer
+        # the places whose state code is the admin1 code
+        county = cls(table[~table.duplicated('geonameid', keep=False)]).admin_codes(2)
+        expected = pd.Series(list(zip(table['admin1code'], table['admin2code']))).map(county).to_numpy()
+        table = table[pd.isna(expected) | (expected == table['county_code'].to_numpy())]
+        other_state = table['state_code'].to_numpy(dtype=object) != table['admin1code'].to_numpy(dtype=object)
+        table = table.iloc[np.lexsort((other_state, table['geonameid'].to_numpy()))]
+        return cls(table.drop_duplicates('geonameid').reset_index(drop=True)[list(COLUMNS)])
+
+    def save(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.table.to_csv(path, index=None)
+
+    @classmethod
+    def load(cls, path):
+        dtypes = {c: str for c in COLUMNS}
+        dtypes['geonameid'] = 'int64'
+        return cls(pd.read_csv(path, dtype=dtypes, keep_default_na=False, na_values=['']))
+
+    def admin_codes(self, level):
+        """Returns the dict of admin codes tuple (admin1code, ..) -> postal code of admin level 1, 2 or 3."""
+        if level not in self._admin_codes:
+            keys, col = list(ADMIN_KEYS[:level]), POSTAL_ADMIN_KEYS[level - 1]
+            counts = self.table.groupby(keys + [col], observed=True).size().sort_values(ascending=False, kind='stable')
+            modes = counts.reset_index().drop_duplicates(keys)
+            self._admin_codes[level] = dict(zip(zip(*[modes[k] for k in keys]), modes[col]))
+        return self._admin_codes[level]
+
+    def postal_admin_code(self, *admin_codes):
+        """Returns the postal state, county or community code of admin codes (admin1code[, admin2code[, ..]])."""
+        return self.admin_codes(len(admin_codes)).get(tuple(admin_codes))
+
+    def postal_code(self, geonameid):
+        if self._postal_codes is None:
+            self._postal_codes = dict(zip(self.table['geonameid'], self.table['postal_code']))
+        return self._postal_codes.get(geonameid)
+
+    def postal_codes(self, geonameids):
+        """Returns the postal codes of an array of geonameids, None if not mapped."""
+        pos = pd.Index(self.table['geonameid']).get_indexer(np.asarray(geonameids, dtype=np.int64))
+        codes = np.append(self.table['postal_code'].to_numpy(dtype=object), None)
+        return codes[pos]
+
+
+def get_city_postals(name, cities, postals, rebuild=False):
+    """
+    Returns the mapping `name`, loaded from cache or built from cities and postals and persisted first. The cache is
+    keyed on the source stamps of both frames (see frames.source_stamps).
+    """
+    path = city_postals_folder.joinpath(f'{name}.csv')
+    meta = path.with_suffix('.json')
+    sources = [list(stamp) for frame in (cities, postals) for stamp in frame.attrs.get('sources', [])]
+
+    def cached():
+        if rebuild or not path.exists() or not meta.exists():
+            return False
+        with meta.open() as f:
+            return json.load(f)['sources'] == sources
+
+    def load():
+        if cached():
+            return CityPostals.load(path)
+        table = CityPostals.build(cities, postals)
+        table.save(path)
+        with meta.open('w') as f:
+            json.dump({'sources': sources}, f)
+        return table
+
+    cache = get_dataset_cache()
+    if rebuild:
+        cache.evict(('city_postals', name))
+    return cache.get(('city_postals', name), load)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+`ngogeo build-cache`: precomputes the datasets and indexes of countries ahead of deployment.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+import click
+from ngoschema.cli import pass_environment
+
+from ngogeo import settings as geo_settings
+from ngogeo.territories import get_world, stored_geonames_gdf, stored_postals_gdf
+from ngogeo.frames import clear_stored_frames, stored_frame_folder
+from ngogeo.city_postals import city_postals_folder
+from ngogeo.admin_hierarchy import get_admin_hierarchy
+
+
+def _stored(name):
+    return not geo_settings.FRAME_STORE or stored_frame_folder(name).exists()
+
+
+@click.command('build-cache', short_help='Precomputes datasets and indexes.')
+@click.argument('countries', nargs=-1)
+@click.option('--crs', 'crs_list', multiple=True, help='Other CRS of the country frames, besides the country CRS.')
+@click.option('--with-geonames', is_flag=True, help='Also builds the geonames of the countries.')
+@click.option('--postals/--no-postals', default=True, show_default=True, help='Builds the postal codes.')
+@click.option('--admin-grids/--no-admin-grids', default=True, show_default=True,
+              help='Builds the admin1/admin2 lookup grids of the countries.')
+@click.option('--ip', is_flag=True, help='Builds the table of the GeoLite2 city database.')
+@click.option('--snapshot', type=click.Path(file_okay=False), default=None,
+              help='Saves a world snapshot with everything built (defaults to WORLD_SNAPSHOT).')
+@click.option('--rebuild', is_flag=True, help='Rebuilds from the source files instead of reusing caches.')
+@pass_environment
+def cli(ctx, countries, crs_list, with_geonames, postals, admin_grids, ip, snapshot, rebuild):
+    """
+    Downloads and parses the world and COUNTRIES datasets (ISO codes or names), builds their caches and indexes,
+    verifies them and reports timings.
+    """
+    if not geo_settings.FRAME_STORE:
+        ctx.log('warning: FRAME_STORE is disabled, frames are only built in memory')
+    # indexes and grids are only persisted by the snapshot restored by get_world
+    snapshot = snapshot or geo_settings.WORLD_SNAPSHOT
+    if not snapshot:
+        ctx.log('warning: no --snapshot nor WORLD_SNAPSHOT, indexes are only built in memory')
+    results = []
+
+    def step(label, build, verify=None):
+        start = time.time()
+        try:
+            value = build()
+            ok = bool(verify(value)) if verify is not None else value is not None
+        except Exception as er:
+            value, ok = None, False
+            ctx.log('%s: %s', label, er)
+        elapsed = time.time() - start
+        results.append((label, elapsed, ok))
+        ctx.log('%-36s %8.2fs  %s', label, elapsed, 'ok' if ok else 'FAILED')
+        return value
+
+    world = get_world()
+    if rebuild:
+        clear_stored_frames('countries_*')
+        clear_stored_frames(f'{world.cities_file}_*')
+    step('world countries', lambda: world.countries_gdf, len)
+    cities_gdf = step('world cities', lambda: world.cities_gdf, len)
+    step('world cities index', world.cities_index,
+         lambda index: index.row(cities_gdf, cities_gdf['geonameid'].iloc[-1]) is not None)
+    hierarchy = step('admin hierarchy', lambda: get_admin_hierarchy(rebuild=rebuild), lambda h: len(h.keys))
+    grid = step('country grid', lambda: world.country_grid(rebuild=rebuild), lambda g: len(g.labels))
+    if ip:
+        from ngogeo.ip_utils import IpUtilsCity
+        from ngogeo.ip_table import get_ip_table
+        step('ip table', lambda: get_ip_table(IpUtilsCity, rebuild=rebuild),
+             lambda t: t.lookup(['8.8.8.8'])['country_code'].notna().all())
+
+    for name in countries:
+        country = world.get_country(name) if len(name) <= 3 else world.find_by_name(name)
+        if country is None:
+            raise click.BadParameter(f'unknown country {name!r}.', param_hint='COUNTRIES')
+        cc = country.country_code
+        if rebuild:
+            for pattern in (f'geonames_{cc}_*', f'postals_{cc}_*'):
+                clear_stored_frames(pattern)
+            for path in city_postals_folder.glob(f'{cc}_*'):
+                path.unlink()
+        country.with_postals = postals
+        country.with_geonames = with_geonames
+        for crs in dict.fromkeys([str(country.crs)] + list(crs_list)):
+            if with_geonames:
+                step(f'{cc} geonames {crs}', lambda: stored_geonames_gdf(cc, crs),
+                     lambda gdf: len(gdf) and _stored(f'geonames_{cc}_{crs}'))
+            if postals:
+                step(f'{cc} postals {crs}', lambda: stored_postals_gdf(cc, crs),
+                     lambda gdf: len(gdf) and _stored(f'postals_{cc}_{crs}'))
+        if with_geonames:
+            step(f'{cc} geonames index', country.geonames_index, len)
+        places = step(f'{cc} places', country.places_gdf, len)
+        if places is not None and len(places):
+            name = places['name'].iloc[int(places['population'].fillna(0).to_numpy().argmax())]
+            step(f'{cc} name index', country.name_index, lambda index: len(index.positions(name)))
+        if postals:
+            step(f'{cc} city/postal codes', country.city_postals, lambda t: len(t.table) and t.admin_codes(1))
+        if hierarchy is not None:
+            step(f'{cc} admin units', lambda: hierarchy.children(cc), len)
+        if grid is not None:
+            place = cities_gdf[cities_gdf['countrycode'] == cc].nlargest(1, 'population')
+            if len(place):
+                step(f'{cc} country grid lookup',
+                     lambda: grid.locate(place['longitude'].iloc[0], place['latitude'].iloc[0]),
+                     lambda label: label == cc)
+        if admin_grids:
+            for level in (1, 2):
+                step(f'{cc} admin{level} grid',
+                     lambda: country.admin_grid(level, rebuild=rebuild, bound_from_cities=True),
+                     lambda g: len(g.labels))
+
+    if snapshot:
+        step('world snapshot', lambda: world.save_snapshot(snapshot), lambda meta: meta['datasets'])
+    failed = [label for label, elapsed, ok in results if not ok]
+    ctx.log('%d steps in %.1fs, %d failed', len(results), sum(r[1] for r in results), len(failed))
+    if failed:
+        raise click.ClickException(f'failed to build {", ".join(failed)}.')
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+`ngogeo geocode`: geocodes a CSV/Parquet file chunk by chunk and writes the enriched rows incrementally.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+import itertools
+from collections import deque
+import click
+import pandas as pd
+from ngoschema.cli import pass_environment
+
+from ngogeo.batch import BatchEngine
+from ngogeo.table_io import read_chunks, TableWriter
+
+
+@click.command('geocode', short_help='Geocodes a CSV/Parquet file.')
+@click.argument('input', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--country-col', default='country', show_default=True, help='Country column (ISO2/ISO3 code or name).')
+@click.option('--country', 'country_code', default=None, help='Country of all the rows, instead of a column.')
+@click.option('--postal-col', default='postal_code', show_default=True, help='Postal code column.')
+@click.option('--name-col', default='name', show_default=True, help='City name column.')
+@click.option('--lon-col', default='longitude', show_default=True, help='Longitude column (WGS84).')
+@click.option('--lat-col', default='latitude', show_default=True, help='Latitude column (WGS84).')
+@click.option('--reverse/--no-reverse', default=None,
+              help='Reverse geocodes coordinates, by default if the input has coordinates but no postal code or name.')
+@click.option('--prefix', default='geo_', show_default=True, help='Prefix of the columns added to the input.')
+@click.option('-w', '--workers', type=int, default=None, help='Worker processes, 0 to run in this process.')
+@click.option('--chunk-size', type=int, default=None, help='Rows read and processed at once.')
+@click.option('--with-geonames', is_flag=True, help='Matches all the geonames places, not only the world cities.')
+@pass_environment
+def cli(ctx, input, output, country_col, country_code, postal_col, name_col, lon_col, lat_col, reverse, prefix,
+        workers, chunk_size, with_geonames):
+    """Adds country, city, admin codes, postal code and coordinates to each row of a CSV or Parquet file."""
+    columns = {'country': '_country' if country_code else country_col, 'postal_code': postal_col,
+               'name': name_col, 'longitude': lon_col, 'latitude': lat_col}
+    engine = BatchEngine(workers=workers, chunk_size=chunk_size, columns=columns,
+                         with_geonames=with_geonames or None)
+    chunks = read_chunks(input, engine.chunk_size, float_columns=(lon_col, lat_col))
+    first = next(chunks, None)
+    if first is None:
+        raise click.UsageError(f'{input} is empty.')
+    if reverse is None:
+        reverse = lon_col in first.columns and lat_col in first.columns \
+                  and postal_col not in first.columns and name_col not in first.columns
+    read = deque()
+
+    def inputs():
+        # input chunks are kept until their results are written, at most engine.max_pending of them
+        for chunk in itertools.chain([first], chunks):
+            read.append(chunk)
+            yield chunk.assign(_country=country_code) if country_code else chunk
+
+    start, rows, matched = time.time(), 0, 0
+    if not reverse and not country_code and country_col not in first.columns:
+        raise click.UsageError(f'no {country_col!r} column in {input}, use --country-col or --country.')
+    with engine, TableWriter(output) as writer:
+        for res in engine.run('reverse' if reverse else 'geocode', inputs()):
+            chunk = read.popleft()
+            writer.write(pd.concat([chunk.reset_index(drop=True),
+                                    res.add_prefix(prefix).reset_index(drop=True)], axis=1))
+            rows += len(res)
+            matched += int(res['match'].notna().sum())
+            elapsed = time.time() - start
+            ctx.log('%d rows, %d matched (%.1f%%), %.0f rows/s', rows, matched, 100. * matched / max(rows, 1),
+                    rows / max(elapsed, 1e-9))
+    ctx.log('%s: %d rows written in %.1fs', output, writer.rows, time.time() - start)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+`ngogeo serve`: local geocoding http service (ASGI, served by uvicorn).
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import click
+from ngoschema.cli import pass_environment
+
+from ngogeo import settings as geo_settings
+from ngogeo.service import GeoService
+
+
+@click.command('serve', short_help='Serves geocoding endpoints over http.')
+@click.option('--host', default=None, help='Host to bind (SERVICE_HOST by default).')
+@click.option('-p', '--port', type=int, default=None, help='Port to bind (SERVICE_PORT by default).')
+@click.option('-c', '--country', 'countries', multiple=True,
+              help='Country preloaded at startup (repeatable, SERVICE_COUNTRIES by default).')
+@click.option('--with-geonames', is_flag=True, help='Searches all the geonames places, not only cities.')
+@click.option('--admin-grids', is_flag=True, help='Builds the admin grids of the preloaded countries for /locate.')
+@click.option('--ip', is_flag=True, help='Preloads the table of the GeoLite2 city database for /ip.')
+@click.option('--max-batch', type=int, default=None, help='Maximum number of requests coalesced in a batch.')
+@click.option('--max-delay', type=float, default=None, help='Maximum wait (seconds) of a request for its batch.')
+@click.option('--threads', type=int, default=None, help='Threads running the batches and searches.')
+@pass_environment
+def cli(ctx, host, port, countries, with_geonames, admin_grids, ip, max_batch, max_delay, threads):
+    """
+    Serves /locate, /nearest, /radius, /name, /postal and /ip (GET, JSON), /health and /metrics.
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        raise ImportError('ngogeo serve requires uvicorn (pip install uvicorn)')
+    app = GeoService(countries=list(countries) or None, with_geonames=with_geonames or None, admin_grids=admin_grids,
+                     ip=ip, max_batch=max_batch, max_delay=max_delay, threads=threads)
+    host = host or geo_settings.SERVICE_HOST
+    port = port or geo_settings.SERVICE_PORT
+    ctx.log('serving %s on http://%s:%d', app, host, port)
+    uvicorn.run(app, host=host, port=port, lifespan='on', log_level='info')
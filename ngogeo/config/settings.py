@@ -1,5 +1,10 @@
 GEOLITE2_STATIC_FOLDER = 'geolite2'
 GEOLITE2_VERSION = '20211130'
+# reader mode of geolite2 databases: 'mmap', 'memory', 'file' or 'auto'
+GEOLITE2_READER_MODE = 'mmap'
+IP_CACHE_SIZE = 65536
+# bulk ip lookups in the sorted range tables exported from geolite2 databases (ngogeo.ip_table)
+IP_WITH_TABLE = False
 
 GEONAMES_DOWNLOAD_URL = 'https://download.geonames.org/export/dump/'
 GEONAMES_STATIC_FOLDER = 'geonames'
@@ -14,8 +19,69 @@ WORLD_WITH_SHAPE = True
 WORLD_WITH_CITIES = True
 COUNTRY_WITH_POSTALS = True
 COUNTRY_WITH_GEONAMES = False
+# snapshot folder (World.save_snapshot) restored by get_world when the first world is created
+WORLD_SNAPSHOT = None
 
 POSTAL_DOWNLOAD_URL = 'https://download.geonames.org/export/zip/'
 POSTAL_STATIC_FOLDER = 'postal'
 
 DEFAULT_RADIUS_SEARCH = 10000
+
+CACHE_STATIC_FOLDER = 'cache'
+# memory budget of the datasets (country frames, indexes) kept loaded, least recently used ones are evicted
+DATASET_CACHE_MAX_BYTES = 4 * 1024 ** 3
+
+# country and world frames stored column-wise, their coordinates, ids and string codes memory-mapped and shared
+# between the processes loading them (a folder on a tmpfs such as /dev/shm keeps them in shared memory). Geometries
+# and spatial indexes are still built by each process. Stored frames are read-only and their string columns are
+# categoricals, copy them before modifying them.
+FRAME_STORE = False
+FRAME_STORE_FOLDER = None
+
+# batch geocoding: worker processes (None for the number of cores, 0 to run in the calling process), rows per
+# chunk and chunks in flight before reading more input (None for twice the number of workers)
+BATCH_WORKERS = None
+BATCH_CHUNK_SIZE = 50000
+BATCH_MAX_PENDING = None
+
+# geocoding service (ngogeo serve): countries preloaded at startup, concurrent requests coalesced in batches of at
+# most SERVICE_MAX_BATCH items waiting at most SERVICE_MAX_DELAY seconds, run on SERVICE_THREADS threads
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8000
+SERVICE_COUNTRIES = []
+SERVICE_MAX_BATCH = 256
+SERVICE_MAX_DELAY = 0.002
+SERVICE_THREADS = 4
+
+# asyncio api (ngogeo.aio): threads running blocking i/o (downloads, overpass, geolite2 reads) and cpu bound loads
+# (None for the number of cores)
+AIO_IO_THREADS = 16
+AIO_CPU_THREADS = None
+
+# precomputed lookup grid (cell size in degrees)
+GRID_RESOLUTION = 0.25
+ADMIN_GRID_RESOLUTION = 0.05
+WORLD_WITH_GRID = False
+
+# projected CRS used for countries with a national grid, others stay in WSG84 and are searched with haversine
+COUNTRY_CRS = {'FR': 'EPSG:2154'}
+
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+OVERPASS_TIMEOUT = 180
+# on-disk cache of overpass responses (ttl in seconds, max size in bytes)
+OVERPASS_CACHE = True
+OVERPASS_CACHE_TTL = 7 * 24 * 3600
+OVERPASS_CACHE_MAX_SIZE = 256 * 1024 * 1024
+OVERPASS_CACHE_ONLY = False
+# bboxes can be split in tiles of fixed size (degrees) fetched concurrently and cached separately, opt-in as a
+# country-sized bbox makes hundreds of requests
+OVERPASS_TILED = False
+OVERPASS_TILE_SIZE = 0.25
+OVERPASS_WORKERS = 4
+OVERPASS_MAX_RETRIES = 3
+OVERPASS_RETRY_BACKOFF = 2.
+
+# sqlite database of an ingested osm extract, searched instead of overpass when set
+OSM_EXTRACT_DB = None
+# overpass output format ('json' or 'xml')
+OVERPASS_OUTPUT = 'json'
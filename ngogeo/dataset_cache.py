@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-bounded cache of the datasets loaded by territories (frames, indexes, mapping tables).
+
+Each entry is accounted with the memory it owns and entries are evicted in least recently used order once the
+budget DATASET_CACHE_MAX_BYTES is exceeded. Territories whose lazy properties hold an evicted dataset, or a subset
+derived from it, are reset so that the next access reloads it.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import mmap
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from ngogeo import settings as geo_settings
+from .single_flight import SingleFlight
+
+CacheStats = namedtuple('CacheStats', 'hits misses evictions items nbytes max_bytes')
+
+
+# approximate size of a GEOS geometry besides its coordinates
+GEOMETRY_BYTES = 100
+
+
+def _mapped(array):
+    """True if a numpy array is a view of a memory-mapped file, whose pages are not owned by the process."""
+    # copies of a np.memmap are np.memmap too, only views keep the mmap as base
+    while array is not None:
+        if isinstance(array, mmap.mmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def _array_nbytes(array):
+    return 0 if _mapped(array) else int(array.nbytes)
+
+
+def _series_nbytes(series):
+    array = series.array
+    if isinstance(series.dtype, gpd.array.GeometryDtype):
+        geoms = np.asarray(array, dtype=object)
+        coords = int(shapely.get_num_coordinates(geoms).sum()) * 8 * (3 if shapely.has_z(geoms).any() else 2)
+        return int(geoms.nbytes) + coords + GEOMETRY_BYTES * int((~shapely.is_missing(geoms)).sum())
+    if isinstance(array, pd.Categorical):
+        return _array_nbytes(array.codes) + int(array.categories.memory_usage(deep=True))
+    if isinstance(array, pd.arrays.NumpyExtensionArray) and series.dtype.kind in 'biufcmM':
+        return _array_nbytes(series.to_numpy())
+    return int(series.memory_usage(index=False, deep=True))
+
+
+def dataset_nbytes(obj):
+    """
+    Memory size owned by a frame, array or object exposing a `nbytes` attribute: deep size of the python objects,
+    approximate size of the geometries, without the memory-mapped arrays (their pages belong to the page cache).
+    """
+    if isinstance(obj, pd.DataFrame):
+        return sum(_series_nbytes(s) for k, s in obj.items()) + int(obj.index.memory_usage(deep=True))
+    if isinstance(obj, pd.Series):
+        return _series_nbytes(obj) + int(obj.index.memory_usage(deep=True))
+    if isinstance(obj, pd.Index):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        return _array_nbytes(obj)
+    nbytes = getattr(obj, 'nbytes', None)
+    return int(nbytes) if nbytes is not None else sys.getsizeof(obj)
+
+
+class DatasetCache(object):
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = geo_settings.DATASET_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._hits = self._misses = self._evictions = 0
+        self._lock = threading.RLock()
+        self._flights = SingleFlight()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {len(self._entries)} datasets {self._nbytes / 2 ** 20:.1f}/' \
+               f'{self.max_bytes / 2 ** 20:.0f}MB>'
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, loader, owner=None, prop=None):
+        """
+        Returns dataset `key`, loaded with `loader()` if not cached. If given, `owner[prop]` holds the dataset and
+        is reset when it is evicted. Concurrent callers of a missing key wait for a single load.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                self._add_owner(entry, owner, prop)
+                return entry[0]
+        value = self._flights.do(key, lambda: self._load(key, loader))
+        if owner is not None and value is not None:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._add_owner(entry, owner, prop)
+        return value
+
+    def put(self, key, value):
+        """Inserts an already loaded dataset `key`, replacing the cached one."""
+        self.evict(key)
+        nbytes = dataset_nbytes(value)
+        with self._lock:
+            self._entries[key] = [value, nbytes, []]
+            self._nbytes += nbytes
+            self._evict_to(self.max_bytes, keep=key)
+
+    def items(self):
+        """Returns the (key, dataset) pairs cached, least recently used first."""
+        with self._lock:
+            return [(k, e[0]) for k, e in self._entries.items()]
+
+    @staticmethod
+    def _add_owner(entry, owner, prop):
+        if owner is not None and all(o is not owner for o, p in entry[2]):
+            entry[2].append((owner, prop))
+
+    def _load(self, key, loader):
+        with self._lock:
+            # loaded by a flight that ended between the lookup and this one
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+        value = loader()
+        if value is None:
+            return None
+        nbytes = dataset_nbytes(value)
+        with self._lock:
+            self._entries[key] = [value, nbytes, []]
+            self._nbytes += nbytes
+            self._evict_to(self.max_bytes, keep=key)
+        return value
+
+    def _evict_to(self, max_bytes, keep=None):
+        while self._nbytes > max_bytes and self._entries:
+            key = next(iter(self._entries))
+            if key == keep:
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(key)
+                continue
+            self.evict(key)
+
+    def evict(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            self._nbytes -= entry[1]
+            self._evictions += 1
+        for owner, prop in entry[2]:
+            # the lazy property (and the subsets derived from it) is evaluated again by its getter on next access
+            owner.reset_dataset(prop)
+        return True
+
+    def clear(self):
+        for key in list(self._entries):
+            self.evict(key)
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict_to(max_bytes)
+
+    def sizes(self):
+        """Returns the size in bytes of each cached dataset, least recently used first."""
+        return OrderedDict((k, e[1]) for k, e in self._entries.items())
+
+    def stats(self):
+        return CacheStats(self._hits, self._misses, self._evictions, len(self._entries), self._nbytes,
+                          self.max_bytes)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_dataset_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = DatasetCache()
+    return _cache
@@ -27,7 +27,8 @@ class GeoDataframeSubset(with_metaclass(SchemaMetaclass)):
         gdf = self.subset
         return pd.DataFrame(gdf) if gdf is not None else None
 
-    def search_radius(self, point, radius=10000, point_crs=None, regex=False, **kwargs):
+    def search_radius(self, point, radius=10000, point_crs=None, regex=False, geographic=None, limit=None, **kwargs):
         subset = self.subset
         if subset is not None:
-            return _search_radius(subset, point, radius=10000, point_crs=None, regex=False, **kwargs)
+            return _search_radius(subset, point, radius=radius, point_crs=point_crs, regex=regex,
+                                  geographic=geographic, limit=limit, **kwargs)
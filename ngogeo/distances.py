@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized great-circle distances on longitude/latitude arrays (in degrees).
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import numpy as np
+import geopandas as gpd
+
+from ngogeo import settings as geo_settings
+
+EARTH_RADIUS_KM = 6371.0088  # mean earth radius (IUGG)
+
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    """Great-circle distance in km, arguments are broadcast against each other."""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2.) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2
+    return 2. * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0., 1.)))
+
+
+def geodesic_km(lon1, lat1, lon2, lat2, ellps='WGS84'):
+    """Distance in km on the ellipsoid (pyproj.Geod), slower but exact."""
+    from pyproj import Geod
+    lon1, lat1, lon2, lat2 = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (lon1, lat1, lon2, lat2)])
+    _, _, d = Geod(ellps=ellps).inv(lon1, lat1, lon2, lat2)
+    return np.asarray(d) / 1000.
+
+
+def distance_matrix_km(lons1, lats1, lons2, lats2, chunk_size=2048, method='haversine'):
+    """NxM distance matrix in km, computed by chunks of rows to bound the temporaries."""
+    dist = haversine_km if method == 'haversine' else geodesic_km
+    lons1, lats1 = np.asarray(lons1, dtype=float), np.asarray(lats1, dtype=float)
+    lons2, lats2 = np.asarray(lons2, dtype=float)[None, :], np.asarray(lats2, dtype=float)[None, :]
+    res = np.empty((len(lons1), lons2.shape[1]))
+    for i in range(0, len(lons1), chunk_size):
+        res[i:i + chunk_size] = dist(lons1[i:i + chunk_size, None], lats1[i:i + chunk_size, None], lons2, lats2)
+    return res
+
+
+def lonlat_arrays(obj, crs=None):
+    """Returns longitude and latitude arrays (EPSG:4326) of a point, a (lon, lat) tuple or a geodataframe/geoseries."""
+    from .point_search import _transform_xy
+    wsg84 = geo_settings.WSG84_CRS
+    if isinstance(obj, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        if isinstance(obj, gpd.GeoDataFrame) and 'longitude' in obj and 'latitude' in obj:
+            return obj['longitude'].to_numpy(float), obj['latitude'].to_numpy(float)
+        geom = obj.geometry
+        return _transform_xy(geom.x.to_numpy(float), geom.y.to_numpy(float), geom.crs, wsg84)
+    if hasattr(obj, 'x'):
+        obj = (obj.x, obj.y)
+    lon, lat = np.atleast_1d(obj[0]).astype(float), np.atleast_1d(obj[1]).astype(float)
+    lon, lat = _transform_xy(lon, lat, crs, wsg84)
+    return np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+
+
+def gdf_distance_matrix_km(gdf1, gdf2, chunk_size=2048, method='haversine'):
+    """Distance matrix between two result sets (ex: cities x postals) as a dataframe indexed as the inputs."""
+    import pandas as pd
+    lons1, lats1 = lonlat_arrays(gdf1)
+    lons2, lats2 = lonlat_arrays(gdf2)
+    return pd.DataFrame(distance_matrix_km(lons1, lats1, lons2, lats2, chunk_size=chunk_size, method=method),
+                        index=gdf1.index, columns=gdf2.index)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Column-wise storage of (geo)dataframes as .npy arrays.
+
+Each column is saved as contiguous arrays so that it is loaded memory-mapped: numeric and datetime columns as is,
+nullable integers as values and mask, strings as category codes and categories, point geometries as x/y
+coordinates and other geometries as concatenated WKB buffers.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import os
+import pathlib
+import shutil
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from ngoschema.loaders import static_module_loader
+from ngogeo import settings as geo_settings
+from .single_flight import single_flight
+
+FRAME_META = 'frame.json'
+
+frame_store_folder = pathlib.Path(geo_settings.FRAME_STORE_FOLDER) if geo_settings.FRAME_STORE_FOLDER else \
+    static_module_loader.subfolder('ngogeo').joinpath(geo_settings.CACHE_STATIC_FOLDER, 'frames')
+
+
+def _save_column(folder, i, series):
+    fn = folder.joinpath(f'{i}')
+    if isinstance(series.dtype, gpd.array.GeometryDtype):
+        geoms = np.asarray(series.array, dtype=object)
+        if (shapely.get_type_id(geoms) <= 0).all():
+            # points (0) and missing geometries (-1)
+            xy = np.full((len(geoms), 2), np.nan)
+            valid = ~shapely.is_missing(geoms)
+            xy[valid] = shapely.get_coordinates(geoms[valid])
+            np.save(f'{fn}_xy.npy', xy)
+            return {'kind': 'points'}
+        wkbs = shapely.to_wkb(geoms)
+        lengths = np.array([len(w) if w is not None else -1 for w in wkbs], dtype=np.int64)
+        np.save(f'{fn}_offsets.npy', np.concatenate([[0], np.cumsum(np.maximum(lengths, 0))]))
+        np.save(f'{fn}_missing.npy', lengths < 0)
+        np.save(f'{fn}_wkb.npy', np.frombuffer(b''.join(w for w in wkbs if w is not None), dtype=np.uint8))
+        return {'kind': 'wkb'}
+    if isinstance(series.dtype, pd.api.extensions.ExtensionDtype) and series.dtype.kind in 'iufb':
+        np.save(f'{fn}_values.npy', series.fillna(0).to_numpy(dtype=series.dtype.numpy_dtype))
+        np.save(f'{fn}_mask.npy', series.isna().to_numpy())
+        return {'kind': 'masked', 'dtype': str(series.dtype)}
+    if series.dtype.kind in 'biufcmM':
+        np.save(f'{fn}.npy', series.to_numpy())
+        return {'kind': 'array'}
+    values = series.astype(object)
+    notna = values.notna()
+    if not values[notna].map(type).eq(str).all():
+        raise TypeError(f'column {series.name!r} is neither numeric, geometry nor string.')
+    codes, categories = pd.factorize(values)
+    # codes in the smallest integer type of pandas categoricals, so that they are used without copy
+    codes = pd.Categorical.from_codes(codes, categories=categories, validate=False).codes
+    np.save(f'{fn}_codes.npy', codes)
+    np.save(f'{fn}_categories.npy', np.asarray(categories, dtype=str))
+    return {'kind': 'category'}
+
+
+def _load_column(folder, i, meta, mmap_mode, categorical=False):
+    fn = str(folder.joinpath(f'{i}'))
+    kind = meta['kind']
+    if kind == 'points':
+        xy = np.load(f'{fn}_xy.npy', mmap_mode=mmap_mode)
+        geoms = shapely.points(xy)
+        geoms[np.isnan(xy[:, 0])] = None
+        return geoms
+    if kind == 'wkb':
+        offsets = np.load(f'{fn}_offsets.npy')
+        missing = np.load(f'{fn}_missing.npy')
+        buffer = np.load(f'{fn}_wkb.npy', mmap_mode=mmap_mode)
+        wkbs = np.array([None if m else buffer[lo:hi].tobytes()
+                         for lo, hi, m in zip(offsets[:-1], offsets[1:], missing)], dtype=object)
+        return shapely.from_wkb(wkbs)
+    if kind == 'masked':
+        values = np.load(f'{fn}_values.npy', mmap_mode=mmap_mode)
+        mask = np.load(f'{fn}_mask.npy', mmap_mode=mmap_mode)
+        array_cls = type(pd.array([], dtype=meta['dtype']))
+        return array_cls(np.asarray(values), np.asarray(mask))
+    if kind == 'array':
+        return np.load(f'{fn}.npy', mmap_mode=mmap_mode)
+    codes = np.load(f'{fn}_codes.npy', mmap_mode=mmap_mode)
+    categories = np.load(f'{fn}_categories.npy').astype(object)
+    if categorical:
+        return pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object), validate=False)
+    # strings are shared between the rows of a same category
+    return np.where(codes >= 0, categories.take(np.maximum(codes, 0)) if len(categories) else None, None)
+
+
+def source_stamps(paths):
+    """Returns the [path, mtime, size] stamps of source files, with None mtime and size for missing files."""
+    stamps = []
+    for path in map(pathlib.Path, paths):
+        stat = path.stat() if path.exists() else None
+        stamps.append([str(path), stat.st_mtime_ns, stat.st_size] if stat else [str(path), None, None])
+    return stamps
+
+
+def save_frame(frame, folder, sources=None):
+    """
+    Saves a DataFrame or GeoDataFrame column-wise in folder, with the stamps of its source files (see
+    source_stamps, by default those of frame.attrs['sources']).
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    index_names = [n if n is not None else f'__index_{i}__' for i, n in enumerate(frame.index.names)]
+    flat = frame.copy(deep=False)
+    flat.index = flat.index.set_names(index_names)
+    flat = flat.reset_index()
+    columns = [dict(name=c, **_save_column(folder, i, flat[c])) for i, c in enumerate(flat.columns)]
+    meta = {'length': len(flat), 'columns': columns, 'index': index_names,
+            'sources': frame.attrs.get('sources', []) if sources is None else sources}
+    if isinstance(frame, gpd.GeoDataFrame) and frame._geometry_column_name in frame.columns:
+        meta['geometry'] = frame.geometry.name
+        meta['crs'] = frame.crs.to_string() if frame.crs is not None else None
+    with folder.joinpath(FRAME_META).open('w') as f:
+        json.dump(meta, f)
+
+
+def load_frame(folder, mmap_mode='r', categorical=False):
+    """
+    Loads a frame saved by save_frame, numeric columns being memory-mapped with mmap_mode. With categorical,
+    string columns are categoricals over the memory-mapped codes instead of object columns.
+    """
+    with folder.joinpath(FRAME_META).open() as f:
+        meta = json.load(f)
+    # index values are copied by pandas, they are not loaded as categoricals
+    data = {c['name']: _load_column(folder, i, c, mmap_mode, categorical and c['name'] not in meta['index'])
+            for i, c in enumerate(meta['columns'])}
+    frame = pd.DataFrame(data, copy=False)
+    if 'geometry' in meta:
+        for c in meta['columns']:
+            if c['kind'] in ('points', 'wkb'):
+                frame[c['name']] = gpd.GeoSeries(frame[c['name']].values, crs=meta['crs'])
+        frame = gpd.GeoDataFrame(frame, geometry=meta['geometry'], crs=meta['crs'], copy=False)
+    frame = frame.set_index(meta['index'])
+    frame.index.names = [None if n.startswith('__index_') else n for n in meta['index']]
+    frame.attrs['sources'] = meta.get('sources', [])
+    return frame
+
+
+def frame_exists(folder):
+    return folder.joinpath(FRAME_META).exists()
+
+
+def sources_outdated(recorded):
+    """True if a source file changed since its stamp was recorded (missing source files are ignored)."""
+    stamps = source_stamps(path for path, mtime, size in recorded)
+    return any(stamp[1] is not None and stamp != saved for stamp, saved in zip(stamps, recorded))
+
+
+def frame_outdated(folder):
+    """True if a source file of a saved frame changed since it was saved."""
+    with folder.joinpath(FRAME_META).open() as f:
+        return sources_outdated(json.load(f).get('sources', []))
+
+
+def stored_frame_folder(name):
+    return frame_store_folder.joinpath(name.replace(':', '_'))
+
+
+def clear_stored_frames(pattern):
+    """Removes the stored frames whose name matches a glob pattern, returns their number."""
+    folders = list(frame_store_folder.glob(pattern.replace(':', '_'))) if frame_store_folder.exists() else []
+    for folder in folders:
+        shutil.rmtree(folder)
+    return len(folders)
+
+
+def get_stored_frame(name, loader, rebuild=False, sources=()):
+    """
+    Returns frame `name` of the frame store, saved first from loader() if not stored yet or if one of its `sources`
+    files changed since. Coordinates, ids and category codes are memory-mapped, so that the processes loading a
+    same frame share their physical pages, but geometries are built from them by each process. The frame is
+    read-only and its string columns are categoricals.
+    """
+    if not geo_settings.FRAME_STORE:
+        frame = loader()
+        if frame is not None:
+            frame.attrs['sources'] = source_stamps(sources)
+        return frame
+    folder = stored_frame_folder(name)
+
+    def store():
+        if rebuild or not frame_exists(folder) or frame_outdated(folder):
+            # saved aside then renamed, as other processes may be storing or loading the same frame
+            tmp = folder.with_name(f'{folder.name}.{os.getpid()}.tmp')
+            frame = loader()
+            # stamped once loaded, as the loader may download the sources
+            save_frame(frame, tmp, sources=source_stamps(sources))
+            if folder.exists():
+                shutil.rmtree(folder)
+            try:
+                tmp.rename(folder)
+            except OSError:
+                shutil.rmtree(tmp)
+        return load_frame(folder, categorical=True)
+
+    return single_flight(('frame', name), store)
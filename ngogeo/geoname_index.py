@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Indexes of the rows of a loaded geonames/cities frame: hash index from geonameid to row position, and name index of
+the normalized names of the rows.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import numpy as np
+import pandas as pd
+
+from .dataset_cache import get_dataset_cache
+from .city_postals import _name_key
+
+
+class GeonameIndex(object):
+    # stamps of the source files of the indexed frame (see frames.source_stamps)
+    sources = ()
+
+    def __init__(self, geonameids, sources=()):
+        self.sources = list(sources)
+        geonameids = np.asarray(pd.Series(geonameids).fillna(-1), dtype=np.int64)
+        # keep the first row of duplicated ids so that the index is unique
+        _, first = np.unique(geonameids, return_index=True)
+        self.rows = np.sort(first)
+        self._index = pd.Index(geonameids[self.rows])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def save(self, folder):
+        folder.mkdir(parents=True, exist_ok=True)
+        np.save(folder.joinpath('rows.npy'), self.rows)
+        np.save(folder.joinpath('geonameids.npy'), self._index.to_numpy())
+        with folder.joinpath('index.json').open('w') as f:
+            json.dump({'sources': self.sources}, f)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        index = cls.__new__(cls)
+        index.rows = np.load(folder.joinpath('rows.npy'), mmap_mode=mmap_mode)
+        index._index = pd.Index(np.load(folder.joinpath('geonameids.npy')))
+        meta = folder.joinpath('index.json')
+        if meta.exists():
+            with meta.open() as f:
+                index.sources = json.load(f)['sources']
+        return index
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self._index.memory_usage(deep=True)
+
+    def __contains__(self, gid):
+        return self.position(gid) >= 0
+
+    def positions(self, gids):
+        """Returns the row positions of geonameids, -1 if not indexed."""
+        gids = np.asarray(pd.Series(gids, dtype=object).fillna(-1), dtype=np.int64)
+        pos = self._index.get_indexer(gids)
+        return np.where(pos >= 0, self.rows[pos], -1)
+
+    def position(self, gid):
+        if gid is None or pd.isna(gid):
+            return -1
+        return int(self.positions([gid])[0])
+
+    def row(self, frame, gid):
+        """Returns the row of geonameid in the indexed frame, or None."""
+        pos = self.position(gid)
+        return frame.iloc[pos] if pos >= 0 else None
+
+
+def get_geoname_index(name, frame, rebuild=False):
+    """Returns the index `name` of a frame with a geonameid column, built on first access into the dataset cache."""
+    cache = get_dataset_cache()
+    if rebuild:
+        cache.evict(('geoname_index', name))
+    return cache.get(('geoname_index', name),
+                     lambda: GeonameIndex(frame['geonameid'], sources=frame.attrs.get('sources', ())))
+
+
+class NameIndex(object):
+    """Normalized names (see city_postals._name_key) of the rows of a frame, stored as codes of the unique names."""
+    # stamps of the source files of the indexed frame (see frames.source_stamps)
+    sources = ()
+
+    def __init__(self, names, sources=()):
+        self.sources = list(sources)
+        codes, keys = pd.factorize(_name_key(pd.Series(names).fillna('')))
+        self.codes = codes.astype(np.int32)
+        self.keys = pd.Index(keys)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def save(self, folder):
+        folder.mkdir(parents=True, exist_ok=True)
+        np.save(folder.joinpath('codes.npy'), self.codes)
+        np.save(folder.joinpath('keys.npy'), self.keys.to_numpy(dtype=str))
+        with folder.joinpath('index.json').open('w') as f:
+            json.dump({'sources': self.sources}, f)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        index = cls.__new__(cls)
+        index.codes = np.load(folder.joinpath('codes.npy'), mmap_mode=mmap_mode)
+        index.keys = pd.Index(np.load(folder.joinpath('keys.npy')).astype(object))
+        with folder.joinpath('index.json').open() as f:
+            index.sources = json.load(f)['sources']
+        return index
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.keys.memory_usage(deep=True)
+
+    def lookup(self, names):
+        """Returns the codes of names, -1 if no row has the name or if the name is empty once normalized."""
+        keys = _name_key(pd.Series(names, dtype=object).fillna(''))
+        return np.where(keys.to_numpy() != '', self.keys.get_indexer(keys), -1)
+
+    def positions(self, name):
+        """Returns the row positions of a name."""
+        code = self.lookup([name])[0]
+        return np.flatnonzero(self.codes == code) if code >= 0 else np.array([], dtype=np.int64)
+
+
+def get_name_index(name, frame, rebuild=False):
+    """Returns the name index `name` of a frame with a name column, built on first access into the dataset cache."""
+    cache = get_dataset_cache()
+    if rebuild:
+        cache.evict(('name_index', name))
+    return cache.get(('name_index', name), lambda: NameIndex(frame['name'], sources=frame.attrs.get('sources', ())))
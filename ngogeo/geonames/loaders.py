@@ -48,9 +48,14 @@ DATA_FIELDS = {
 }
 
 
-def load_geonames_gdf(filename, crs=None):
-    gdir = geonames_folder.joinpath(filename)
-    gct = gdir.joinpath(filename + '.txt')
+def geonames_file(filename):
+    """Path of the text file of geonames dump `filename`, downloaded or not."""
+    return geonames_folder.joinpath(filename, filename + '.txt')
+
+
+def download_geonames(filename):
+    """Downloads and extracts geonames dump `filename` if not done yet, returns the path of its text file."""
+    gct = geonames_file(filename)
     if not gct.exists():
         url = geo_settings.GEONAMES_DOWNLOAD_URL + filename + '.zip'
         r = requests.get(url)
@@ -62,6 +67,11 @@ def load_geonames_gdf(filename, crs=None):
         # extract archive
         with zipfile.ZipFile(gcz, 'r') as zo:
             zo.extractall(str(geonames_folder.joinpath(filename)))
+    return gct
+
+
+def load_geonames_gdf(filename, crs=None):
+    gct = download_geonames(filename)
     df = pd.read_csv(gct, sep="\t", dtype=DATA_FIELDS, names=tuple(DATA_FIELDS))
     df['modificationdate'] = pd.to_datetime(df['modificationdate'])
     gdf = gpd.GeoDataFrame(
@@ -72,6 +82,32 @@ def load_geonames_gdf(filename, crs=None):
     return gdf if not crs or gdf.crs.is_exact_same(crs) else gdf.to_crs(crs)
 
 
+ADMIN_CODES_FILES = {1: 'admin1CodesASCII.txt', 2: 'admin2Codes.txt'}
+
+
+def load_admin_codes(level):
+    """Loads geonames admin1/admin2 code tables, with codes as 'FR.84' / 'FR.84.42'."""
+    filename = ADMIN_CODES_FILES[level]
+    fp = geonames_folder.joinpath(filename)
+    if not fp.exists():
+        r = requests.get(geo_settings.GEONAMES_DOWNLOAD_URL + filename)
+        r.raise_for_status()
+        with fp.open('wb') as f:
+            f.write(r.content)
+    # Namibia country code is NA
+    return pd.read_csv(fp, sep="\t", names=['code', 'name', 'asciiname', 'geonameid'], keep_default_na=False,
+                       na_values={'geonameid': ['']}, dtype={'code': str, 'name': str, 'asciiname': str,
+                                                             'geonameid': pd.Int64Dtype()})
+
+
+def load_hierarchy():
+    """Loads the parent/child geonameid relations of hierarchy.zip."""
+    hz = geonames_folder.joinpath('hierarchy.zip')
+    assert hz.exists()
+    return pd.read_csv(hz, sep="\t", names=['parent', 'child', 'type'], keep_default_na=False,
+                       dtype={'parent': 'int64', 'child': 'int64', 'type': str})
+
+
 def load_languages():
     lg = geonames_folder.joinpath('iso-languagecodes.txt')
     assert lg.exists()
@@ -93,6 +129,14 @@ def load_cities(filename='cities5000', crs=None):
     return load_geonames_gdf(filename, crs)
 
 
+def countries_files(with_shapes=True):
+    """Paths of the country infos and, with shapes, of the country shapes."""
+    files = [geonames_folder.joinpath('countryInfo.txt')]
+    if with_shapes:
+        files.append(geonames_folder.joinpath('shapes_simplified_low', 'shapes_simplified_low.json'))
+    return files
+
+
 def load_countries(with_shapes=True):
     ci = geonames_folder.joinpath('countryInfo.txt')
     assert ci.exists()
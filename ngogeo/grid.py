@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed lookup grid for constant time reverse geocoding.
+
+The extent is rasterized in cells of `resolution` degrees. A cell entirely inside one territory stores the
+position of that territory, an empty cell stores -1 and a cell crossed by a boundary stores -(2 + n) where n is
+its row in the border table listing the candidate territories to test exactly.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import numpy as np
+import shapely
+
+from ngoschema.loaders import static_module_loader
+from ngogeo import settings as geo_settings
+from .single_flight import single_flight
+from .frames import sources_outdated
+
+grid_folder = static_module_loader.subfolder('ngogeo').joinpath(geo_settings.CACHE_STATIC_FOLDER, 'grid')
+
+WORLD_BOUNDS = (-180., -90., 180., 90.)
+
+_grids = {}
+
+
+class TerritoryGrid(object):
+
+    def __init__(self, cells, border_ptr, border_idx, geometries, labels, bounds, resolution, sources=()):
+        self.cells = cells
+        self.border_ptr = border_ptr
+        self.border_idx = border_idx
+        self.geometries = geometries
+        self.labels = list(labels)
+        self.bounds = tuple(bounds)
+        self.resolution = resolution
+        # stamps of the source files of the territories (see frames.source_stamps)
+        self.sources = list(sources)
+
+    def __repr__(self):
+        ny, nx = self.cells.shape
+        return f'<{self.__class__.__name__} {nx}x{ny} @{self.resolution}deg {len(self.labels)} territories>'
+
+    @classmethod
+    def build(cls, geometries, labels, resolution=None, bounds=None, sources=()):
+        """Rasterize geometries (in EPSG:4326) row by row to keep memory bounded."""
+        resolution = resolution or geo_settings.GRID_RESOLUTION
+        geometries = np.asarray(geometries, dtype=object)
+        if bounds is None:
+            minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+            minx, miny = np.floor(minx / resolution) * resolution, np.floor(miny / resolution) * resolution
+            bounds = (minx, miny, maxx, maxy)
+        minx, miny, maxx, maxy = bounds
+        nx = max(int(np.ceil((maxx - minx) / resolution)), 1)
+        ny = max(int(np.ceil((maxy - miny) / resolution)), 1)
+        tree = shapely.STRtree(geometries)
+        x0 = minx + np.arange(nx) * resolution
+        cells = np.full((ny, nx), -1, dtype=np.int32)
+        border_ptr = [0]
+        border_idx = []
+        for iy in range(ny):
+            y0 = miny + iy * resolution
+            boxes = shapely.box(x0, y0, x0 + resolution, y0 + resolution)
+            box_ids, geom_ids = tree.query(boxes, predicate='intersects')
+            if not len(box_ids):
+                continue
+            counts = np.bincount(box_ids, minlength=nx)
+            inside = shapely.contains(geometries[geom_ids], boxes[box_ids])
+            full = inside & (counts[box_ids] == 1)
+            cells[iy, box_ids[full]] = geom_ids[full]
+            border = ~full
+            # query results are ordered by box, candidates of a border cell are contiguous
+            for ix in np.unique(box_ids[border]):
+                cells[iy, ix] = -(2 + len(border_ptr) - 1)
+                candidates = geom_ids[box_ids == ix]
+                border_idx.extend(candidates.tolist())
+                border_ptr.append(len(border_idx))
+        return cls(cells, np.asarray(border_ptr, dtype=np.int64), np.asarray(border_idx, dtype=np.int32),
+                   geometries, labels, bounds, resolution, sources)
+
+    def save(self, folder):
+        folder.mkdir(parents=True, exist_ok=True)
+        np.save(folder.joinpath('cells.npy'), self.cells)
+        np.save(folder.joinpath('border_ptr.npy'), self.border_ptr)
+        np.save(folder.joinpath('border_idx.npy'), self.border_idx)
+        wkbs = shapely.to_wkb(self.geometries)
+        np.save(folder.joinpath('geometries_ptr.npy'), np.cumsum([0] + [len(w) for w in wkbs]))
+        with folder.joinpath('geometries.wkb').open('wb') as f:
+            f.write(b''.join(wkbs))
+        with folder.joinpath('grid.json').open('w') as f:
+            json.dump(dict(labels=self.labels, bounds=self.bounds, resolution=self.resolution, sources=self.sources), f)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        with folder.joinpath('grid.json').open() as f:
+            meta = json.load(f)
+        cells = np.load(folder.joinpath('cells.npy'), mmap_mode=mmap_mode)
+        border_ptr = np.load(folder.joinpath('border_ptr.npy'), mmap_mode=mmap_mode)
+        border_idx = np.load(folder.joinpath('border_idx.npy'), mmap_mode=mmap_mode)
+        ptr = np.load(folder.joinpath('geometries_ptr.npy'))
+        buf = folder.joinpath('geometries.wkb').read_bytes()
+        geometries = shapely.from_wkb([buf[i:j] for i, j in zip(ptr[:-1], ptr[1:])])
+        return cls(cells, border_ptr, border_idx, geometries, meta['labels'], meta['bounds'], meta['resolution'],
+                   meta.get('sources', ()))
+
+    def lookup(self, lons, lats):
+        """Returns the position of the territory containing each coordinate, -1 if none."""
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        minx, miny = self.bounds[:2]
+        ny, nx = self.cells.shape
+        ix = np.floor((lons - minx) / self.resolution).astype(np.int64)
+        iy = np.floor((lats - miny) / self.resolution).astype(np.int64)
+        valid = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        res = np.full(lons.shape, -1, dtype=np.int32)
+        res[valid] = self.cells[iy[valid], ix[valid]]
+        for i in np.flatnonzero(res <= -2):
+            row = -res[i] - 2
+            res[i] = -1
+            for c in self.border_idx[self.border_ptr[row]:self.border_ptr[row + 1]]:
+                if shapely.intersects_xy(self.geometries[c], lons[i], lats[i]):
+                    res[i] = c
+                    break
+        return res
+
+    def locate(self, lon, lat):
+        """Returns the label of the territory containing the coordinate or None."""
+        i = self.lookup(lon, lat)[0]
+        return self.labels[i] if i >= 0 else None
+
+    def locate_labels(self, lons, lats):
+        idx = self.lookup(lons, lats)
+        labels = np.asarray(self.labels + [None], dtype=object)
+        return labels[idx]
+
+
+def get_territory_grid(name, geometries, labels, resolution=None, bounds=None, rebuild=False, digest=None,
+                       sources=()):
+    """
+    Returns the grid `name`, loading it memory-mapped from cache or building and persisting it first.
+    `geometries` can be a callable returning (geometries, labels), only called when the grid is built, and `digest`
+    a version of the territories (or a callable returning it) naming the cache folder, so that a grid of other
+    territories is not reused. `sources` are the stamps of the source files of the territories (or a callable
+    returning them), saved with the grid.
+    """
+    resolution = resolution or geo_settings.GRID_RESOLUTION
+    version = digest() if callable(digest) else digest
+    bounds = tuple(bounds) if bounds is not None else None
+    key = (name, resolution, version, bounds)
+
+    def load():
+        if key in _grids and not rebuild:
+            return _grids[key]
+        folder = grid_folder.joinpath(grid_folder_name(*key))
+        grid = TerritoryGrid.load(folder) if folder.joinpath('grid.json').exists() and not rebuild else None
+        # grids whose source files changed are built again
+        if grid is None or sources_outdated(grid.sources):
+            geoms, labs = geometries() if callable(geometries) else (geometries, labels)
+            grid = TerritoryGrid.build(geoms, labs, resolution=resolution, bounds=bounds,
+                                       sources=sources() if callable(sources) else sources)
+            grid.save(folder)
+        _grids[key] = grid
+        return grid
+
+    if key not in _grids or rebuild:
+        return single_flight(('grid', key), load)
+    return _grids[key]
+
+
+def grid_folder_name(name, resolution, version=None, bounds=None):
+    """Name of the cache folder of a grid key."""
+    folder = f'{name}_{resolution:g}' + (f'_{version}' if version else '')
+    return folder + ('_' + '_'.join(f'{b:g}' for b in bounds) if bounds is not None else '')
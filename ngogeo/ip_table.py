@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+GeoLite2 databases flattened in sorted network ranges for vectorized bulk lookups.
+
+Each database is exported once as sorted arrays of range starts/ends (uint32 for IPv4, 16 bytes big endian for
+IPv6) pointing to rows of a deduplicated attribute table. Arrays are persisted as .npy files and memory-mapped,
+so a lookup of many addresses is a single `searchsorted`.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import ipaddress
+import json
+import numpy as np
+import pandas as pd
+
+from ngoschema.loaders import static_module_loader
+from ngogeo import settings as geo_settings
+from .single_flight import single_flight
+
+ip_table_folder = static_module_loader.subfolder('ngogeo').joinpath(geo_settings.CACHE_STATIC_FOLDER, 'ip_table')
+
+_tables = {}
+
+
+class IpTable(object):
+
+    def __init__(self, v4_starts, v4_ends, v4_attrs, v6_starts, v6_ends, v6_attrs, attributes):
+        self.v4_starts, self.v4_ends, self.v4_attrs = v4_starts, v4_ends, v4_attrs
+        self.v6_starts, self.v6_ends, self.v6_attrs = v6_starts, v6_ends, v6_attrs
+        self.attributes = attributes
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {len(self.v4_starts)} ipv4 ranges, {len(self.v6_starts)} ipv6 ranges, ' \
+               f'{len(self.attributes)} attributes>'
+
+    @classmethod
+    def build(cls, ip_utils_cls):
+        """Walks the networks of the database of an IpUtilsFile subclass and flattens them."""
+        import maxminddb
+        v4, v6, records = [], [], {}
+        with maxminddb.open_database(str(ip_utils_cls.db_path())) as reader:
+            for network, record in reader:
+                attr = records.setdefault(ip_utils_cls._parse(record), len(records))
+                if network.version == 4:
+                    v4.append((int(network.network_address), int(network.broadcast_address), attr))
+                elif network.network_address.ipv4_mapped is None and network.network_address.sixtofour is None:
+                    v6.append((network.network_address.packed, network.broadcast_address.packed, attr))
+        v4.sort()
+        v6.sort()
+        attributes = pd.DataFrame.from_records(list(records), columns=list(ip_utils_cls._fields))
+        return cls(np.array([r[0] for r in v4], dtype=np.uint32), np.array([r[1] for r in v4], dtype=np.uint32),
+                   np.array([r[2] for r in v4], dtype=np.int32),
+                   np.array([r[0] for r in v6], dtype='S16'), np.array([r[1] for r in v6], dtype='S16'),
+                   np.array([r[2] for r in v6], dtype=np.int32), attributes)
+
+    def save(self, folder):
+        folder.mkdir(parents=True, exist_ok=True)
+        for name in ('v4_starts', 'v4_ends', 'v4_attrs', 'v6_starts', 'v6_ends', 'v6_attrs'):
+            np.save(folder.joinpath(f'{name}.npy'), getattr(self, name))
+        dtypes = {}
+        for c in self.attributes.columns:
+            col = self.attributes[c]
+            if pd.api.types.is_numeric_dtype(col):
+                arr, dtypes[c] = col.to_numpy(dtype=float, na_value=np.nan), 'float'
+            else:
+                arr, dtypes[c] = np.array([v if isinstance(v, str) else '' for v in col], dtype=str), 'str'
+            np.save(folder.joinpath(f'attr_{c}.npy'), arr)
+        with folder.joinpath('ip_table.json').open('w') as f:
+            json.dump(dict(columns=list(self.attributes.columns), dtypes=dtypes), f)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        with folder.joinpath('ip_table.json').open() as f:
+            meta = json.load(f)
+        arrays = [np.load(folder.joinpath(f'{name}.npy'), mmap_mode=mmap_mode)
+                  for name in ('v4_starts', 'v4_ends', 'v4_attrs', 'v6_starts', 'v6_ends', 'v6_attrs')]
+        attributes = {}
+        for c in meta['columns']:
+            arr = np.load(folder.joinpath(f'attr_{c}.npy'), mmap_mode=mmap_mode)
+            attributes[c] = pd.Series(arr).replace('', None) if meta['dtypes'][c] == 'str' else arr
+        return cls(*arrays, pd.DataFrame(attributes))
+
+    @staticmethod
+    def _search(starts, ends, attrs, keys):
+        pos = np.searchsorted(starts, keys, side='right') - 1
+        found = pos >= 0
+        pos = np.where(found, pos, 0)
+        found &= keys <= ends[pos] if len(ends) else False
+        return np.where(found, attrs[pos] if len(attrs) else -1, -1)
+
+    def lookup_positions(self, ips):
+        """Returns the attribute row of each ip, -1 if not found or invalid."""
+        ips = pd.Series(ips, dtype=object).astype(str).to_numpy(dtype=str)
+        res = np.full(len(ips), -1, dtype=np.int64)
+        is_v6 = np.char.find(ips, ':') >= 0
+        v4 = np.flatnonzero(~is_v6)
+        if len(v4):
+            keys, valid = _parse_ipv4(ips[v4])
+            res[v4] = np.where(valid, self._search(self.v4_starts, self.v4_ends, self.v4_attrs, keys), -1)
+        v6 = np.flatnonzero(is_v6)
+        if len(v6):
+            packed = []
+            for ip in ips[v6]:
+                try:
+                    packed.append(ipaddress.IPv6Address(ip).packed)
+                except ValueError:
+                    packed.append(None)
+            valid = np.array([p is not None for p in packed])
+            keys = np.array([p or b'' for p in packed], dtype='S16')
+            res[v6] = np.where(valid, self._search(self.v6_starts, self.v6_ends, self.v6_attrs, keys), -1)
+        return res
+
+    def lookup(self, ips):
+        """Same output as IpUtilsFile.lookup_batch, as a single vectorized search."""
+        ips = ips if isinstance(ips, pd.Series) else pd.Series(ips)
+        pos = self.lookup_positions(ips)
+        attributes = pd.concat([self.attributes, self.attributes.iloc[:0].reindex([len(self.attributes)])])
+        res = attributes.iloc[np.where(pos < 0, len(self.attributes), pos)].set_index(ips.index)
+        for c in res.columns:
+            if c.endswith('geonameid'):
+                res[c] = res[c].astype(pd.Int64Dtype())
+        res.insert(0, 'ip', ips)
+        return res
+
+
+def _parse_ipv4(ips):
+    """Parses an array of dotted ipv4 strings on their ascii bytes, returns uint32 keys and a validity mask."""
+    try:
+        b = ips.astype('S16')
+    except UnicodeEncodeError:
+        b = np.array([ip.encode('ascii', 'replace') for ip in ips], dtype='S16')
+    chars = b.view(np.uint8).reshape(len(b), 16)
+    digits = chars - np.uint8(48)
+    is_digit, is_dot = digits < 10, chars == 46
+    # a 16th character means the address is too long
+    valid = (is_digit | is_dot | (chars == 0)).all(axis=1) & (chars[:, 15] == 0)
+    seg = np.cumsum(is_dot, axis=1)
+    valid &= seg[:, -1] == 3
+    seg = np.minimum(seg, 3) + 4 * np.arange(len(b))[:, None]
+    ndigits = np.bincount(seg[is_digit], minlength=4 * len(b)).reshape(len(b), 4)
+    valid &= ((ndigits >= 1) & (ndigits <= 3)).all(axis=1)
+    # octets with a leading zero ('01') are rejected, as by ipaddress
+    first = is_digit & np.concatenate([np.ones((len(b), 1), dtype=bool), is_dot[:, :-1]], axis=1)
+    valid &= ~(first & (chars == 48) & (ndigits.ravel()[seg] > 1)).any(axis=1)
+    # the exponent of a digit is the count of digits after it in its octet
+    exponent = np.cumsum(ndigits, axis=1).ravel()[seg] - np.cumsum(is_digit, axis=1)
+    weights = np.where(is_digit, digits * 10 ** np.clip(exponent, 0, 2), 0)
+    octets = np.bincount(seg.ravel(), weights=weights.ravel(), minlength=4 * len(b)).reshape(len(b), 4)
+    octets = octets.astype(np.int64)
+    valid &= (octets <= 255).all(axis=1)
+    keys = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+    return np.where(valid, keys, 0).astype(np.uint32), valid
+
+
+def get_ip_table(ip_utils_cls, rebuild=False):
+    """Returns the table of an IpUtilsFile subclass, memory-mapped from cache or built and persisted first."""
+    key = f'{ip_utils_cls._db_fn}_{ip_utils_cls._version}'
+
+    def load():
+        if key in _tables and not rebuild:
+            return _tables[key]
+        folder = ip_table_folder.joinpath(key)
+        if folder.joinpath('ip_table.json').exists() and not rebuild:
+            table = IpTable.load(folder)
+        else:
+            table = IpTable.build(ip_utils_cls)
+            table.save(folder)
+        _tables[key] = table
+        return table
+
+    if key not in _tables or rebuild:
+        return single_flight(('ip_table', key), load)
+    return _tables[key]
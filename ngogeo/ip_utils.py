@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os, os.path
+import abc
+import functools
+import threading
 import geoip2.database
+import maxminddb
 import ipaddress
+import pandas as pd
+from multiprocessing import Pool
 
 from ngoschema.loaders import static_module_loader
 
@@ -10,28 +16,140 @@ from ngogeo import settings as geo_settings
 
 geolite2_folder = static_module_loader.subfolder('ngogeo').joinpath(geo_settings.GEOLITE2_STATIC_FOLDER)
 
+READER_MODES = {
+    'auto': maxminddb.MODE_AUTO,
+    'mmap': maxminddb.MODE_MMAP,
+    'memory': maxminddb.MODE_MEMORY,
+    'file': maxminddb.MODE_FILE,
+}
 
-class IpUtilsFile:
+
+class IpUtilsFile(abc.ABC):
     _version = geo_settings.GEOLITE2_VERSION
     _db_fn = None
+    _fields = ()
+
+    def __init__(self, mode=None, cache_size=None):
+        self._mode = mode or geo_settings.GEOLITE2_READER_MODE
+        # raw records are read with maxminddb, the geoip2 reader building models is only opened if used
+        self._db = maxminddb.open_database(str(self.db_path()), mode=READER_MODES[self._mode])
+        self._models = None
+        self._models_lock = threading.Lock()
+        cache_size = geo_settings.IP_CACHE_SIZE if cache_size is None else cache_size
+        self._cached_record = functools.lru_cache(maxsize=cache_size)(self._record)
+
+    @classmethod
+    def db_path(cls):
+        fn = geolite2_folder.joinpath(f'{cls._db_fn}_{cls._version}', f'{cls._db_fn}.mmdb')
+        return fn.resolve()
 
-    def __init__(self):
-        fn = geolite2_folder.joinpath(f'{self._db_fn}_{self._version}', f'{self._db_fn}.mmdb')
-        self._reader = geoip2.database.Reader(str(fn.resolve()))
+    def __enter__(self):
+        return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self._reader.close()
+        self.close()
+
+    def close(self):
+        self._db.close()
+        if self._models is not None:
+            self._models.close()
+
+    @property
+    def _reader(self):
+        # geoip2 reader, for country() and city() models
+        with self._models_lock:
+            if self._models is None:
+                self._models = geoip2.database.Reader(str(self.db_path()), mode=READER_MODES[self._mode])
+        return self._models
+
+    def _raw(self, ip):
+        try:
+            return self._db.get(ip)
+        except ValueError:
+            return None
+
+    def _record(self, ip):
+        r = self._raw(ip)
+        return self._parse(r) if r else None
+
+    @staticmethod
+    @abc.abstractmethod
+    def _parse(r):
+        """Returns the tuple of _fields of a raw maxminddb record."""
+
+    def record(self, ip):
+        """Returns the record of an ip (tuple of _fields), None if not found. Records are kept in a LRU cache."""
+        return self._cached_record(ip)
+
+    def cache_info(self):
+        return self._cached_record.cache_info()
+
+    def lookup_batch(self, ips, processes=None, chunk_size=10000):
+        """
+        Locates a series/array of ips and returns a dataframe with the columns of _fields, indexed as the input.
+        Repeated ips are looked up once, in `processes` worker processes if given.
+        """
+        ips = ips if isinstance(ips, pd.Series) else pd.Series(ips)
+        codes, uniques = pd.factorize(ips)
+        uniques = [str(ip) for ip in uniques]
+        if processes and processes > 1 and len(uniques) > chunk_size:
+            chunks = [uniques[i:i + chunk_size] for i in range(0, len(uniques), chunk_size)]
+            with Pool(processes, initializer=_init_worker, initargs=(self.__class__, self._mode)) as pool:
+                records = [r for rs in pool.imap(_worker_records, chunks) for r in rs]
+        else:
+            records = [self.record(ip) for ip in uniques]
+        # last row stands for missing ips (factorize code -1)
+        empty = (None, ) * len(self._fields)
+        table = pd.DataFrame.from_records([r or empty for r in records] + [empty], columns=list(self._fields))
+        for c in table.columns:
+            if c.endswith('geonameid'):
+                table[c] = table[c].astype(pd.Int64Dtype())
+        res = table.iloc[codes].set_index(ips.index)
+        res.insert(0, 'ip', ips)
+        return res
 
 
 class IpUtilsCountry(IpUtilsFile):
     _db_fn = 'GeoLite2-Country'
+    _fields = ('continent_code', 'country_code', 'country_geonameid')
 
     def country(self, ip):
         return self._reader.country(ip)
 
+    @staticmethod
+    def _parse(r):
+        country = r.get('country') or r.get('registered_country') or {}
+        return (r.get('continent', {}).get('code'), country.get('iso_code'), country.get('geoname_id'))
+
 
 class IpUtilsCity(IpUtilsCountry):
     _db_fn = 'GeoLite2-City'
+    _fields = IpUtilsCountry._fields + ('subdivision1_code', 'subdivision1_geonameid',
+                                        'subdivision2_code', 'subdivision2_geonameid',
+                                        'city_name', 'city_geonameid', 'postal_code', 'latitude', 'longitude')
 
     def city(self, ip):
         return self._reader.city(ip)
+
+    @staticmethod
+    def _parse(r):
+        subdivisions = r.get('subdivisions', []) + [{}, {}]
+        city = r.get('city', {})
+        location = r.get('location', {})
+        return IpUtilsCountry._parse(r) + (
+            subdivisions[0].get('iso_code'), subdivisions[0].get('geoname_id'),
+            subdivisions[1].get('iso_code'), subdivisions[1].get('geoname_id'),
+            city.get('names', {}).get('en'), city.get('geoname_id'),
+            r.get('postal', {}).get('code'), location.get('latitude'), location.get('longitude'))
+
+
+_worker = None
+
+
+def _init_worker(cls, mode):
+    global _worker
+    _worker = cls(mode=mode)
+
+
+def _worker_records(ips):
+    return [_worker.record(ip) for ip in ips]
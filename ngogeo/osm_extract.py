@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Offline POI search in a local OpenStreetMap extract (.osm or .osm.pbf).
+
+The extract is ingested once in a sqlite database holding the tagged nodes (and way centroids) with an index on
+tag key/value and a R*Tree spatial index, so that searches do not depend on the Overpass API.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from ngoschema.loaders import static_module_loader
+from ngogeo import settings as geo_settings
+from .overpass import parse_bbox, element_type
+
+osm_folder = static_module_loader.subfolder('ngogeo').joinpath(geo_settings.CACHE_STATIC_FOLDER, 'osm')
+
+BATCH_SIZE = 10000
+
+
+class OsmExtractStore(object):
+
+    def __init__(self, path=None):
+        if path is None:
+            osm_folder.mkdir(parents=True, exist_ok=True)
+            path = osm_folder.joinpath('osm_extract.sqlite')
+        self.path = str(path)
+        self._local = threading.local()
+        with self._connect() as cx:
+            cx.execute('CREATE TABLE IF NOT EXISTS pois ('
+                       'rowid INTEGER PRIMARY KEY, type TEXT, id INTEGER, lon REAL, lat REAL, tags TEXT)')
+            cx.execute('CREATE UNIQUE INDEX IF NOT EXISTS pois_id ON pois (type, id)')
+            cx.execute('CREATE TABLE IF NOT EXISTS tags (poi INTEGER, key TEXT, value TEXT)')
+            cx.execute('CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value, poi)')
+            cx.execute('CREATE INDEX IF NOT EXISTS tags_poi ON tags (poi)')
+            cx.execute('CREATE VIRTUAL TABLE IF NOT EXISTS pois_rtree USING rtree(poi, minx, maxx, miny, maxy)')
+
+    def _connect(self):
+        cx = getattr(self._local, 'cx', None)
+        if cx is None:
+            cx = self._local.cx = sqlite3.connect(self.path, timeout=30)
+        return cx
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM pois').fetchone()[0]
+
+    def _delete(self, cx, batch):
+        # elements ingested again replace their row, tags and box
+        ids = {}
+        for etype, eid, *_ in batch:
+            ids.setdefault(etype, []).append(eid)
+        rowids = []
+        for etype, eids in ids.items():
+            for i in range(0, len(eids), 900):
+                chunk = eids[i:i + 900]
+                sql = f'SELECT rowid FROM pois WHERE type = ? AND id IN ({", ".join("?" * len(chunk))})'
+                rowids += cx.execute(sql, [etype] + chunk).fetchall()
+        for table in ('tags', 'pois_rtree'):
+            cx.executemany(f'DELETE FROM {table} WHERE poi = ?', rowids)
+        cx.executemany('DELETE FROM pois WHERE rowid = ?', rowids)
+
+    def _insert(self, cx, batch):
+        batch = list({(el[0], el[1]): el for el in batch}.values())
+        self._delete(cx, batch)
+        rowid = cx.execute('SELECT COALESCE(MAX(rowid), 0) FROM pois').fetchone()[0]
+        pois, tags, boxes = [], [], []
+        for etype, eid, lon, lat, etags in batch:
+            rowid += 1
+            pois.append((rowid, etype, eid, lon, lat, json.dumps(etags)))
+            tags.extend((rowid, k, v) for k, v in etags.items())
+            boxes.append((rowid, lon, lon, lat, lat))
+        cx.executemany('INSERT INTO pois VALUES (?, ?, ?, ?, ?, ?)', pois)
+        cx.executemany('INSERT INTO tags VALUES (?, ?, ?)', tags)
+        cx.executemany('INSERT INTO pois_rtree VALUES (?, ?, ?, ?, ?)', boxes)
+
+    def ingest(self, filename, keys=None, with_ways=True):
+        """Ingests the tagged elements of an extract, optionally only those having one of the tag `keys`."""
+        filename = str(filename)
+        elements = _read_pbf(filename, with_ways) if filename.endswith('.pbf') else _read_osm(filename, with_ways)
+        keys = set(keys) if keys else None
+        count = 0
+        cx = self._connect()
+        with cx:
+            batch = []
+            for element in elements:
+                if keys and not keys.intersection(element[4]):
+                    continue
+                batch.append(element)
+                if len(batch) >= BATCH_SIZE:
+                    self._insert(cx, batch)
+                    count += len(batch)
+                    batch = []
+            self._insert(cx, batch)
+            count += len(batch)
+        return count
+
+    def query(self, bbox, element='node', crs=None, tag_columns=None, **kwargs):
+        """
+        Returns the elements (a type or a list of types) matching tags `kwargs` in a 'south, west, north, east'
+        bbox, with the columns of the overpass json results of _search_elements.
+        """
+        s, w, n, e = parse_bbox(bbox)
+        joins, params = '', []
+        for i, (k, v) in enumerate(kwargs.items()):
+            joins += f' JOIN tags t{i} ON t{i}.poi = p.rowid AND t{i}.key = ? AND t{i}.value = ?'
+            params += [k, str(v)]
+        sql = ('SELECT p.type, p.id, p.lon, p.lat, p.tags FROM pois_rtree r JOIN pois p ON p.rowid = r.poi' + joins +
+               ' WHERE r.minx >= ? AND r.maxx <= ? AND r.miny >= ? AND r.maxy <= ?')
+        params += [w, e, s, n]
+        if element:
+            etypes = [element_type(el) for el in ([element] if isinstance(element, str) else element)]
+            sql += f' AND p.type IN ({", ".join("?" * len(etypes))})'
+            params += etypes
+        rows = self._connect().execute(sql, params).fetchall()
+        lons = np.array([r[2] for r in rows], dtype=float)
+        lats = np.array([r[3] for r in rows], dtype=float)
+        tags = [json.loads(r[4]) for r in rows]
+        data = dict(ids=np.array([r[1] for r in rows], dtype=np.int64),
+                    type=pd.Categorical([r[0] for r in rows], categories=['node', 'way', 'relation']),
+                    tags=tags, longitude=lons, latitude=lats)
+        for k in tag_columns or []:
+            data[k] = [t.get(k) for t in tags]
+        df = gpd.GeoDataFrame(data, geometry=gpd.points_from_xy(lons, lats), crs=geo_settings.WSG84_CRS)
+        return df if crs is None or df.crs.is_exact_same(crs) else df.to_crs(crs)
+
+
+def _read_osm(filename, with_ways=True):
+    """Streams (type, id, lon, lat, tags) of tagged nodes and way centroids from an .osm xml file."""
+    coords = {}
+    for _, el in ET.iterparse(filename, events=('end',)):
+        if el.tag == 'node':
+            eid, lon, lat = int(el.get('id')), float(el.get('lon')), float(el.get('lat'))
+            if with_ways:
+                coords[eid] = (lon, lat)
+            tags = {t.get('k'): t.get('v') for t in el.iter('tag')}
+            if tags:
+                yield 'node', eid, lon, lat, tags
+            el.clear()
+        elif el.tag == 'way':
+            tags = {t.get('k'): t.get('v') for t in el.iter('tag')}
+            pts = [coords[r] for r in (int(nd.get('ref')) for nd in el.iter('nd')) if r in coords]
+            if tags and pts and with_ways:
+                yield 'way', int(el.get('id')), sum(p[0] for p in pts) / len(pts), sum(p[1] for p in pts) / len(pts), tags
+            el.clear()
+        elif el.tag == 'relation':
+            el.clear()
+
+
+def _read_pbf(filename, with_ways=True):
+    """Streams (type, id, lon, lat, tags) of tagged nodes and way centroids from an .osm.pbf file (needs osmium)."""
+    try:
+        import osmium
+        osmium.FileProcessor
+    except (ImportError, AttributeError):
+        raise ImportError('reading .osm.pbf extracts requires pyosmium>=3.7 (pip install osmium)')
+    processor = osmium.FileProcessor(filename)
+    if with_ways:
+        processor = processor.with_locations()
+    for obj in processor:
+        if not len(obj.tags):
+            continue
+        if obj.is_node():
+            yield 'node', obj.id, obj.location.lon, obj.location.lat, {t.k: t.v for t in obj.tags}
+        elif with_ways and obj.is_way():
+            pts = [(nd.lon, nd.lat) for nd in obj.nodes if nd.location.valid()]
+            if pts:
+                yield ('way', obj.id, sum(p[0] for p in pts) / len(pts), sum(p[1] for p in pts) / len(pts),
+                       {t.k: t.v for t in obj.tags})
+
+
+_store = None
+
+
+def get_osm_extract_store():
+    """Returns the store configured by setting OSM_EXTRACT_DB, or None."""
+    global _store
+    if _store is None and geo_settings.OSM_EXTRACT_DB:
+        _store = OsmExtractStore(geo_settings.OSM_EXTRACT_DB)
+    return _store
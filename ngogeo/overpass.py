@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Access to the Overpass API with a persistent response cache.
+
+Responses are stored zlib-compressed in a sqlite database so that the cache is shared by all the processes of a
+host, expired after a TTL and evicted least recently used first when the cache exceeds its maximum size.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+import zlib
+import requests
+
+from ngoschema.loaders import static_module_loader
+from ngogeo import settings as geo_settings
+
+overpass_folder = static_module_loader.subfolder('ngogeo').joinpath(geo_settings.CACHE_STATIC_FOLDER, 'overpass')
+
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+
+class OverpassCacheMiss(LookupError):
+    pass
+
+
+class OverpassCache(object):
+
+    def __init__(self, path=None, ttl=None, max_size=None):
+        if path is None:
+            overpass_folder.mkdir(parents=True, exist_ok=True)
+            path = overpass_folder.joinpath('overpass.sqlite')
+        self.path = str(path)
+        self.ttl = geo_settings.OVERPASS_CACHE_TTL if ttl is None else ttl
+        self.max_size = geo_settings.OVERPASS_CACHE_MAX_SIZE if max_size is None else max_size
+        self.hits = self.misses = self.stores = self.evictions = 0
+        self._local = threading.local()
+        with self._connect() as cx:
+            cx.execute('CREATE TABLE IF NOT EXISTS responses ('
+                       'key TEXT PRIMARY KEY, data BLOB, size INTEGER, created REAL, accessed REAL)')
+            cx.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            cx.execute('CREATE INDEX IF NOT EXISTS responses_created ON responses (created)')
+
+    def _connect(self):
+        cx = getattr(self._local, 'cx', None)
+        if cx is None:
+            cx = self._local.cx = sqlite3.connect(self.path, timeout=30)
+            cx.execute('PRAGMA journal_mode=WAL')
+        return cx
+
+    @staticmethod
+    def make_key(element, filters, bbox, output='xml'):
+        filters = sorted((str(k), str(v)) for k, v in dict(filters or {}).items())
+        bbox = ','.join(f'{float(c):.5f}' for c in str(bbox).split(',')) if bbox else ''
+        raw = json.dumps([element, filters, bbox, output])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key, allow_expired=False):
+        now = time.time()
+        with self._connect() as cx:
+            row = cx.execute('SELECT data, created FROM responses WHERE key=?', (key,)).fetchone()
+            if row is None or (not allow_expired and self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            cx.execute('UPDATE responses SET accessed=? WHERE key=?', (now, key))
+        self.hits += 1
+        return zlib.decompress(row[0])
+
+    def set(self, key, data):
+        now = time.time()
+        blob = zlib.compress(data, 6)
+        with self._connect() as cx:
+            cx.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, blob, len(blob), now, now))
+        self.stores += 1
+        self.evict()
+
+    def evict(self):
+        """Removes expired entries, then least recently used ones until the cache fits in max_size."""
+        with self._connect() as cx:
+            if self.ttl:
+                self.evictions += cx.execute('DELETE FROM responses WHERE created < ?',
+                                             (time.time() - self.ttl,)).rowcount
+            if self.max_size:
+                total = cx.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+                if total <= self.max_size:
+                    return
+                # least recently used keys are read until enough space is freed, then deleted at once
+                keys = []
+                for key, size in cx.execute('SELECT key, size FROM responses ORDER BY accessed'):
+                    if total <= self.max_size:
+                        break
+                    keys.append((key,))
+                    total -= size
+                cx.executemany('DELETE FROM responses WHERE key=?', keys)
+                self.evictions += len(keys)
+
+    def clear(self):
+        with self._connect() as cx:
+            cx.execute('DELETE FROM responses')
+
+    def stats(self):
+        with self._connect() as cx:
+            count, size = cx.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_ratio=self.hits / lookups if lookups else None,
+                    stores=self.stores, evictions=self.evictions, count=count, size=size)
+
+
+_cache = None
+
+
+def get_overpass_cache():
+    global _cache
+    if _cache is None and geo_settings.OVERPASS_CACHE:
+        _cache = OverpassCache()
+    return _cache
+
+
+def overpass_fetch(query, url=None, timeout=None, max_retries=None, backoff=None):
+    """Posts a query, retrying with exponential backoff when the server is busy or unreachable."""
+    max_retries = geo_settings.OVERPASS_MAX_RETRIES if max_retries is None else max_retries
+    backoff = geo_settings.OVERPASS_RETRY_BACKOFF if backoff is None else backoff
+    for attempt in range(max_retries + 1):
+        try:
+            r = requests.post(url or geo_settings.OVERPASS_URL, data={'data': query},
+                              timeout=timeout or geo_settings.OVERPASS_TIMEOUT)
+            r.raise_for_status()
+            return r.content
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as er:
+            response = getattr(er, 'response', None)
+            if attempt == max_retries or (response is not None and response.status_code not in RETRY_STATUS_CODES):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def overpass_query(query, key=None, cache=None, cache_only=None, url=None):
+    """Returns the raw response of an overpass query, from the cache if available."""
+    cache = get_overpass_cache() if cache is None else cache
+    cache_only = geo_settings.OVERPASS_CACHE_ONLY if cache_only is None else cache_only
+    if cache and key:
+        data = cache.get(key, allow_expired=cache_only)
+        if data is not None:
+            return data
+    if cache_only:
+        raise OverpassCacheMiss(f'overpass query not in cache: {query}')
+    data = overpass_fetch(query, url=url)
+    if cache and key:
+        cache.set(key, data)
+    return data
+
+
+def element_type(element):
+    """Normalizes element names ('ways' -> 'way') to overpass statements."""
+    return {'nodes': 'node', 'ways': 'way', 'relations': 'relation', 'areas': 'way'}.get(element, element)
+
+
+def parse_bbox(bbox):
+    """Returns (south, west, north, east) from an overpass bbox string or sequence."""
+    if isinstance(bbox, str):
+        bbox = bbox.split(',')
+    return tuple(float(c) for c in bbox)
+
+
+def format_bbox(bbox):
+    s, w, n, e = bbox
+    return f'{s:.3f}, {w:.3f}, {n:.3f}, {e:.3f}'
+
+
+def iter_json_elements(raw):
+    """Iterates the elements of an overpass json response, streamed with ijson when available."""
+    try:
+        import ijson
+    except ImportError:
+        yield from json.loads(raw).get('elements', [])
+        return
+    from io import BytesIO
+    yield from ijson.items(BytesIO(raw), 'elements.item', use_float=True)
+
+
+def bbox_tiles(bbox, tile_size=None):
+    """Splits a bbox in the tiles of a fixed grid of tile_size degrees covering it, so tiles are reusable keys."""
+    tile_size = tile_size or geo_settings.OVERPASS_TILE_SIZE
+    s, w, n, e = parse_bbox(bbox)
+    tiles = []
+    for i in range(math.floor(s / tile_size), math.ceil(n / tile_size)):
+        for j in range(math.floor(w / tile_size), math.ceil(e / tile_size)):
+            tiles.append(format_bbox((i * tile_size, j * tile_size, (i + 1) * tile_size, (j + 1) * tile_size)))
+    return tiles or [format_bbox((s, w, n, e))]
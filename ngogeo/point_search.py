@@ -3,10 +3,14 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import difflib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
 from pprint import pprint
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyproj
 import shapely
 import shapely.geometry
 from shapely.geometry import Point, Polygon, MultiPoint
@@ -14,29 +18,96 @@ import overpy
 
 from ngoschema.protocols import with_metaclass, SchemaMetaclass, ObjectProtocol
 from ngogeo import settings as geo_settings
+from .distances import haversine_km, lonlat_arrays, EARTH_RADIUS_KM
+from .overpass import OverpassCache, overpass_query, bbox_tiles, parse_bbox, element_type, iter_json_elements
+from .osm_extract import get_osm_extract_store
 
 api = overpy.Overpass()
 
 DEFAULT_RADIUS_SEARCH = geo_settings.DEFAULT_RADIUS_SEARCH
 
 
+@functools.lru_cache(maxsize=None)
+def _get_crs(crs):
+    return pyproj.CRS.from_user_input(crs)
+
+
+@functools.lru_cache(maxsize=None)
+def _is_same_crs(crs1, crs2):
+    return _get_crs(crs1).is_exact_same(_get_crs(crs2))
+
+
+@functools.lru_cache(maxsize=128)
+def _get_transformer(src_crs, dest_crs):
+    return pyproj.Transformer.from_crs(_get_crs(src_crs), _get_crs(dest_crs), always_xy=True)
+
+
+def _transform_xy(x, y, src_crs, dest_crs):
+    """Transforms raw coordinates (scalars or arrays) with a cached transformer."""
+    if src_crs is None or dest_crs is None or _is_same_crs(src_crs, dest_crs):
+        return x, y
+    return _get_transformer(src_crs, dest_crs).transform(x, y)
+
+
 def _make_point_to_crs(point, point_crs=None, dest_crs=None):
+    """
+    Returns a point (or (x, y) tuple) of point_crs (WSG84 by default) in dest_crs. Shapely geometries do not carry
+    a crs: callers passing the result on give dest_crs as its point_crs.
+    """
     if isinstance(point, gpd.GeoDataFrame):
-        point_gdf = point
+        point_crs = point.crs
+        point = point.geometry.iloc[0]
+    point_crs = point_crs or geo_settings.WSG84_CRS
+    dest_crs = dest_crs or point_crs
+    if isinstance(point, Point):
+        if _is_same_crs(point_crs, dest_crs):
+            return point
+        x, y = point.x, point.y
     else:
-        point_gdf = gpd.GeoDataFrame(geometry=[point] if isinstance(point, Point) else [Point(*point)], crs=point_crs)
-    dest_crs = dest_crs or point_gdf.crs
-    if not point_gdf.crs.is_exact_same(dest_crs):
-        point_gdf = point_gdf.to_crs(dest_crs)
-    res = point_gdf.geometry[0]
-    res._crs = dest_crs
-    return res
+        x, y = point
+    return Point(*_transform_xy(x, y, point_crs, dest_crs))
 
 
-def _search_name(df, name, regex=False, **kwargs):
-    """Returns the most likely result as a pandas Series"""
-    # Make a copy of the dataset to preserve the original
+def _radius_to_crs_units(radius, crs):
+    """Converts a radius in meters to degrees (along a meridian) if crs is geographic."""
+    if crs is not None and _get_crs(crs).is_geographic:
+        return float(np.degrees(radius / (EARTH_RADIUS_KM * 1000.)))
+    return radius
+
+
+def _degree_bbox(lon, lat, radius):
+    """Returns (minx, miny, maxx, maxy) in degrees enclosing a radius in meters around a WSG84 point."""
+    dlat = np.degrees(radius / (EARTH_RADIUS_KM * 1000.))
+    coslat = np.cos(np.radians(min(abs(lat) + dlat, 90.)))
+    dlon = 180. if coslat < 1e-12 else min(dlat / coslat, 180.)
+    return lon - dlon, lat - dlat, lon + dlon, lat + dlat
+
+
+def _make_points_to_crs(coords, point_crs=None, dest_crs=None, as_points=False):
+    """Batch variant of _make_point_to_crs for a (N, 2) array of coordinates or a (xs, ys) tuple of arrays."""
+    if isinstance(coords, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        point_crs = point_crs or coords.crs
+        xs, ys = coords.geometry.x.to_numpy(), coords.geometry.y.to_numpy()
+    elif isinstance(coords, tuple):
+        xs, ys = (np.asarray(c, dtype=float) for c in coords)
+    else:
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        xs, ys = coords[:, 0], coords[:, 1]
+    xs, ys = _transform_xy(xs, ys, point_crs, dest_crs or point_crs)
+    return shapely.points(xs, ys) if as_points else (np.asarray(xs), np.asarray(ys))
+
+
+def _top_k(values, k=None):
+    """Positions of the k smallest values in increasing order, using partial selection when k is given."""
+    values = np.asarray(values)
+    if k is None or k >= len(values):
+        return np.argsort(values, kind='stable')
+    idx = np.argpartition(values, k)[:k]
+    return idx[np.argsort(values[idx], kind='stable')]
+
 
+def _search_name(df, name, regex=False, limit=None, **kwargs):
+    """Returns the most likely result as a pandas Series"""
     # Filter data by string queries before searching
     filters = {**kwargs}
     for key, val in filters.items():
@@ -46,63 +117,184 @@ def _search_name(df, name, regex=False, **kwargs):
             ]
 
     # Use difflib to find matches
-    diffs = difflib.get_close_matches(name, df['name'].tolist(), n=1, cutoff=0)
-    matches = df[df['name'] == diffs[0]]
+    diffs = difflib.get_close_matches(name, df['name'].dropna().unique().tolist(), n=1, cutoff=0)
+    if not diffs:
+        return df.iloc[:0]
+    names = df['name'].to_numpy()
+    positions = np.flatnonzero(names == diffs[0])
+
+    # certainty is only computed for the selected rows, best first
+    certainty = np.array([difflib.SequenceMatcher(None, n, name).ratio() for n in names[positions]])
+    order = _top_k(-certainty, limit)
+    matches = df.iloc[positions[order]]
+    matches['certainty'] = certainty[order]
+    return matches
 
-    def certainty(result_name):
-        return difflib.SequenceMatcher(None, result_name, name).ratio()
 
-    matches['certainty'] = matches['name'].apply(certainty)
-    return matches.sort_values(by=['certainty'], ascending=False)
+def _search_radius_wsg84(gdf, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None):
+    """Radius search on longitude/latitude, without reprojecting the dataset."""
+    point_crs = point_crs or geo_settings.WSG84_CRS
+    p = _make_point_to_crs(point, point_crs=point_crs, dest_crs=geo_settings.WSG84_CRS)
+    lons, lats = lonlat_arrays(gdf)
+    minx, miny, maxx, maxy = _degree_bbox(p.x, p.y, radius)
+    # modulo handles boxes crossing the antimeridian
+    mask = (lats >= miny) & (lats <= maxy) & (np.mod(lons - minx, 360.) <= maxx - minx)
+    dist = haversine_km(p.x, p.y, lons[mask], lats[mask]) * 1000.
+    inside = dist <= radius
+    return gdf[mask][inside], dist[inside]
 
 
-def _search_radius(gdf, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, **kwargs):
+def _search_radius_candidates(gdf, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, geographic=None,
+                              **kwargs):
+    """Returns the unsorted rows within radius and their distances in meters."""
     # Filter data by string queries before searching
     filters = {**kwargs}
     for key, val in filters.items():
         gdf = gdf[
             gdf[key].str.contains(val, case=False, regex=regex, na=False)
         ]
+    if geographic or (geographic is None and (gdf.crs is None or _get_crs(gdf.crs).is_geographic)):
+        return _search_radius_wsg84(gdf, point, radius=radius, point_crs=point_crs)
     # https://gis.stackexchange.com/questions/349637/given-list-of-points-lat-long-how-to-find-all-points-within-radius-of-a-give
-    if isinstance(point, gpd.GeoDataFrame):
-        point_gdf = point
-    else:
-        point_crs = point_crs or geo_settings.EPSG4326_CRS
-        point_gdf = gpd.GeoDataFrame(geometry=[point] if isinstance(point, Point) else [Point(*point)], crs=point_crs)
-    if not point_gdf.crs.is_exact_same(gdf.crs):
-        point_gdf = point_gdf.to_crs(gdf.crs)
-    x = point_gdf.buffer(radius).convex_hull.unary_union
+    point_crs = point_crs or geo_settings.EPSG4326_CRS
+    p = _make_point_to_crs(point, point_crs=point_crs, dest_crs=gdf.crs)
+    x = p.buffer(radius).convex_hull
     ret = gdf[gdf["geometry"].within(x)]
-    ret['distance'] = ret.geometry.distance(point_gdf.geometry[0])
-    return ret.sort_values(by=['distance'])
+    # great-circle distance in meters, independent of the projection of the dataset
+    lon, lat = _transform_xy(p.x, p.y, gdf.crs, geo_settings.WSG84_CRS)
+    return ret, haversine_km(lon, lat, *lonlat_arrays(ret)) * 1000.
+
+
+def _search_radius(gdf, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, geographic=None, limit=None,
+                   **kwargs):
+    ret, dist = _search_radius_candidates(gdf, point, radius=radius, point_crs=point_crs, regex=regex,
+                                          geographic=geographic, **kwargs)
+    order = _top_k(dist, limit)
+    ret = ret.iloc[order]
+    ret['distance'] = dist[order]
+    return ret
+
+
+def _iter_search_radius(gdf, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, geographic=None,
+                        chunk_size=16, **kwargs):
+    """Yields (distance, row) by increasing distance, ordering the candidates by growing chunks."""
+    ret, dist = _search_radius_candidates(gdf, point, radius=radius, point_crs=point_crs, regex=regex,
+                                          geographic=geographic, **kwargs)
+    remaining = np.arange(len(dist))
+    while len(remaining):
+        k = min(chunk_size, len(remaining))
+        if k < len(remaining):
+            part = np.argpartition(dist[remaining], k)
+            head, remaining = remaining[part[:k]], remaining[part[k:]]
+        else:
+            head, remaining = remaining, remaining[:0]
+        for i in head[np.argsort(dist[head], kind='stable')]:
+            yield dist[i], ret.iloc[i]
+        chunk_size *= 2
+
 
+def _elements_gdf(result, elements=('node', 'way', 'relation'), tag_columns=None):
+    """Builds the frame of the elements of a parsed overpass xml response, with the columns of _json_elements_gdf."""
+    types, found = [], []
+    for etype in map(element_type, elements):
+        for n in getattr(result, etype + 's'):
+            # ways and relations are located by their center
+            lon, lat = (n.lon, n.lat) if isinstance(n, overpy.Node) else (n.center_lon, n.center_lat)
+            if lon is not None and lat is not None:
+                types.append(etype)
+                found.append((n, lon, lat))
+    lons = np.array([lon for n, lon, lat in found], dtype=float)
+    lats = np.array([lat for n, lon, lat in found], dtype=float)
+    tags = [n.tags for n, lon, lat in found]
+    data = dict(ids=np.array([n.id for n, lon, lat in found], dtype=np.int64),
+                type=pd.Categorical(types, categories=['node', 'way', 'relation']), tags=tags,
+                attributes=[n.attributes for n, lon, lat in found], longitude=lons, latitude=lats)
+    for k in tag_columns or []:
+        data[k] = [t.get(k) for t in tags]
+    return gpd.GeoDataFrame(data, geometry=gpd.points_from_xy(lons, lats), crs=geo_settings.WSG84_CRS)
 
-def _search_elements(bbox, element='node', crs=None, **kwargs):
+
+def _json_elements_gdf(raw, geom=False, tag_columns=None):
+    """Builds coordinate arrays and tag columns while streaming the elements of an overpass json response."""
+    types, ids, lons, lats, tags, lines = [], [], [], [], [], {}
+    for el in iter_json_elements(raw):
+        if 'lon' in el:
+            lon, lat = el['lon'], el['lat']
+        elif 'center' in el:
+            lon, lat = el['center']['lon'], el['center']['lat']
+        elif 'bounds' in el:
+            b = el['bounds']
+            lon, lat = (b['minlon'] + b['maxlon']) / 2., (b['minlat'] + b['maxlat']) / 2.
+        else:
+            continue
+        if geom and el['type'] == 'way' and el.get('geometry'):
+            lines[len(ids)] = [(g['lon'], g['lat']) for g in el['geometry'] if g]
+        types.append(el['type'])
+        ids.append(el['id'])
+        lons.append(lon)
+        lats.append(lat)
+        tags.append(el.get('tags', {}))
+    lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+    geometry = np.asarray(gpd.points_from_xy(lons, lats), dtype=object)
+    if lines:
+        pos = np.fromiter(lines.keys(), dtype=np.int64, count=len(lines))
+        geometry[pos] = shapely.linestrings([lines[i] if len(lines[i]) > 1 else lines[i] * 2 for i in pos])
+    data = dict(ids=np.asarray(ids, dtype=np.int64), type=pd.Categorical(types, categories=['node', 'way', 'relation']),
+                tags=tags, longitude=lons, latitude=lats)
+    for k in tag_columns or []:
+        data[k] = [t.get(k) for t in tags]
+    return gpd.GeoDataFrame(data, geometry=geometry, crs=geo_settings.WSG84_CRS)
+
+
+def _search_elements(bbox, element='node', crs=None, cache=None, cache_only=None, tiled=None, tile_size=None,
+                     workers=None, url=None, store=None, output=None, geom=False, **kwargs):
+    """
+    Searches OSM elements with tags kwargs in bbox. element can be a list of types ('node', 'way', 'relation')
+    searched in a single query, geom returns way linestrings instead of their centers (json output only). tiled
+    (OVERPASS_TILED by default) splits bbox in tiles of tile_size degrees fetched concurrently.
+    """
     crs = crs or geo_settings.WSG84_CRS
-    attrs = ', '.join([f'"{k}"="{v}"' for k, v in kwargs.items()])
-    result = api.query(f"[out:xml];{element}[{attrs}]({bbox});out;")
-    elements = getattr(result, element + 's')
-    ids = [n.id for n in elements]
-    points = [Point(n.lon, n.lat) for n in elements]
-    tags = [n.tags for n in elements]
-    attributes = [n.attributes for n in elements]
-    df = gpd.GeoDataFrame(dict(ids=ids, tags=tags, attributes=attributes),
-                          geometry=points, crs=geo_settings.WSG84_CRS)
+    etypes = [element_type(e) for e in ([element] if isinstance(element, str) else element)]
+    # local osm extract (explicit or configured) replaces overpass
+    store = get_osm_extract_store() if store is None else store
+    if store is not None:
+        return store.query(bbox, element=etypes, crs=crs, tag_columns=list(kwargs) + ['name'], **kwargs)
+    tiled = geo_settings.OVERPASS_TILED if tiled is None else tiled
+    output = output or geo_settings.OVERPASS_OUTPUT
+    filters = ''.join([f'["{k}"="{v}"]' for k, v in kwargs.items()])
+    tag_columns = list(kwargs) + ['name']
+    out = 'geom' if geom and output == 'json' else 'center'
+
+    def fetch(tile):
+        statements = ''.join(f'{e}{filters}({tile});' for e in etypes)
+        query = f"[out:{output}][timeout:{geo_settings.OVERPASS_TIMEOUT}];({statements});out {out};"
+        raw = overpass_query(query, key=OverpassCache.make_key(etypes, kwargs, tile, output=f'{output}-{out}'),
+                             cache=cache, cache_only=cache_only, url=url)
+        if output == 'json':
+            return _json_elements_gdf(raw, geom=geom, tag_columns=tag_columns)
+        return _elements_gdf(api.parse_xml(raw), etypes, tag_columns=tag_columns)
+
+    if not tiled:
+        df = fetch(bbox)
+    else:
+        tiles = bbox_tiles(bbox, tile_size)
+        with ThreadPoolExecutor(max_workers=min(workers or geo_settings.OVERPASS_WORKERS, len(tiles))) as executor:
+            frames = list(executor.map(fetch, tiles))
+        df = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=geo_settings.WSG84_CRS)
+        # tiles share their edges and overflow the requested bbox
+        s, w, n, e = parse_bbox(bbox)
+        df = df.drop_duplicates(subset=['type', 'ids'] if 'type' in df else ['ids'])
+        df = df[df['longitude'].between(w, e) & df['latitude'].between(s, n)].reset_index(drop=True)
     return df if df.crs.is_exact_same(crs) else df.to_crs(crs)
 
 
 def _search_elements_radius(point, radius, point_crs=None, element='node', crs=None, **kwargs):
     wsg84_crs = geo_settings.WSG84_CRS
     crs = crs or wsg84_crs
-    if isinstance(point, gpd.GeoDataFrame):
-        point_gdf = point
-    else:
-        point_crs = point_crs or wsg84_crs
-        point_gdf = gpd.GeoDataFrame(geometry=[point] if isinstance(point, Point) else [Point(*point)], crs=point_crs)
-    if not point_gdf.crs.is_exact_same(wsg84_crs):
-        point_gdf = point_gdf.to_crs(wsg84_crs)
-    bbox = point_gdf.buffer(radius).envelope.to_crs(geo_settings.WSG84_CRS).bounds
-    bbox = f'{bbox.miny[0]:.3f}, {bbox.minx[0]:.3f}, {bbox.maxy[0]:.3f}, {bbox.maxx[0]:.3f}'
+    point_crs = point_crs or wsg84_crs
+    p = _make_point_to_crs(point, point_crs=point_crs, dest_crs=wsg84_crs)
+    minx, miny, maxx, maxy = _degree_bbox(p.x, p.y, radius)
+    bbox = f'{miny:.3f}, {minx:.3f}, {maxy:.3f}, {maxx:.3f}'
     return _search_elements(bbox, element=element, crs=crs, **kwargs)
 
 
@@ -37,10 +37,19 @@ DATA_FIELDS = [
 ]
 
 
-def load_postals_gdf(filename, unique=True, crs=None):
-    gdir = postal_folder.joinpath(filename)
-    gct = gdir.joinpath(filename + '.txt')
-    gcti = gct.with_name(filename + '-index.txt')
+def postals_files(filename):
+    """Paths of the postal codes of dump `filename` and of their index of unique postal codes, downloaded or not."""
+    gct = postal_folder.joinpath(filename, filename + '.txt')
+    return gct, gct.with_name(filename + '-index.txt')
+
+
+def download_postals(filename):
+    """
+    Downloads and extracts postal codes dump `filename` if not done yet, with its index of unique postal codes.
+    Returns the paths of the postal codes and of the index.
+    """
+    gct, gcti = postals_files(filename)
+    gdir = gct.parent
     if not gct.exists():
         url = geo_settings.POSTAL_DOWNLOAD_URL + filename + '.zip'
         r = requests.get(url)
@@ -69,7 +78,11 @@ def load_postals_gdf(filename, unique=True, crs=None):
             df_unique[key] = df_unique_cp_group[key].first()
         df_unique = df_unique.reset_index()[DATA_FIELDS]
         df_unique.to_csv(gcti, index=None)
+    return gct, gcti
 
+
+def load_postals_gdf(filename, unique=True, crs=None):
+    gct, gcti = download_postals(filename)
     df = pd.read_csv(gcti if unique else gct, dtype={"state_code": str, "county_code": str,
                                                      "community_code": str, "postal_code": str,
                                                      "longitude": float, "latitude": float})
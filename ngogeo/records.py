@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight views on the rows of a geonames/postals frame.
+
+A view only holds its frame and row position, fields are read from the frame on access and the full schema
+object (City, Geoname...) is only built when an attribute which is not a column is requested.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import pandas as pd
+
+
+def records(frame):
+    """Returns the rows of a frame as dicts without missing values, in a single pass."""
+    return [{k: v for k, v in r.items() if pd.isna(v) is not True} for r in frame.to_dict('records')]
+
+
+class RecordViews(object):
+    """Sequence of the views of all rows of a frame, materialized as `cls(**kwargs)` objects."""
+    __slots__ = ('frame', 'cls', 'kwargs')
+
+    def __init__(self, frame, cls, **kwargs):
+        self.frame = frame
+        self.cls = cls
+        self.kwargs = kwargs
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __getitem__(self, i):
+        n = len(self.frame)
+        if not -n <= i < n:
+            raise IndexError(i)
+        return RecordView(self, i % n)
+
+    def __iter__(self):
+        return (RecordView(self, i) for i in range(len(self.frame)))
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {len(self)} {self.cls.__name__}>'
+
+    def materialize(self):
+        """Builds the objects of all rows at once, with the bulk constructor of `cls`."""
+        return self.cls.from_frame(self.frame, **self.kwargs)
+
+
+class RecordView(object):
+    __slots__ = ('_views', '_pos', '_obj')
+
+    def __init__(self, views, pos):
+        self._views = views
+        self._pos = pos
+        self._obj = None
+
+    def __repr__(self):
+        return f'<{self._views.cls.__name__}View [{self.get("geonameid")}] {self.get("name")}>'
+
+    def __getitem__(self, key):
+        frame = self._views.frame
+        return frame.iat[self._pos, frame.columns.get_loc(key)]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self._views.frame.columns:
+            return self[name]
+        return getattr(self.materialize(), name)
+
+    def get(self, key, default=None):
+        return self[key] if key in self._views.frame.columns else default
+
+    @property
+    def row(self):
+        return self._views.frame.iloc[self._pos]
+
+    def materialize(self):
+        """Returns the full object of the row, built once."""
+        if self._obj is None:
+            views = self._views
+            self._obj = views.cls.from_frame(views.frame.iloc[[self._pos]], **views.kwargs)[0]
+        return self._obj
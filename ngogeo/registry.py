@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the territories of a world, indexed as they are created.
+
+Territories are indexed by kind ('continent', 'country', 'iso3', 'geonameid', 'admin') and key, so that keyed
+access does not scan or instantiate sibling territories.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+
+class TerritoryRegistry(object):
+
+    def __init__(self):
+        self._indexes = defaultdict(dict)
+        self.aliases = {}
+
+    def __repr__(self):
+        counts = ', '.join(f'{len(v)} {k}' for k, v in self._indexes.items())
+        return f'<{self.__class__.__name__} {counts}>'
+
+    def __len__(self):
+        return sum(len(v) for v in self._indexes.values())
+
+    def register(self, territory):
+        for kind, key in territory._registry_keys():
+            if key is not None:
+                self._indexes[kind][key] = territory
+
+    def get(self, kind, key):
+        return self._indexes[kind].get(key)
+
+    def values(self, kind):
+        return list(self._indexes[kind].values())
+
+    def territories(self):
+        """Returns the territories registered, each once."""
+        return list({id(t): t for index in self._indexes.values() for t in index.values()}.values())
+
+    def clear(self):
+        self._indexes.clear()
+        self.aliases.clear()
+
+
+def get_registry(root):
+    """Returns the registry of the territories under `root` (a World), held by the root so that it goes with it."""
+    registry = vars(root).get('_registry')
+    if registry is None:
+        # setdefault so that threads creating the registry concurrently share the first one
+        registry = vars(root).setdefault('_registry', TerritoryRegistry())
+    return registry
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Geocoding service as an ASGI application (served by `ngogeo serve`).
+
+Endpoints answer GET requests with JSON: /locate, /nearest, /radius, /name, /postal and /ip, plus /health and
+/metrics (latency and batch size histograms in the Prometheus text format). Concurrent single-item requests of the
+vectorized endpoints (locate, nearest, name, postal, ip) are coalesced into micro-batches run in one call.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+import numpy as np
+import pandas as pd
+
+from ngogeo import settings as geo_settings
+from .territories import get_world
+from .batch import BatchEngine, RESULT_COLUMNS
+from .point_search import _search_radius
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+RADIUS_COLUMNS = ('geonameid', 'name', 'admin1code', 'admin2code', 'admin3code', 'population', 'longitude',
+                  'latitude', 'distance')
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class Unavailable(RuntimeError):
+    pass
+
+
+class Histogram(object):
+    """Cumulative histogram of observations over fixed upper bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = np.zeros(len(self.buckets) + 1, dtype=np.int64)
+        self.sum = 0.
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.buckets, value)] += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket of quantile q (inf if beyond the last bucket, None if empty)."""
+        if not self.count:
+            return None
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+    def prometheus(self, name, labels):
+        lines = []
+        for le, n in zip([str(b) for b in self.buckets] + ['+Inf'], np.cumsum(self.counts)):
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {n}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class MicroBatcher(object):
+    """
+    Coalesces concurrent awaits of single items into calls of `fn(items) -> results` on an executor, a batch being
+    run once it has `max_batch` items or when its first item has waited `max_delay` seconds.
+    """
+
+    def __init__(self, fn, executor=None, max_batch=None, max_delay=None):
+        self.fn = fn
+        self.executor = executor
+        self.max_batch = max_batch or geo_settings.SERVICE_MAX_BATCH
+        self.max_delay = geo_settings.SERVICE_MAX_DELAY if max_delay is None else max_delay
+        self.sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self._pending = []
+        self._timer = None
+        # the loop only holds weak references to tasks, running batches are kept until done
+        self._tasks = set()
+
+    async def __call__(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Runs the pending items and waits for the running batches."""
+        self._flush()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _run_items(self, items):
+        results = []
+        for item in items:
+            try:
+                results.append(self.fn([item])[0])
+            except Exception as er:
+                results.append(er)
+        return results
+
+    async def _run(self, batch):
+        self.sizes.observe(len(batch))
+        loop = asyncio.get_running_loop()
+        items = [item for item, _ in batch]
+        try:
+            results = await loop.run_in_executor(self.executor, self.fn, items)
+        except Exception as er:
+            # the items of a failed batch are run again one by one, so that only the failing ones fail
+            results = [er] if len(items) == 1 else await loop.run_in_executor(self.executor, self._run_items, items)
+        for (_, future), res in zip(batch, results):
+            if future.done():  # cancelled by its client
+                continue
+            if isinstance(res, Exception):
+                future.set_exception(res)
+            else:
+                future.set_result(res)
+
+
+def _jsonable(v):
+    if isinstance(v, (np.integer, np.bool_)):
+        return v.item()
+    if isinstance(v, (float, np.floating)):
+        return None if np.isnan(v) else float(v)
+    if v is None or v is pd.NA or v is pd.NaT:
+        return None
+    return v
+
+
+def _records(frame, columns=None):
+    frame = frame[[c for c in columns if c in frame.columns]] if columns else frame
+    return [{k: _jsonable(v) for k, v in row.items()} for row in frame.to_dict('records')]
+
+
+def _param(params, name, type=str, default=BadRequest):
+    value = params.get(name)
+    if value in (None, ''):
+        if default is BadRequest:
+            raise BadRequest(f'missing parameter {name!r}.')
+        return default
+    try:
+        return type(value)
+    except ValueError:
+        raise BadRequest(f'invalid parameter {name}={value!r}.')
+
+
+class GeoService(object):
+    """ASGI application of the geocoding service."""
+    endpoints = ('locate', 'nearest', 'radius', 'name', 'postal', 'ip')
+
+    def __init__(self, countries=None, with_geonames=None, admin_grids=False, ip=False, max_batch=None,
+                 max_delay=None, threads=None):
+        """
+        Service preloading the datasets of `countries` (ISO2 codes, SERVICE_COUNTRIES by default) at startup, with
+        their admin1/admin2 grids to locate admin units if `admin_grids` and the ip table if `ip`. `with_geonames`
+        is set on the preloaded countries, other countries keep their defaults.
+        """
+        self.countries = list(geo_settings.SERVICE_COUNTRIES if countries is None else countries)
+        self.admin_grids = admin_grids
+        self.ip = ip
+        self.with_geonames = with_geonames
+        self.executor = ThreadPoolExecutor(threads or geo_settings.SERVICE_THREADS, thread_name_prefix='ngogeo')
+        self.engine = BatchEngine(workers=0)
+        self.batchers = {name: MicroBatcher(fn, self.executor, max_batch=max_batch, max_delay=max_delay)
+                         for name, fn in [('locate', self.locate_batch), ('reverse', self.reverse_batch),
+                                          ('geocode', self.geocode_batch), ('ip', self.ip_batch)]}
+        self.latencies = {name: Histogram(LATENCY_BUCKETS) for name in self.endpoints}
+        self._grids = {}
+        self.ready = False
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {len(self.countries)} countries preloaded>'
+
+    # batch functions, run on the executor
+
+    def preload(self):
+        """Loads the world, its country grid and the datasets and grids of the preloaded countries."""
+        world = get_world()
+        world.countries_gdf
+        if world.with_shapes:
+            world.country_grid()
+        for cc in self.countries:
+            country = world.get_country(cc)
+            if country is None:
+                raise ValueError(f'unknown country {cc!r}.')
+            # set once before serving, requests running on the executor threads only read the countries
+            if self.with_geonames is not None and country.with_geonames != self.with_geonames:
+                country.with_geonames = self.with_geonames
+            places = country.places_gdf()
+            if places is not None:
+                places.sindex
+                country.name_index()
+            country.city_postals()
+            if self.admin_grids:
+                self._grids[country.country_code] = [(level, country.admin_grid(level, bound_from_cities=True))
+                                                     for level in (1, 2)]
+        if self.ip:
+            self.ip_batch(['8.8.8.8'])
+        self.ready = True
+
+    def locate_batch(self, points):
+        """Country code (and admin keys of the countries with admin grids) of (lon, lat) points."""
+        lons, lats = np.array(points, dtype=float).reshape(-1, 2).T
+        world = get_world()
+        if world.with_shapes:
+            codes = world.country_grid().locate_labels(lons, lats)
+        else:
+            codes = [getattr(world.locate_country(p, use_grid=False), 'country_code', None) for p in points]
+        res = [{'country_code': cc} for cc in codes]
+        codes = pd.Series(codes)
+        for cc, rows in codes.groupby(codes, sort=False).indices.items():
+            for level, grid in self._grids.get(cc, []):
+                for i, key in zip(rows, grid.locate_labels(lons[rows], lats[rows])):
+                    res[i][f'admin{level}'] = key
+        return res
+
+    def _engine_batch(self, op, queries):
+        frame = pd.DataFrame(queries)
+        return _records(next(self.engine.run(op, [frame])), RESULT_COLUMNS)
+
+    def reverse_batch(self, queries):
+        """Nearest place of {'longitude', 'latitude'[, 'country']} queries."""
+        return self._engine_batch('reverse', queries)
+
+    def geocode_batch(self, queries):
+        """Places of {'country', 'postal_code' and/or 'name'} queries."""
+        return self._engine_batch('geocode', queries)
+
+    def ip_batch(self, ips):
+        res = get_world().locate_ips(ips, use_table=True)
+        if res is None:
+            raise Unavailable('no geolite2 database enabled.')
+        return _records(res.drop(columns='ip'))
+
+    def radius(self, lon, lat, radius, country_code=None, limit=None):
+        world = get_world()
+        country = world.get_country(country_code) if country_code else world.locate_country((lon, lat),
+                                                                                             use_grid=world.with_shapes)
+        if country is None:
+            return []
+        places = country.places_gdf()
+        return _records(_search_radius(places, (lon, lat), radius=radius, limit=limit), RADIUS_COLUMNS)
+
+    # endpoints
+
+    async def _locate(self, params):
+        return await self.batchers['locate']((_param(params, 'lon', float), _param(params, 'lat', float)))
+
+    async def _nearest(self, params):
+        return await self.batchers['reverse']({'longitude': _param(params, 'lon', float),
+                                               'latitude': _param(params, 'lat', float),
+                                               'country': _param(params, 'country', default=None)})
+
+    async def _radius(self, params):
+        args = (_param(params, 'lon', float), _param(params, 'lat', float),
+                _param(params, 'radius', float, geo_settings.DEFAULT_RADIUS_SEARCH),
+                _param(params, 'country', default=None), _param(params, 'limit', int, 10))
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.radius, *args)
+
+    async def _name(self, params):
+        return await self.batchers['geocode']({'country': _param(params, 'country'), 'name': _param(params, 'q'),
+                                               'postal_code': _param(params, 'postal', default=None)})
+
+    async def _postal(self, params):
+        return await self.batchers['geocode']({'country': _param(params, 'country'),
+                                               'postal_code': _param(params, 'code')})
+
+    async def _ip(self, params):
+        return await self.batchers['ip'](_param(params, 'ip'))
+
+    def metrics(self):
+        lines = ['# TYPE ngogeo_request_seconds histogram']
+        for name, histogram in self.latencies.items():
+            lines += histogram.prometheus('ngogeo_request_seconds', f'endpoint="{name}"')
+        lines.append('# TYPE ngogeo_batch_size histogram')
+        for name, batcher in self.batchers.items():
+            lines += batcher.sizes.prometheus('ngogeo_batch_size', f'batch="{name}"')
+        return '\n'.join(lines) + '\n'
+
+    # asgi
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        path = scope['path'].strip('/')
+        params = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        start = time.perf_counter()
+        status = 200
+        if path == 'health':
+            body = {'ready': self.ready, 'countries': self.countries}
+            status = 200 if self.ready else 503
+        elif path == 'metrics':
+            return await self._send(send, 200, self.metrics().encode(), b'text/plain; version=0.0.4')
+        elif path not in self.endpoints:
+            body, status = {'error': f'unknown endpoint {path!r}.'}, 404
+        elif scope['method'] != 'GET':
+            body, status = {'error': 'only GET is allowed.'}, 405
+        else:
+            try:
+                body = await getattr(self, f'_{path}')(params)
+            except BadRequest as er:
+                body, status = {'error': str(er)}, 400
+            except Unavailable as er:
+                body, status = {'error': str(er)}, 503
+            except Exception as er:
+                body, status = {'error': f'{er.__class__.__name__}: {er}'}, 500
+            self.latencies[path].observe(time.perf_counter() - start)
+        await self._send(send, status, json.dumps(body).encode(), b'application/json')
+
+    @staticmethod
+    async def _send(send, status, body, content_type):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await asyncio.get_running_loop().run_in_executor(self.executor, self.preload)
+                except Exception as er:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(er)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.gather(*[batcher.close() for batcher in self.batchers.values()])
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
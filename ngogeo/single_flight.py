@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight execution: concurrent callers of the same key run the loading function once and share its result.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import asyncio
+import threading
+
+
+class _Flight(object):
+    __slots__ = ('event', 'thread', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.thread = threading.get_ident()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, fn):
+        """
+        Returns fn(), the first caller of `key` runs it while the others wait and get the same result or exception.
+        `fn` should check the cache it fills, as a caller can come just after a flight ended.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if flight.thread == threading.get_ident():
+                # reentrant call from the loading function itself
+                return fn()
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = fn()
+        except BaseException as er:
+            flight.error = er
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return flight.value
+
+
+class AsyncSingleFlight(object):
+    """Single flight of coroutines: concurrent awaits of the same key in an event loop share one task."""
+
+    def __init__(self):
+        self._tasks = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if all its callers were cancelled
+
+    async def do(self, key, fn):
+        """Returns await fn(), the first caller of `key` starts it and the others await the same task."""
+        task = self._tasks.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._done(key, t))
+        # a cancelled caller does not cancel the task shared with the others
+        return await asyncio.shield(task)
+
+
+_flights = SingleFlight()
+
+
+def single_flight(key, fn):
+    """Runs fn() once for concurrent callers of `key` in the process wide flight group."""
+    return _flights.do(key, fn)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshot of a built world: the datasets of the dataset cache, the lookup grids, ip tables and admin hierarchy.
+
+A snapshot is a folder of .npy arrays with a snapshot.json meta file. Frames are stored column-wise and all arrays
+are memory-mapped read-only when loaded, so that a master process loading a snapshot before forking its workers
+shares the same physical pages with them (geometries are built from the mapped coordinates when loading). Frames,
+indexes and grids whose source files changed since the snapshot are not restored, they are built again from their
+sources.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import shutil
+
+from . import grid, ip_table, admin_hierarchy
+from .frames import save_frame, load_frame, frame_outdated, sources_outdated
+from .geoname_index import GeonameIndex, NameIndex
+from .city_postals import CityPostals
+from .dataset_cache import get_dataset_cache
+
+SNAPSHOT_META = 'snapshot.json'
+SNAPSHOT_VERSION = 2
+# indexes of the rows of a frame, saved and loaded by their own methods
+INDEX_KINDS = {'geoname_index': GeonameIndex, 'name_index': NameIndex}
+
+
+def _dataset_kind(value):
+    for kind, cls in INDEX_KINDS.items():
+        if isinstance(value, cls):
+            return kind
+    if isinstance(value, CityPostals):
+        return 'city_postals'
+    if hasattr(value, 'columns'):
+        return 'frame'
+
+
+def _save_dataset(kind, value, folder):
+    if kind == 'frame':
+        save_frame(value, folder)
+    elif kind == 'city_postals':
+        save_frame(value.table, folder)
+    else:
+        value.save(folder)
+
+
+def _load_dataset(kind, folder):
+    if kind == 'frame':
+        return load_frame(folder, categorical=True)
+    if kind == 'city_postals':
+        return CityPostals(load_frame(folder, categorical=True))
+    return INDEX_KINDS[kind].load(folder)
+
+
+def save_snapshot(path, world, countries):
+    """
+    Saves the cached datasets and indexes in snapshot folder `path`, with the world config and the list of
+    countries (dicts of country_code and options) to restore.
+    """
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+    meta = {'version': SNAPSHOT_VERSION, 'world': world, 'countries': countries,
+            'datasets': [], 'grids': [], 'ip_tables': [], 'admin_hierarchy': None}
+    for i, (key, value) in enumerate(get_dataset_cache().items()):
+        kind = _dataset_kind(value)
+        if kind is not None:
+            folder = f'datasets/{i}'
+            _save_dataset(kind, value, path.joinpath(folder))
+            meta['datasets'].append({'key': list(key), 'kind': kind, 'folder': folder})
+    for i, (key, territory_grid) in enumerate(list(grid._grids.items())):
+        folder = f'grids/{i}'
+        territory_grid.save(path.joinpath(folder))
+        # key of get_territory_grid: name, resolution, version and bounds
+        meta['grids'].append({'key': list(key), 'folder': folder})
+    for i, (key, table) in enumerate(list(ip_table._tables.items())):
+        folder = f'ip_tables/{i}'
+        table.save(path.joinpath(folder))
+        meta['ip_tables'].append({'key': key, 'folder': folder})
+    if admin_hierarchy._hierarchy is not None:
+        admin_hierarchy._hierarchy.save(path.joinpath('admin_hierarchy'))
+        meta['admin_hierarchy'] = 'admin_hierarchy'
+    with path.joinpath(SNAPSHOT_META).open('w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def load_snapshot(path):
+    """Fills the dataset cache and the index caches from snapshot folder `path` and returns its meta."""
+    with path.joinpath(SNAPSHOT_META).open() as f:
+        meta = json.load(f)
+    if meta.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f'unsupported snapshot version {meta.get("version")} in {path}.')
+    cache = get_dataset_cache()
+    for d in meta['datasets']:
+        folder = path.joinpath(d['folder'])
+        if d['kind'] not in INDEX_KINDS and frame_outdated(folder):
+            continue
+        value = _load_dataset(d['kind'], folder)
+        # indexes hold row positions of their frame, they are outdated with it
+        if d['kind'] in INDEX_KINDS and sources_outdated(value.sources):
+            continue
+        cache.put(tuple(d['key']), value)
+    for g in meta['grids']:
+        name, resolution, version, bounds = g['key']
+        key = (name, resolution, version, tuple(bounds) if bounds is not None else None)
+        territory_grid = grid.TerritoryGrid.load(path.joinpath(g['folder']))
+        if not sources_outdated(territory_grid.sources):
+            grid._grids[key] = territory_grid
+    for t in meta['ip_tables']:
+        ip_table._tables[t['key']] = ip_table.IpTable.load(path.joinpath(t['folder']))
+    if meta['admin_hierarchy']:
+        admin_hierarchy._hierarchy = admin_hierarchy.AdminHierarchy.load(path.joinpath(meta['admin_hierarchy']))
+    return meta
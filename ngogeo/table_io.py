@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked reading and incremental writing of CSV and Parquet tables, so that large files are processed in constant
+memory. Parquet needs pyarrow.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import pathlib
+from collections import defaultdict
+import pandas as pd
+
+PARQUET_SUFFIXES = ('.parquet', '.pq')
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('reading and writing parquet files requires pyarrow (pip install pyarrow)')
+    return pyarrow
+
+
+def is_parquet(path):
+    return pathlib.Path(path).suffix.lower() in PARQUET_SUFFIXES
+
+
+def read_chunks(path, chunk_size, float_columns=()):
+    """Yields dataframes of chunk_size rows of a CSV (values read as strings) or Parquet file."""
+    if is_parquet(path):
+        pq = _pyarrow().parquet
+        for batch in pq.ParquetFile(str(path)).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+        return
+    # other columns are kept as strings (postal codes with leading zeros, ..)
+    dtypes = defaultdict(lambda: str, {c: float for c in float_columns})
+    yield from pd.read_csv(path, chunksize=chunk_size, dtype=dtypes, keep_default_na=False, na_values=[''])
+
+
+class TableWriter(object):
+    """Appends dataframes to a CSV or Parquet file, with the columns and types of the first one."""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.rows = 0
+        self._writer = None
+        self._columns = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def write(self, frame):
+        # string columns are typed as such even when a chunk has only missing values
+        frame = frame.astype({c: 'string' for c in frame.columns if frame[c].dtype == object})
+        first = self._columns is None
+        if first:
+            self._columns = list(frame.columns)
+        frame = frame[self._columns]
+        if is_parquet(self.path):
+            pa = _pyarrow()
+            if first:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                self._writer = pa.parquet.ParquetWriter(str(self.path), table.schema)
+            else:
+                table = pa.Table.from_pandas(frame, schema=self._writer.schema, preserve_index=False)
+            self._writer.write_table(table)
+        else:
+            frame.to_csv(self.path, mode='w' if first else 'a', header=first, index=False)
+        self.rows += len(frame)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
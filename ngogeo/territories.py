@@ -2,6 +2,9 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import gc
+import hashlib
+import pathlib
 import pytz
 from collections import namedtuple, OrderedDict
 import pandas as pd
@@ -16,19 +19,36 @@ from ngoschema.protocols import with_metaclass, SchemaMetaclass
 from ngogeo import settings as geo_settings
 
 
-from .point_search import _make_point_to_crs, _search_elements, _search_name, _search_radius
-from .geonames.loaders import load_geonames_gdf, load_countries, load_cities, load_timezones
-from .postals import load_postals_gdf
+from .point_search import _make_point_to_crs, _search_elements, _search_name, _search_radius, _iter_search_radius
+from .point_search import _radius_to_crs_units
+from .geonames.loaders import load_geonames_gdf, load_countries, load_cities, load_timezones, geonames_file, \
+    countries_files
+from .postals import load_postals_gdf, postals_files
 from .datasets import DataframeSubset, GeoDataframeSubset
+from .distances import haversine_km, lonlat_arrays
+from .grid import get_territory_grid, WORLD_BOUNDS
+from .ip_table import get_ip_table
+from .geoname_index import get_geoname_index, get_name_index
+from .records import RecordViews, records
+from .admin_hierarchy import get_admin_hierarchy
+from .city_postals import get_city_postals
+from .registry import get_registry
+from .dataset_cache import get_dataset_cache
+from .single_flight import single_flight
+from .snapshot import save_snapshot, load_snapshot
+from .frames import get_stored_frame
 
 WSG84_CRS = EPSG4326_CRS = geo_settings.WSG84_CRS
 DEFAULT_CRS = geo_settings.DEFAULT_CRS
+COUNTRY_CRS = geo_settings.COUNTRY_CRS
 DEFAULT_RADIUS_SEARCH = geo_settings.DEFAULT_RADIUS_SEARCH
 WORLD_CITIES_FILE = geo_settings.WORLD_CITIES_FILE
 WORLD_WITH_SHAPE = geo_settings.WORLD_WITH_SHAPE
 WORLD_WITH_CITIES = geo_settings.WORLD_WITH_CITIES
 COUNTRY_WITH_POSTALS = geo_settings.COUNTRY_WITH_POSTALS
 COUNTRY_WITH_GEONAMES = geo_settings.COUNTRY_WITH_GEONAMES
+WORLD_WITH_GRID = geo_settings.WORLD_WITH_GRID
+SNAPSHOT_COUNTRY_OPTIONS = ('with_geonames', 'with_postals', 'bound_from_cities')
 
 
 class SearchBox(with_metaclass(SchemaMetaclass)):
@@ -55,8 +75,33 @@ class Territory(with_metaclass(SchemaMetaclass)):
     _lazyLoading = True
 
     def __init__(self, *args, crs=None, **opts):
-        crs = crs or geo_settings.DEFAULT_CRS
+        # subdivisions share the crs of their parent
+        parent = opts.get('parent')
+        crs = crs or (parent.crs if parent is not None else None) or geo_settings.DEFAULT_CRS
         super().__init__(*args, crs=crs, **opts)
+        self.registry().register(self)
+
+    def registry(self):
+        """Registry of the territories of the same world."""
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        return get_registry(root)
+
+    def reset_dataset(self, prop):
+        """Resets lazy dataset `prop` and the subsets of it held by the territories below, reloaded when accessed."""
+        self._set_dataValidated(prop, None)
+        for territory in self.registry().territories():
+            if territory._dataValidated.get(prop) is None:
+                continue
+            parent = territory.parent
+            while parent is not None and parent is not self:
+                parent = parent.parent
+            if parent is self:
+                territory._set_dataValidated(prop, None)
+
+    def _registry_keys(self):
+        return ()
 
     def __repr__(self):
         return f'<{self.__class__.__name__} [{self.admin_code}] {self.name}>'
@@ -68,7 +113,8 @@ class Territory(with_metaclass(SchemaMetaclass)):
         return self.cs.convex_hull[0] if self.cs is not None else None
 
     def get_box(self):
-        return self.bnd.minimum_rotated_rectangle.buffer(DEFAULT_RADIUS_SEARCH, resolution=4) if self.bnd else None
+        radius = _radius_to_crs_units(DEFAULT_RADIUS_SEARCH, self.crs)
+        return self.bnd.minimum_rotated_rectangle.buffer(radius, resolution=4) if self.bnd else None
 
     def get_bbox(self):
         if self.cs is not None:
@@ -76,8 +122,7 @@ class Territory(with_metaclass(SchemaMetaclass)):
             return f'{bbox.miny[0]:.3f}, {bbox.minx[0]:.3f}, {bbox.maxy[0]:.3f}, {bbox.maxx[0]:.3f}'
 
     def make_point_to_crs(self, point, point_crs=None, dest_crs=None):
-        if hasattr(point, '_crs'):
-            point_crs = point_crs or point._crs
+        # points carry no crs, point_crs is WSG84 unless given
         point_crs = point_crs or WSG84_CRS
         dest_crs = dest_crs or self.crs
         return _make_point_to_crs(point, point_crs=point_crs, dest_crs=dest_crs)
@@ -128,18 +173,31 @@ class CitiesTerritory(with_metaclass(SchemaMetaclass)):
         if self.bound_from_cities and self.cities_gdf is not None:
             return gpd.GeoSeries([MultiPoint(cities_gdf.geometry.to_list())], crs=self.crs)
 
+    def cities_hull(self):
+        """Convex hull of the cities of the territory, whether it is bound from its cities or not."""
+        cities_gdf = self.cities_gdf
+        cities_gdf = cities_gdf.subset if isinstance(cities_gdf, GeoDataframeSubset) else cities_gdf
+        if cities_gdf is not None and len(cities_gdf):
+            return MultiPoint(cities_gdf.geometry.to_list()).convex_hull
+
     def get_cities_gdf(self):
         return self._create_parent_gdf_subset('cities_gdf', subkeys=self.cities_subkeys, ids=self.cities_ids)
 
-    def search_cities_name(self, name, regex=False, **kwargs):
+    def search_cities_name(self, name, regex=False, limit=None, **kwargs):
         cities_gdf = self.cities_gdf
         cities_gdf = cities_gdf.subset if isinstance(cities_gdf, GeoDataframeSubset) else cities_gdf
-        return _search_name(cities_gdf, name, regex=regex, **kwargs)
+        return _search_name(cities_gdf, name, regex=regex, limit=limit, **kwargs)
 
-    def search_cities_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, **kwargs):
+    def search_cities_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, limit=None,
+                             **kwargs):
         cities_gdf = self.cities_gdf
         cities_gdf = cities_gdf.subset if isinstance(cities_gdf, GeoDataframeSubset) else cities_gdf
-        return _search_radius(cities_gdf, point, radius=radius, point_crs=point_crs, regex=regex, **kwargs)
+        return _search_radius(cities_gdf, point, radius=radius, point_crs=point_crs, regex=regex, limit=limit, **kwargs)
+
+    def iter_cities_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, **kwargs):
+        cities_gdf = self.cities_gdf
+        cities_gdf = cities_gdf.subset if isinstance(cities_gdf, GeoDataframeSubset) else cities_gdf
+        return _iter_search_radius(cities_gdf, point, radius=radius, point_crs=point_crs, regex=regex, **kwargs)
 
 
 class PostalsTerritory(with_metaclass(SchemaMetaclass)):
@@ -174,13 +232,21 @@ class PostalsTerritory(with_metaclass(SchemaMetaclass)):
         else:
             return response
 
-    def search_postals_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, **kwargs):
+    def search_postals_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, limit=None,
+                              **kwargs):
         postals_gdf = self.postals_gdf
         postals_gdf = postals_gdf.subset if isinstance(postals_gdf, GeoDataframeSubset) else postals_gdf
         if postals_gdf is not None:
-            gdf = _search_radius(postals_gdf, point, radius=radius, point_crs=point_crs, regex=regex, **kwargs)
+            gdf = _search_radius(postals_gdf, point, radius=radius, point_crs=point_crs, regex=regex, limit=limit,
+                                 **kwargs)
             return gdf
 
+    def iter_postals_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, **kwargs):
+        postals_gdf = self.postals_gdf
+        postals_gdf = postals_gdf.subset if isinstance(postals_gdf, GeoDataframeSubset) else postals_gdf
+        if postals_gdf is not None:
+            yield from _iter_search_radius(postals_gdf, point, radius=radius, point_crs=point_crs, regex=regex, **kwargs)
+
 
 class GeonamesTerritory(with_metaclass(SchemaMetaclass)):
     _id = r"https://numengo.org/ngogeo#/$defs/territories/$defs/GeonamesTerritory"
@@ -191,18 +257,27 @@ class GeonamesTerritory(with_metaclass(SchemaMetaclass)):
     def get_geonames_gdf(self):
         return self._create_parent_gdf_subset('geonames_gdf', subkeys=self.geonames_subkeys, ids=self.geonames_ids)
 
-    def search_geonames_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, **kwargs):
+    def search_geonames_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, limit=None,
+                               **kwargs):
         geonames_gdf = self.geonames_gdf
         geonames_gdf = geonames_gdf.subset if isinstance(geonames_gdf, GeoDataframeSubset) else geonames_gdf
         if geonames_gdf is not None:
-            gdf = _search_radius(geonames_gdf, point, radius=radius, point_crs=point_crs, regex=regex, **kwargs)
+            gdf = _search_radius(geonames_gdf, point, radius=radius, point_crs=point_crs, regex=regex, limit=limit,
+                                 **kwargs)
             return gdf
 
-    def search_geonames_name(self, name, regex=False, **kwargs):
+    def iter_geonames_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, **kwargs):
+        geonames_gdf = self.geonames_gdf
+        geonames_gdf = geonames_gdf.subset if isinstance(geonames_gdf, GeoDataframeSubset) else geonames_gdf
+        if geonames_gdf is not None:
+            yield from _iter_search_radius(geonames_gdf, point, radius=radius, point_crs=point_crs, regex=regex,
+                                           **kwargs)
+
+    def search_geonames_name(self, name, regex=False, limit=None, **kwargs):
         geonames_gdf = self.geonames_gdf
         geonames_gdf = geonames_gdf.subset if isinstance(geonames_gdf, GeoDataframeSubset) else geonames_gdf
         if geonames_gdf is not None:
-            gdf = _search_name(geonames_gdf, name, regex=regex, **kwargs)
+            gdf = _search_name(geonames_gdf, name, regex=regex, limit=limit, **kwargs)
             return gdf
 
     def find_geonameid(self, gid):
@@ -224,28 +299,42 @@ class Admin3(with_metaclass(SchemaMetaclass)):
     def get_postals_gdf(self):
         a2_postals = self.parent.postals_gdf
         if a2_postals is not None:
-            admin_code = self.admin_code
-            try:
-                a3_community_code = f'{float(admin_code):.1f}'
-            except Exception as er:
-                a3_community_code = admin_code
-            a3_postals = a2_postals[a2_postals['community_code'].isin([a3_community_code, admin_code])]
-            if not len(a3_postals):
-                a3_cities = self.cities_gdf.subset
-                a3_cities_postals = a3_cities.merge(a2_postals, left_on='name', right_on='place_name', copy=True)
-                a3s = a3_cities_postals.admin3code.value_counts()
-                if len(a3s):
-                    a3_community_code = a3s.index[0]
-                    a3_postals = a2_postals[a2_postals['community_code'] == a3_community_code]
-            assert len(a3_postals['community_code'].unique()) == 1
-            community_code = a3_postals['community_code'].iloc[0]
+            country = self.parent.parent.parent
+            mapped = country.city_postals().postal_admin_code(self.admin1_code, self.admin2_code, self.admin3_code)
+            community_code = _postal_admin_code(self, a2_postals, 'community_code', self.admin3_code, mapped)
             self._set_dataValidated('community_code', community_code)
             self._set_dataValidated('postals_ids', [community_code])
-        return a3_postals
+            return a2_postals[a2_postals['community_code'] == community_code]
 
     def get_postals_ids(self):
         return [self._dataValidated.get('community_code')]
 
+    def _registry_keys(self):
+        return [('admin', self.admin_key())]
+
+    def find_admin(self, *admin_codes):
+        """Returns the admin unit of codes below this one (ex: country.find_admin('84', '42')), created if needed."""
+        admin = self
+        for code in admin_codes:
+            if admin is None:
+                break
+            level = admin.admin_key().count('.') + 1
+            cls = (Admin1, Admin2, Admin3)[level - 1]
+            codes = {f'admin{l}_code': admin[f'admin{l}_code'] for l in range(1, level)}
+            codes[f'admin{level}_code'] = code
+            admin = _admin(cls, admin, code, **codes)
+        return admin
+
+    def admin_key(self):
+        """Geonames key of the unit, as 'FR.84.42'."""
+        cur, codes = self, []
+        while cur is not None:
+            codes.append(cur.admin_code)
+            if isinstance(cur, Country):
+                break
+            cur = cur.parent
+        return '.'.join(reversed(codes))
+
     def get_name(self):
         admin3_postals = self.postals_gdf
         if admin3_postals is not None:
@@ -254,13 +343,18 @@ class Admin3(with_metaclass(SchemaMetaclass)):
                 return admin3_aliases[0]
         return self.admin_code
 
-    def locate_cities_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, **kwargs):
-        cities = self.search_cities_around(point, radius=radius, point_crs=point_crs, regex=regex, **kwargs)
+    def locate_cities_around(self, point, radius=DEFAULT_RADIUS_SEARCH, point_crs=None, regex=False, limit=None,
+                             views=False, **kwargs):
+        """
+        Returns the (distance, City) pairs of the cities around point. With views, cities are record views only
+        building their City when an attribute which is not a column is requested.
+        """
+        cities = self.search_cities_around(point, radius=radius, point_crs=point_crs, regex=regex, limit=limit, **kwargs)
         cities_distance = cities.pop('distance')
-        ret = [(cities_distance[i], City(geoname=row, parent=self, crs=self.crs)) for i, row in cities.iterrows()]
-        return ret
+        cities = RecordViews(cities, City, parent=self, crs=self.crs)
+        return list(zip(cities_distance.to_list(), cities if views else cities.materialize()))
 
-    def locate_city(self, name=None, postal_code=None):
+    def locate_city(self, name=None, postal_code=None, views=False):
         postal = self.search_postal_code(postal_code, unique=True) if postal_code else None
         geo_kwargs = OrderedDict()
         if postal is not None and len(postal):
@@ -273,7 +367,8 @@ class Admin3(with_metaclass(SchemaMetaclass)):
             if not len(cities):
                 cities = self.search_geonames_name(name, featureclass='P', **geo_kwargs)
             if len(cities):
-                cities = [City(geoname=row, crs=self.crs, parent=self) for i, row in cities.iterrows()]
+                cities = RecordViews(cities, City, crs=self.crs, parent=self)
+                cities = list(cities) if views else cities.materialize()
                 return cities[0] if len(cities) == 1 else cities
 
 
@@ -286,26 +381,17 @@ class Admin2(with_metaclass(SchemaMetaclass)):
     def get_postals_gdf(self):
         a1_postals = self.parent.postals_gdf
         if a1_postals is not None:
-            admin_code = self.admin_code
-            try:
-                a2_county_code = f'{int(admin_code)}'
-            except Exception as er:
-                a2_county_code = admin_code
-            a2_postals = a1_postals[a1_postals['county_code'].isin([a2_county_code, admin_code])]
-            if not len(a2_postals):
-                a2_cities = self.cities_gdf.subset
-                a2_cities_postals = a2_cities.merge(a1_postals, left_on='name', right_on='place_name', copy=True)
-                a2s = a2_cities_postals.admin2code.value_counts()
-                if len(a2s):
-                    a2_county_code = a2s.index[0]
-                    a2_postals = a1_postals[a1_postals['county_code'] == a2_county_code]
-            assert len(a2_postals['county_code'].unique()) == 1
-            county_code = a2_postals['county_code'].iloc[0]
+            country = self.parent.parent
+            mapped = country.city_postals().postal_admin_code(self.admin1_code, self.admin2_code)
+            county_code = _postal_admin_code(self, a1_postals, 'county_code', self.admin2_code, mapped)
             self._set_dataValidated('county_code', county_code)
             self._set_dataValidated('postals_ids', [county_code])
-            return a2_postals
+            return a1_postals[a1_postals['county_code'] == county_code]
 
     def get_name(self):
+        name = get_admin_hierarchy().name(self.admin_key())
+        if name:
+            return name
         a2_postals = self.postals_gdf
         if a2_postals is not None:
             admin2_aliases = a2_postals['county_name'].unique()
@@ -314,13 +400,28 @@ class Admin2(with_metaclass(SchemaMetaclass)):
         return self.admin_code
 
     def get_admin3(self):
-        if self.cities_gdf:
+        admin3_codes = self._hierarchy_admin3_codes()
+        if admin3_codes is None and self.cities_gdf:
             cities_subset = self.cities_gdf.subset
             subkey = Admin3.cities_subkeys.ptype.default()[0]
             admin3_codes = cities_subset[subkey].unique()
-            return [Admin3(admin3_code=c, admin2_code=self.admin2_code, admin1_code=self.admin1_code, parent=self)
+        if admin3_codes is not None:
+            return [_admin(Admin3, self, c, admin3_code=c, admin2_code=self.admin2_code, admin1_code=self.admin1_code)
                     for c in admin3_codes]
 
+    def _hierarchy_admin3_codes(self):
+        # admin3 children of hierarchy.zip are named by the country geonames, when loaded
+        hierarchy = get_admin_hierarchy()
+        geonameid = hierarchy.geonameid(self.admin_key())
+        country = self.parent.parent
+        index = country.geonames_index() if geonameid is not None else None
+        if index is not None:
+            pos = index.positions(hierarchy.child_geonameids(geonameid))
+            codes = country.geonames_gdf['admin3code'].to_numpy()[pos[pos >= 0]]
+            codes = pd.unique(codes[pd.notna(codes)])
+            if len(codes):
+                return codes
+
 
 class Admin1(with_metaclass(SchemaMetaclass)):
     _id = r"https://numengo.org/ngogeo#/$defs/territories/$defs/Admin1"
@@ -331,15 +432,17 @@ class Admin1(with_metaclass(SchemaMetaclass)):
     def get_postals_gdf(self):
         cy_postals = self.parent.postals_gdf
         if cy_postals is not None:
-            a1_cities = self.cities_gdf.subset
-            a1_cities_postals = a1_cities.merge(cy_postals, left_on='name', right_on='place_name', copy=True)
-            a1_postal = a1_cities_postals.state_code.value_counts().index[0]
+            mapped = self.parent.city_postals().postal_admin_code(self.admin1_code)
+            a1_postal = _postal_admin_code(self, cy_postals, 'state_code', self.admin1_code, mapped)
             a1_postals = cy_postals[cy_postals['state_code'] == a1_postal]
             self._set_dataValidated('state_code', a1_postal)
             self._set_dataValidated('postals_ids', [a1_postal])
             return a1_postals
 
     def get_name(self):
+        name = get_admin_hierarchy().name(self.admin_key())
+        if name:
+            return name
         a1_postals = self.postals_gdf
         if a1_postals is not None:
             a1_aliases = a1_postals['state_name'].unique()
@@ -347,12 +450,12 @@ class Admin1(with_metaclass(SchemaMetaclass)):
         return self.admin_code
 
     def get_admin2(self):
-        if self.cities_gdf:
+        admin2_codes = [k.rsplit('.', 1)[-1] for k in get_admin_hierarchy().children(self.admin_key())]
+        if not admin2_codes and self.cities_gdf:
             cities_subset = self.cities_gdf.subset
             subkey = Admin2.cities_subkeys.ptype.default()[0]
             admin2_codes = cities_subset[subkey].unique()
-            return [Admin2(admin2_code=c, admin1_code=self.admin1_code, parent=self)
-                    for c in admin2_codes]
+        return [_admin(Admin2, self, c, admin2_code=c, admin1_code=self.admin1_code) for c in admin2_codes]
 
     def get_admin3(self):
         ret = []
@@ -370,18 +473,35 @@ class Country(with_metaclass(SchemaMetaclass)):
         if infos is not None:
             kwargs.update(infos.dropna().to_dict())
             kwargs['infos'] = infos
+        # countries without national grid keep their data in WSG84
+        kwargs['crs'] = kwargs.get('crs') or COUNTRY_CRS.get(kwargs.get('country_code'), WSG84_CRS)
         super().__init__(*args, bound_from_cities=False, **kwargs)
 
+    @classmethod
+    def from_frame(cls, frame, **kwargs):
+        """Builds the countries of an infos frame indexed by ISO code at once, without per row validation."""
+        countries = []
+        for i, (country_code, fields) in enumerate(zip(frame.index, records(frame))):
+            fields.update(kwargs)
+            country = cls(country_code=country_code, validate=False, **fields)
+            country._set_dataValidated('infos', frame.iloc[i])
+            countries.append(country)
+        return countries
+
+    def _registry_keys(self):
+        return [('admin', self.country_code), ('country', self.country_code), ('iso3', self.get('ISO3')),
+                ('geonameid', self.get('geonameid'))]
+
     def get_name(self):
         return self.admin_code if self.infos is None else self.infos['Country']
 
     def get_admin1(self):
-        if self.cities_gdf:
+        admin1_codes = [k.rsplit('.', 1)[-1] for k in get_admin_hierarchy().children(self.country_code)]
+        if not admin1_codes and self.cities_gdf:
             cities_subset = self.cities_gdf.subset
             subkey = Admin1.cities_subkeys.ptype.default()[0]
             admin1_codes = cities_subset[subkey].unique()
-            return [Admin1(admin1_code=c, parent=self)
-                    for c in admin1_codes]
+        return [_admin(Admin1, self, c, admin1_code=c) for c in admin1_codes]
 
     def get_admin2(self):
         ret = []
@@ -394,10 +514,11 @@ class Country(with_metaclass(SchemaMetaclass)):
 
     def get_capital(self):
         cities = self.cities_gdf
+        cities = cities.subset if isinstance(cities, GeoDataframeSubset) else cities
         if cities is not None:
-            for idx, row in cities.iterrows():
-                if row['featurecode'] == 'PPLC':
-                    return City(geoname=row, parent=self)
+            capitals = cities[cities['featurecode'] == 'PPLC']
+            if len(capitals):
+                return City(geoname=capitals.iloc[0], parent=self)
 
     def get_cs(self):
         infos = self.infos
@@ -411,6 +532,11 @@ class Country(with_metaclass(SchemaMetaclass)):
             ch = cs.explode().geometry.convex_hull
             return ch.unary_union
 
+    def get_box(self):
+        # country boundaries are in WSG84_CRS whatever the country crs
+        radius = _radius_to_crs_units(DEFAULT_RADIUS_SEARCH, WSG84_CRS)
+        return self.bnd.minimum_rotated_rectangle.buffer(radius, resolution=4) if self.bnd else None
+
     def get_languages(self):
         # hack: world.languages return an external db which doesn t behave as a dict
         # conversion possible through protected member fields
@@ -437,6 +563,86 @@ class Country(with_metaclass(SchemaMetaclass)):
                     return l
             return self
 
+    def admin_grid(self, level=2, resolution=None, rebuild=False, bound_from_cities=None):
+        # admins and their bounds are only computed when the grid is not in memory
+        # bound_from_cities defaults to the country option, without changing it
+        from_cities = self.bound_from_cities if bound_from_cities is None else bound_from_cities
+        source = 'cities' if from_cities else 'shapes'
+
+        def bound(admin):
+            if from_cities:
+                return admin.cities_hull()
+            return admin.bnd if not admin.bound_from_cities else None
+
+        def territories():
+            admins, bnds = [], []
+            for a in self[f'admin{level}']:
+                bnd = bound(a)
+                if bnd is not None:
+                    admins.append(a)
+                    bnds.append(bnd)
+            bnds = gpd.GeoSeries(bnds, crs=self.crs).to_crs(WSG84_CRS)
+            # labelled by admin keys ('FR.84.42'), admin codes alone are not unique below admin1
+            return bnds.values, [a.admin_key() for a in admins]
+
+        def digest():
+            keys = sorted(a.admin_key() for a in self[f'admin{level}'])
+            return hashlib.sha1('\n'.join(keys).encode()).hexdigest()[:12]
+
+        def sources():
+            cities = get_world().cities_gdf if from_cities else None
+            return cities.attrs.get('sources', []) if cities is not None else []
+
+        return get_territory_grid(f'{self.country_code}_admin{level}_{source}', territories, None,
+                                  resolution=resolution or geo_settings.ADMIN_GRID_RESOLUTION, rebuild=rebuild,
+                                  digest=digest, sources=sources)
+
+    def locate_admin(self, point, point_crs=None, level=2):
+        p = self.make_point_to_crs(point, point_crs, dest_crs=WSG84_CRS)
+        admin_key = self.admin_grid(level).locate(p.x, p.y)
+        if admin_key is not None:
+            return self.find_admin(*admin_key.split('.')[1:])
+
+    def geonames_index(self):
+        if self.with_geonames:
+            return get_geoname_index(f'geonames_{self.country_code}', self.geonames_gdf)
+
+    def name_index(self):
+        """Index of the normalized names of the places of the country (see places_gdf)."""
+        places = self.places_gdf()
+        if places is not None:
+            source = 'geonames' if self.with_geonames else 'cities'
+            return get_name_index(f'places_{self.country_code}_{source}', places)
+
+    def _geoname_row(self, gid):
+        # world cities first as they are usually loaded, then the country geonames
+        world = get_world()
+        cities_index = world.cities_index()
+        if cities_index is not None:
+            row = cities_index.row(world.cities_gdf, gid)
+            if row is not None and row['countrycode'] == self.country_code:
+                return row
+        geonames_index = self.geonames_index()
+        if geonames_index is not None:
+            return geonames_index.row(self.geonames_gdf, gid)
+
+    def find_geonameid(self, gid):
+        row = self._geoname_row(gid)
+        if row is not None:
+            return Geoname(geoname=row, parent=self)
+
+    def locate_geonameid(self, gid):
+        """Returns the Admin1/2/3, City or Geoname of a geonameid, or None if not in the loaded frames."""
+        row = self._geoname_row(gid)
+        if row is None:
+            return None
+        featurecode = row['featurecode']
+        if featurecode in ('ADM1', 'ADM2', 'ADM3'):
+            return self.find_admin(*[row[f'admin{level}code'] for level in range(1, int(featurecode[-1]) + 1)])
+        if row['featureclass'] == 'P':
+            return City(geoname=row, parent=self, crs=self.crs)
+        return Geoname(geoname=row, parent=self)
+
     def get_currency(self):
         # hack: world.currencies return an external db which doesn t behave as a dict
         # conversion possible through protected member fields
@@ -452,11 +658,34 @@ class Country(with_metaclass(SchemaMetaclass)):
 
     def get_geonames_gdf(self):
         if self.with_geonames:
-            return load_geonames_gdf(self.country_code, crs=self.crs)
+            return get_dataset_cache().get(('geonames', self.country_code, str(self.crs)), self._load_geonames_gdf,
+                                           owner=self, prop='geonames_gdf')
+
+    def _load_geonames_gdf(self):
+        return stored_geonames_gdf(self.country_code, self.crs)
 
     def get_postals_gdf(self):
         if self.with_postals:
-            return load_postals_gdf(self.country_code, crs=self.crs)
+            return get_dataset_cache().get(('postals', self.country_code, str(self.crs)), self._load_postals_gdf,
+                                           owner=self, prop='postals_gdf')
+
+    def _load_postals_gdf(self):
+        return stored_postals_gdf(self.country_code, self.crs)
+
+    def places_gdf(self):
+        """Populated places of the country: its geonames of class P if loaded, otherwise the world cities."""
+        if self.with_geonames:
+            geonames = self.geonames_gdf
+            return geonames[geonames['featureclass'] == 'P']
+        cities = self.cities_gdf
+        return cities.subset if isinstance(cities, GeoDataframeSubset) else cities
+
+    def city_postals(self):
+        """City <-> postal code <-> admin codes mapping of the country, cached on disk."""
+        postals = self.postals_gdf
+        if postals is not None:
+            source = 'geonames' if self.with_geonames else 'cities'
+            return get_city_postals(f'{self.country_code}_{source}', self.places_gdf(), postals)
 
 
 class Continent(with_metaclass(SchemaMetaclass)):
@@ -471,10 +700,16 @@ class Continent(with_metaclass(SchemaMetaclass)):
     def get_countries_gdf(self):
         return self._create_parent_gdf_subset('countries_gdf', subkeys='Continent', ids=[self.continent_code])
 
+    def _registry_keys(self):
+        return [('continent', self.continent_code)]
+
     def get_countries(self):
+        # countries already created (ex: by World.get_country) are reused
         countries_gdf = self.countries_gdf.subset
-        return [Country(country_code=ucc, infos=countries_gdf.loc[ucc], parent=self)
-                for ucc in countries_gdf.index]
+        registry = self.registry()
+        missing = [cc for cc in countries_gdf.index if registry.get('country', cc) is None]
+        Country.from_frame(countries_gdf.loc[missing], parent=self)
+        return [registry.get('country', cc) for cc in countries_gdf.index]
 
     def get_bnd(self):
         countries_gdf = self.countries_gdf.subset
@@ -501,9 +736,9 @@ class Continent(with_metaclass(SchemaMetaclass)):
     def locate_country(self, point, point_crs=None):
         if hasattr(self, 'bnd'):
             p = self.make_point_to_crs(point, point_crs, dest_crs=WSG84_CRS)
-            for cc, bnd in self.bnd.iteritems():
+            for cc, bnd in self.bnd.items():
                 if bnd.contains(p):
-                    return self.countries.get(country_code=cc)
+                    return self.parent.get_country(cc)
         for country in self.countries:
             if country.contains(point, point_crs):
                 return country
@@ -521,7 +756,18 @@ class World(with_metaclass(SchemaMetaclass)):
         super().__init__(*args, name='World', cities_file=cities_file,
                          with_cities=with_cities, with_shapes=with_shapes, crs=crs, **kwargs)
 
+    def _registry_keys(self):
+        return ()
+
     def get_countries_gdf(self):
+        return get_dataset_cache().get(('countries', self.with_shapes), self._load_countries_gdf,
+                                       owner=self, prop='countries_gdf')
+
+    def _load_countries_gdf(self):
+        return get_stored_frame(f'countries_{self.with_shapes}', self._build_countries_gdf,
+                                sources=countries_files(self.with_shapes))
+
+    def _build_countries_gdf(self):
         countries_gdf = load_countries(with_shapes=self.with_shapes)
         if self.with_shapes:
             countries_bnd = countries_gdf.geometry.explode().convex_hull
@@ -530,7 +776,12 @@ class World(with_metaclass(SchemaMetaclass)):
 
     def get_cities_gdf(self):
         if self.with_cities:
-            return load_cities(self.cities_file, crs=self.crs)
+            return get_dataset_cache().get(('cities', self.cities_file, str(self.crs)), self._load_cities_gdf,
+                                           owner=self, prop='cities_gdf')
+
+    def _load_cities_gdf(self):
+        return get_stored_frame(f'{self.cities_file}_{self.crs}', lambda: load_cities(self.cities_file, crs=self.crs),
+                                sources=[geonames_file(self.cities_file)])
 
     def get_continents(self):
         continent_codes = self.countries_gdf['Continent'].dropna().unique()
@@ -538,8 +789,11 @@ class World(with_metaclass(SchemaMetaclass)):
                 for cc in continent_codes]
 
     def get_countries(self):
-        continents_countries = [list(c.countries) for c in self.continents]
-        return sum(continents_countries)
+        return [country for continent in self.continents for country in continent.countries]
+
+    def cities_index(self):
+        if self.with_cities:
+            return get_geoname_index(f'cities_{self.cities_file}', self.cities_gdf)
 
     def get_timezones(self):
         return load_timezones()
@@ -565,34 +819,92 @@ class World(with_metaclass(SchemaMetaclass)):
         elif self.ip_city is not None:
             res = self.ip_city.city(ip)
         if res is not None:
-            return self.continents.get(continent_code=res.continent.code).countries.get(country_code=res.country.iso_code)
+            return self.get_country(res.country.iso_code)
+
+    def locate_ips(self, ips, processes=None, use_table=None):
+        """Batch ip geolocation, returns a dataframe of country/subdivisions/city/postal codes and geoname ids."""
+        ip_utils = self.ip_city if self.ip_city is not None else self.ip_country
+        use_table = geo_settings.IP_WITH_TABLE if use_table is None else use_table
+        if ip_utils is not None:
+            if use_table:
+                return get_ip_table(ip_utils.__class__).lookup(ips)
+            return ip_utils.lookup_batch(ips, processes=processes)
 
     def locate_ip_city(self, ip):
         if self.ip_city:
-            res = self.ip_city.city(ip)
-            if res:
-                country = cur = self.continents.get(continent_code=res.continent.code).countries.get(country_code=res.country.iso_code)
-                for s in res.subdivisions:
+            record = self.ip_city.record(ip)
+            if record is None:
+                return None
+            record = dict(zip(self.ip_city._fields, record))
+            country = self.get_country(record['country_code'])
+            if country is None:
+                return None
+            # geoname ids of the record resolve through indexes, names are only searched as a fallback
+            city = country.locate_geonameid(record['city_geonameid'])
+            if city is not None:
+                return city
+            cur = country
+            for key in ('subdivision2_geonameid', 'subdivision1_geonameid'):
+                admin = country.locate_geonameid(record[key])
+                if admin is not None:
+                    cur = admin
+                    break
+            else:
+                for s in self.ip_city.city(ip).subdivisions:
                     if cur.subdivisions:
                         cur = cur.subdivisions.get(name=s.name)
-                return cur.locate_city(name=res.city.name,
-                                       postal_code=res.postal.code)
+            if record['city_name'] is None and record['postal_code'] is None:
+                return cur
+            return cur.locate_city(name=record['city_name'], postal_code=record['postal_code'])
 
     def get_languages(self):
         return pycountry.languages # pycountry languages better than iso geonames
 
+    def to_country_code(self, code):
+        """Returns the ISO2 code of an ISO2/ISO3 code or a country geonameid, None if unknown."""
+        registry = self.registry()
+        if not registry.aliases:
+            countries_gdf = self.countries_gdf
+            registry.aliases.update(zip(countries_gdf.index, countries_gdf.index))
+            registry.aliases.update(zip(countries_gdf['ISO3'], countries_gdf.index))
+            registry.aliases.update(zip(countries_gdf['geonameid'].dropna().astype(int), countries_gdf.index))
+        return registry.aliases.get(code)
+
+    def get_continent(self, continent_code):
+        continent = self.registry().get('continent', continent_code)
+        return continent if continent is not None else self.continents.get(continent_code=continent_code)
+
     def get_country(self, country_code):
-        for continent in self.continents:
-            c = continent.countries.get(country_code=country_code)
-            if c:
-                return c
+        """Returns the country of an ISO2/ISO3 code or geonameid, creating only this country if needed."""
+        country_code = self.to_country_code(country_code)
+        if country_code is None:
+            return None
+        country = self.registry().get('country', country_code)
+        if country is None:
+            countries_gdf = self.countries_gdf
+            continent = self.get_continent(countries_gdf.loc[country_code, 'Continent'])
+            country = Country.from_frame(countries_gdf.loc[[country_code]], parent=continent)[0]
+        return country
 
     def locate(self, point, point_crs=None):
         for continent in self.continents:
             if continent.contains(point, point_crs):
                 return continent.locate(point, point_crs)
 
-    def locate_country(self, point, point_crs=None):
+    def country_grid(self, resolution=None, rebuild=False):
+        if self.with_shapes:
+            countries_gdf = self.countries_gdf
+            return get_territory_grid('countries', countries_gdf.geometry.values, countries_gdf.index.to_list(),
+                                      resolution=resolution, bounds=WORLD_BOUNDS, rebuild=rebuild,
+                                      sources=countries_gdf.attrs.get('sources', []))
+
+    def locate_country(self, point, point_crs=None, use_grid=WORLD_WITH_GRID):
+        if use_grid:
+            grid = self.country_grid()
+            if grid is not None:
+                p = self.make_point_to_crs(point, point_crs, dest_crs=WSG84_CRS)
+                country_code = grid.locate(p.x, p.y)
+                return self.get_country(country_code) if country_code else None
         for continent in self.continents:
             if continent.contains(point, point_crs):
                 return continent.locate_country(point, point_crs)
@@ -601,6 +913,14 @@ class World(with_metaclass(SchemaMetaclass)):
         country_code = coco.convert(names=name, to='ISO2', not_found=None, enforce_list=False, exclude_prefix=exclude_prefix)
         return self.get_country(country_code)
 
+    def save_snapshot(self, path):
+        """Saves the world, the countries created and the datasets and indexes loaded to a snapshot folder."""
+        world = {'cities_file': self.cities_file, 'with_shapes': self.with_shapes, 'with_cities': self.with_cities}
+        countries = [dict(country_code=country.country_code,
+                          **{k: getattr(country, k) for k in SNAPSHOT_COUNTRY_OPTIONS})
+                     for country in self.registry().values('country')]
+        return save_snapshot(pathlib.Path(path), world, countries)
+
 
 class Location(with_metaclass(SchemaMetaclass)):
     _id = r"https://numengo.org/ngogeo#/$defs/territories/$defs/Location"
@@ -671,6 +991,17 @@ class Geoname(with_metaclass(SchemaMetaclass)):
             kwargs['geoname'] = geoname
         super().__init__(*args, **kwargs)
 
+    @classmethod
+    def from_frame(cls, frame, **kwargs):
+        """Builds the objects of all rows of a frame at once, without per row validation."""
+        objs = []
+        for i, fields in enumerate(records(frame)):
+            fields.update(kwargs)
+            obj = cls(validate=False, **fields)
+            obj._set_dataValidated('geoname', frame.iloc[i])
+            objs.append(obj)
+        return objs
+
     def set_geoname(self, geoname):
         for k, v in geoname.dropna().to_dict().items():
             self._set_dataValidated(k, v)
@@ -684,13 +1015,13 @@ class Geoname(with_metaclass(SchemaMetaclass)):
             cur = cur.parent
 
     def get_admin1(self):
-        return self.country.admin1.get(admin_code=self.admin1code)
+        return self.country.find_admin(self.admin1code)
 
     def get_admin2(self):
-        return self.admin1.admin2.get(admin_code=self.admin2code)
+        return self.country.find_admin(self.admin1code, self.admin2code)
 
     def get_admin3(self):
-        return self.admin2.admin3.get(admin_code=self.admin3code)
+        return self.country.find_admin(self.admin1code, self.admin2code, self.admin3code)
 
     def get_featureclass_description(self):
         from .geonames.features import FEATURE_CLASS_TITLES
@@ -732,22 +1063,17 @@ class Geoname(with_metaclass(SchemaMetaclass)):
     def get_gdf(self):
         return Location.get_gdf(self, self.geoname)
 
-    def distance_km(self, other):
+    def distance_km(self, other, other_crs=None):
+        """Distance to a geoname, a point of other_crs (WSG84 by default) or the rows of a geodataframe."""
         from geopandas import GeoDataFrame
-        unique = True
+        lon, lat = self.longitude, self.latitude
         if isinstance(other, Geoname):
-            other_loc = other.location
-            other_loc = _make_point_to_crs(other_loc, point_crs=other.crs, dest_crs=self.crs)
+            other_lon, other_lat = lonlat_arrays((other.longitude, other.latitude))
         elif isinstance(other, Point):
-            other_loc = other
-            other_loc = _make_point_to_crs(other_loc, point_crs=other._crs or WSG84_CRS, dest_crs=self.crs)
+            other_lon, other_lat = lonlat_arrays(other, crs=other_crs or WSG84_CRS)
         elif isinstance(other, GeoDataFrame):
-            unique = False
-            if not other.crs.is_exact_same(self.crs):
-                other = other.to_crs(self.crs)
-            other_loc = other.geometry
-        res = list(self.gdf.geometry.distance(other_loc) / 1000.)
-        return res[0] if unique else res
+            return list(haversine_km(lon, lat, *lonlat_arrays(other)))
+        return float(haversine_km(lon, lat, other_lon, other_lat)[0])
 
 
 class City(with_metaclass(SchemaMetaclass)):
@@ -757,24 +1083,95 @@ class City(with_metaclass(SchemaMetaclass)):
         return Location.get_gdf(self, self.geoname, self.postal)
 
     def get_postal(self):
-        postals = self.admin3.postals_gdf
-        postals = postals[postals['place_name'] == self.name]
-        if len(postals):
-            postal = postals.iloc[0]
-            return postal
+        country = self.country
+        city_postals = country.city_postals() if country is not None else None
+        if city_postals is not None:
+            postal_code = city_postals.postal_code(self.geonameid)
+            postals = country.postals_gdf
+            if postal_code is not None and postal_code in postals.index:
+                return postals.loc[postal_code]
 
     def set_postal(self, postal):
         for k, v in postal.dropna().to_dict().items():
             self._set_dataValidated(k, v)
 
 
+def _admin(cls, parent, code, **codes):
+    """Returns the registered admin unit `code` of parent, only created if not registered yet."""
+    admin = parent.registry().get('admin', f'{parent.admin_key()}.{code}')
+    return admin if admin is not None else cls(parent=parent, **codes)
+
+
+def _postal_admin_code(admin, postals, column, admin_code, mapped):
+    """
+    Postal state/county/community code (column) of an admin unit: the `mapped` one of the city/postal mapping,
+    otherwise the postal code written as its admin code, otherwise the most frequent one of the postal places
+    within the hull of its cities.
+    """
+    if mapped is not None:
+        return mapped
+    codes = [admin_code]
+    try:
+        codes += [f'{int(admin_code)}', f'{float(admin_code):.1f}']
+    except (TypeError, ValueError):
+        pass
+    found = postals[column][postals[column].isin(codes)]
+    if not len(found):
+        hull = admin.cities_hull()
+        found = postals[column][postals.within(hull)] if hull is not None else found
+    counts = found.value_counts()
+    counts = counts[counts > 0]
+    return counts.index[0] if len(counts) else None
+
+
+def stored_geonames_gdf(country_code, crs):
+    """Geonames of a country in crs, from the frame store."""
+    return get_stored_frame(f'geonames_{country_code}_{crs}', lambda: load_geonames_gdf(country_code, crs=crs),
+                            sources=[geonames_file(country_code)])
+
+
+def stored_postals_gdf(country_code, crs):
+    """Unique postal codes of a country in crs, from the frame store."""
+    return get_stored_frame(f'postals_{country_code}_{crs}', lambda: load_postals_gdf(country_code, crs=crs),
+                            sources=postals_files(country_code))
+
+
 _world_dbs = {}
 _WorldCfg = namedtuple("WorldConfig", "cities_file with_shapes with_cities")
 
 
+def load_world_snapshot(path, freeze=False):
+    """
+    Returns the world of a snapshot folder with its countries and datasets restored, and registers it for
+    get_world. With freeze, loaded objects are moved out of the collected generations (gc.freeze) so that the
+    garbage collector of forked workers does not write to their pages.
+    """
+    meta = load_snapshot(pathlib.Path(path))
+    cfg = _WorldCfg(**meta['world'])
+    world = _world_dbs[cfg] = World(**cfg._asdict())
+    world.countries_gdf, world.cities_gdf
+    for options in meta['countries']:
+        country = world.get_country(options['country_code'])
+        for k in SNAPSHOT_COUNTRY_OPTIONS:
+            if options.get(k) is not None:
+                setattr(country, k, options[k])
+        country.geonames_gdf, country.postals_gdf
+    if freeze:
+        gc.freeze()
+    return world
+
+
 def get_world(cities_file=WORLD_CITIES_FILE, with_shapes=WORLD_WITH_SHAPE, with_cities=WORLD_WITH_CITIES):
-    global _world_dbs
     cfg = _WorldCfg(cities_file, with_shapes, with_cities)
+
+    def load():
+        if not _world_dbs and geo_settings.WORLD_SNAPSHOT:
+            load_world_snapshot(geo_settings.WORLD_SNAPSHOT)
+        if cfg not in _world_dbs:
+            _world_dbs[cfg] = World(**cfg._asdict())
+        return _world_dbs[cfg]
+
     if cfg not in _world_dbs:
-        _world_dbs[cfg] = World(**cfg._asdict())
+        # concurrent first callers wait for a single world
+        return single_flight(('world', cfg), load)
     return _world_dbs[cfg]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+from ngogeo.ip_utils import IpUtilsCity
+from ngogeo.ip_table import get_ip_table
+
+
+def random_ips(n, seed=0):
+    rng = np.random.default_rng(seed)
+    octets = rng.integers(1, 255, size=(n, 4)).astype(str)
+    return pd.Series(octets[:, 0]).str.cat([octets[:, 1], octets[:, 2], octets[:, 3]], sep='.')
+
+
+def benchmark(n=1000000, sample=100000):
+    ips = random_ips(n)
+
+    t0 = time.perf_counter()
+    table = get_ip_table(IpUtilsCity)
+    print(f'table loaded in {time.perf_counter() - t0:.2f}s: {table}')
+
+    t0 = time.perf_counter()
+    res = table.lookup(ips)
+    dt_table = time.perf_counter() - t0
+    print(f'IpTable.lookup: {n} ips in {dt_table:.2f}s ({n / dt_table:,.0f} ips/s)')
+
+    # the per address tree walk is timed on a sample and extrapolated
+    ip_utils = IpUtilsCity()
+    t0 = time.perf_counter()
+    found = 0
+    for ip in ips.iloc[:sample]:
+        try:
+            found += ip_utils.city(ip) is not None
+        except Exception:
+            pass
+    dt_city = (time.perf_counter() - t0) * n / sample
+    print(f'IpUtilsCity.city: {n} ips in ~{dt_city:.2f}s ({n / dt_city:,.0f} ips/s), speedup x{dt_city / dt_table:.1f}')
+    assert found == (table.lookup_positions(ips.iloc[:sample]) >= 0).sum()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares IpUtilsCity.city to vectorized IpTable lookups.')
+    parser.add_argument('-n', type=int, default=1000000)
+    parser.add_argument('--sample', type=int, default=100000)
+    args = parser.parse_args()
+    benchmark(args.n, args.sample)
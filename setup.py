@@ -70,6 +70,8 @@ install_requires = [
     'future',
     'python-gettext',
     'click',
+    'pandas>=2',
+    'shapely>=2',
     'geopandas',
     'pgeocode',
     'geonames-lib',
@@ -78,6 +80,7 @@ install_requires = [
     #'countryinfo',
     'currencies',
     'geoip2',
+    'maxminddb',
     'overpy'
 ]
 
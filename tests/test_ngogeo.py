@@ -23,6 +23,36 @@ def test_ip_utils_city():
     assert city
 
 
+def test_ip_utils_batch():
+    import pandas as pd
+    from ngogeo.ip_utils import IpUtilsCity
+    ip_city = IpUtilsCity(mode='memory')
+    ips = pd.Series(['92.184.108.14', '8.8.8.8', None, 'not an ip', '92.184.108.14'])
+    res = ip_city.lookup_batch(ips)
+    assert list(res.index) == list(ips.index)
+    assert res['country_code'].iloc[0] == ip_city.city('92.184.108.14').country.iso_code
+    assert res['city_geonameid'].iloc[0] == res['city_geonameid'].iloc[4]
+    assert res['country_code'].iloc[2:4].isna().all()
+    assert ip_city.cache_info().misses == 3
+
+
+def test_ip_table(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from ngogeo.ip_utils import IpUtilsCity
+    from ngogeo.ip_table import IpTable, _parse_ipv4
+    keys, valid = _parse_ipv4(np.array(['01.2.3.4', '1.2.3.04', '0.0.0.0', '10.0.100.1']))
+    assert list(valid) == [False, False, True, True] and keys[3] == (10 << 24) + (100 << 8) + 1
+    table = IpTable.build(IpUtilsCity)
+    table.save(tmp_path)
+    table = IpTable.load(tmp_path)
+    ips = pd.Series(['92.184.108.14', '8.8.8.8', '2a01:cb00::1', None, '999.1.1.1', 'not an ip', '092.184.108.14'])
+    res = table.lookup(ips)
+    expected = IpUtilsCity(mode='memory').lookup_batch(ips)
+    pd.testing.assert_frame_equal(res, expected, check_dtype=False)
+    assert res['country_code'].iloc[3:].isna().all()
+
+
 def test_geoplot():
     import geoplot
     import geoplot.crs as gcrs
@@ -180,6 +210,599 @@ def test_perf():
     assert germany
 
 
+def test_point_transforms():
+    import numpy as np
+    from shapely.geometry import Point
+    from ngogeo import point_search
+    point_search._get_transformer.cache_clear()
+    x, y = point_search._transform_xy(4.04255, 46.04378, 'EPSG:4326', 'EPSG:2154')
+    xs, ys = point_search._transform_xy(np.array([4.04255, 2.3522]), np.array([46.04378, 48.8566]),
+                                        'EPSG:4326', 'EPSG:2154')
+    assert (xs[0], ys[0]) == (x, y) and 6e6 < ys[1] < 7e6
+    assert point_search._get_transformer.cache_info().misses == 1
+    assert point_search._transform_xy(1., 2., 'EPSG:4326', 'EPSG:4326') == (1., 2.)
+    # batch variant, from a (N, 2) array or a pair of arrays, as points or arrays
+    px, py = point_search._make_points_to_crs([[4.04255, 46.04378]], point_crs='EPSG:4326', dest_crs='EPSG:2154')
+    assert np.allclose([px[0], py[0]], [x, y])
+    points = point_search._make_points_to_crs((xs, ys), point_crs='EPSG:2154', dest_crs='EPSG:4326', as_points=True)
+    assert np.allclose([points[1].x, points[1].y], [2.3522, 48.8566])
+    # points carry no crs: a projected point is only read back with its crs
+    p = point_search._make_point_to_crs((4.04255, 46.04378), point_crs='EPSG:4326', dest_crs='EPSG:2154')
+    back = point_search._make_point_to_crs(p, point_crs='EPSG:2154', dest_crs='EPSG:4326')
+    assert isinstance(p, Point) and np.allclose([back.x, back.y], [4.04255, 46.04378])
+
+
+def test_grid():
+    world = territories.get_world()
+    grid = world.country_grid()
+    assert list(grid.locate_labels([4.04255, -3.70379], [46.04378, 40.41678])) == ['FR', 'ES']
+    assert world.locate_country((4.04255, 46.04378), point_crs='EPSG:4326', use_grid=True).country_code == 'FR'
+
+
+def test_grid_lazy_inputs(tmp_path, monkeypatch):
+    from shapely.geometry import box
+    from ngogeo import grid as grid_module
+    from ngogeo.grid import get_territory_grid
+    monkeypatch.setattr(grid_module, 'grid_folder', tmp_path)
+    monkeypatch.setattr(grid_module, '_grids', {})
+    calls = []
+
+    def territories_():
+        calls.append('build')
+        return [box(0, 0, 1, 1), box(1, 0, 2, 1)], ['A', 'B']
+
+    grid = get_territory_grid('test_lazy', territories_, None, resolution=0.5, digest='v1')
+    assert grid.locate(1.5, 0.5) == 'B'
+    # in memory: territories are not computed again
+    assert get_territory_grid('test_lazy', territories_, None, resolution=0.5, digest='v1') is grid
+    assert calls == ['build']
+    # other territories or bounds are other grids
+    assert get_territory_grid('test_lazy', territories_, None, resolution=0.5, digest='v2') is not grid
+    assert get_territory_grid('test_lazy', territories_, None, resolution=0.5, digest='v1',
+                              bounds=(0, 0, 2, 1)) is not grid
+    assert calls == ['build'] * 3 and len(list(tmp_path.iterdir())) == 3
+
+
+def test_geoname_index():
+    world = territories.get_world()
+    cities = world.cities_gdf
+    index = world.cities_index()
+    assert list(index.positions(cities['geonameid'].iloc[[3, 1]])) == [3, 1]
+    assert index.position(-42) == -1
+    france = world.get_country('FR')
+    gid = cities[(cities['name'] == 'Roanne') & (cities['countrycode'] == 'FR')]['geonameid'].iloc[0]
+    roanne = france.locate_geonameid(gid)
+    assert isinstance(roanne, territories.City) and roanne.name == 'Roanne'
+    name_index = france.name_index()
+    places = france.places_gdf()
+    assert 'Roanne' in places['name'].iloc[name_index.positions('ROANNE')].to_list()
+    assert list(name_index.lookup(['', None])) == [-1, -1]
+    world.with_ip_city = True
+    assert world.locate_ip_city('92.184.108.14').geonameid == world.ip_city.lookup_batch(['92.184.108.14'])[
+        'city_geonameid'].iloc[0]
+
+
+def test_admin_hierarchy():
+    from ngogeo.admin_hierarchy import get_admin_hierarchy
+    hierarchy = get_admin_hierarchy()
+    assert 'FR.84' in hierarchy.children('FR')
+    assert 'FR.84.42' in hierarchy.children('FR.84')
+    assert hierarchy.name('FR.84.42') == 'Loire'
+    assert len(hierarchy.child_geonameids(hierarchy.geonameid('FR.84.42')))
+    france = territories.get_world().get_country('FR')
+    loire = france.admin1.get(admin_code='84').admin2.get(admin_code='42')
+    assert loire.admin_key() == 'FR.84.42'
+    assert loire.name == 'Loire'
+
+
+def test_city_postals():
+    france = territories.get_world().get_country('FR')
+    france.with_postals = True
+    city_postals = france.city_postals()
+    assert city_postals.postal_admin_code('84', '42') is not None
+    loire = france.admin1.get(admin_code='84').admin2.get(admin_code='42')
+    assert (loire.postals_gdf['county_code'] == loire.county_code).all()
+    riorges = france.locate_geonameid(city_postals.table['geonameid'][city_postals.table['postal_code'] == '42153'].iloc[0])
+    assert riorges.postal.name == '42153'
+
+
+def test_city_postals_sources(tmp_path, monkeypatch):
+    import pandas as pd
+    from ngogeo import city_postals
+    from ngogeo.dataset_cache import get_dataset_cache
+    monkeypatch.setattr(city_postals, 'city_postals_folder', tmp_path)
+    cities = pd.DataFrame({'geonameid': [1], 'name': ['Roanne'], 'admin1code': ['84'], 'admin2code': ['42'],
+                           'admin3code': ['421']})
+    postals = pd.DataFrame({'postal_code': ['42300'], 'place_name': ['Roanne'], 'state_code': ['84'],
+                            'county_code': ['42'], 'community_code': ['421']})
+    cities.attrs['sources'] = [['cities.txt', 1, 10]]
+    postals.attrs['sources'] = [['postals.txt', 1, 10]]
+
+    def mapping():
+        get_dataset_cache().evict(('city_postals', 'XX_test'))
+        return city_postals.get_city_postals('XX_test', cities, postals)
+
+    assert mapping().postal_code(1) == '42300'
+    # the mapping on disk is reused while the source files are unchanged
+    postals.loc[0, 'postal_code'] = '42153'
+    assert mapping().postal_code(1) == '42300'
+    postals.attrs['sources'] = [['postals.txt', 2, 10]]
+    assert mapping().postal_code(1) == '42153'
+
+
+def test_registry():
+    import gc
+    import weakref
+    from ngogeo.registry import get_registry
+    world = territories.World()
+    france = world.get_country('FR')
+    assert world.get_country('FRA') is france
+    assert world.registry().get('country', 'DE') is None
+    assert world.get_country(int(france.geonameid)) is france
+    assert france in world.get_continent('EU').countries
+    loire = france.find_admin('84', '42')
+    assert loire.admin_key() == 'FR.84.42'
+    assert loire in france.find_admin('84').admin2
+    assert world.get_country('XX') is None
+    # registries are held by their root, and released with it
+    root = type('Root', (object,), {})()
+    registry = get_registry(root)
+    assert get_registry(root) is registry
+    root = weakref.ref(root)
+    gc.collect()
+    assert root() is None
+
+
+def test_dataset_cache():
+    from ngogeo.dataset_cache import get_dataset_cache
+    cache = get_dataset_cache()
+    world = territories.get_world()
+    france = world.get_country('FR')
+    france.with_postals = True
+    n = len(france.postals_gdf)
+    ara = france.find_admin('84')
+    assert len(ara.postals_gdf)
+    key = ('postals', 'FR', str(france.crs))
+    assert cache.sizes()[key] > 0
+    max_bytes, evictions = cache.max_bytes, cache.stats().evictions
+    try:
+        cache.resize(0)
+        assert key not in cache and cache.stats().evictions > evictions
+        # subsets derived from the evicted frame are released with it
+        assert ara._dataValidated.get('postals_gdf') is None
+        assert len(france.postals_gdf) == n
+    finally:
+        cache.resize(max_bytes)
+
+
+def test_dataset_nbytes(tmp_path):
+    import geopandas as gpd
+    from ngogeo.dataset_cache import dataset_nbytes
+    from ngogeo.frames import save_frame, load_frame
+    n = 1000
+    frame = gpd.GeoDataFrame({'geonameid': range(n), 'name': [f'city {i % 10}' for i in range(n)]},
+                             geometry=gpd.points_from_xy(range(n), range(n)), crs='EPSG:4326')
+    # geometries are accounted beyond their pointers
+    assert dataset_nbytes(frame) > dataset_nbytes(frame.drop(columns='geometry')) + 8 * n + 16 * n
+    # memory-mapped columns are not owned
+    save_frame(frame, tmp_path / 'frame')
+    mapped = load_frame(tmp_path / 'frame', categorical=True)
+    assert dataset_nbytes(mapped['geonameid'].to_numpy()) == 0
+    assert dataset_nbytes(mapped) < dataset_nbytes(mapped.copy())
+
+
+def test_world_snapshot(tmp_path):
+    from ngogeo.frames import save_frame, load_frame
+    world = territories.get_world()
+    france = world.get_country('FR')
+    france.with_postals = True
+    postals = france.postals_gdf
+    save_frame(postals, tmp_path / 'postals')
+    frame = load_frame(tmp_path / 'postals')
+    assert frame.crs == postals.crs and frame.index.equals(postals.index)
+    assert frame.geometry.geom_equals(postals.geometry).all()
+    world.save_snapshot(tmp_path / 'snapshot')
+    dbs = dict(territories._world_dbs)
+    territories._world_dbs.clear()
+    try:
+        restored = territories.load_world_snapshot(tmp_path / 'snapshot')
+        assert restored is territories.get_world() and restored is not world
+        country = restored.get_country('FR')
+        assert country.with_postals and len(country.postals_gdf) == len(postals)
+    finally:
+        territories._world_dbs.clear()
+        territories._world_dbs.update(dbs)
+
+
+def test_frame_store(tmp_path, monkeypatch):
+    from ngogeo import settings as geo_settings
+    from ngogeo import frames
+    from ngogeo.frames import get_stored_frame
+    monkeypatch.setattr(frames, 'frame_store_folder', tmp_path)
+    france = territories.get_world().get_country('FR')
+    monkeypatch.setattr(geo_settings, 'FRAME_STORE', False)
+    loaded = territories.stored_postals_gdf('FR', france.crs)
+    assert loaded['latitude'].to_numpy().flags.writeable
+    monkeypatch.setattr(geo_settings, 'FRAME_STORE', True)
+    postals = territories.stored_postals_gdf('FR', france.crs)
+    # coordinates and category codes are read-only memory-mapped arrays
+    assert not postals['latitude'].to_numpy().flags.writeable
+    assert not postals['state_code'].array.codes.flags.writeable
+    assert postals.index.equals(loaded.index)
+    stored = get_stored_frame(f'postals_FR_{france.crs}', None)
+    assert stored.index.equals(postals.index)
+
+
+def test_stored_frame_sources(tmp_path, monkeypatch):
+    import pandas as pd
+    from ngogeo import settings as geo_settings
+    from ngogeo import frames
+    from ngogeo.frames import get_stored_frame, sources_outdated
+    from ngogeo.geoname_index import GeonameIndex
+    monkeypatch.setattr(geo_settings, 'FRAME_STORE', True)
+    monkeypatch.setattr(frames, 'frame_store_folder', tmp_path / 'frames')
+    source = tmp_path / 'source.csv'
+    source.write_text('geonameid\n1\n2\n')
+    frame = get_stored_frame('test_sources', lambda: pd.read_csv(source), sources=[source])
+    assert len(frame) == 2
+    index = GeonameIndex(frame['geonameid'], sources=frame.attrs['sources'])
+    index.save(tmp_path / 'index')
+    # stored frames are rebuilt once their source files change, and indexes over them are outdated
+    source.write_text('geonameid\n1\n2\n3\n')
+    assert len(get_stored_frame('test_sources', lambda: pd.read_csv(source), sources=[source])) == 3
+    assert len(get_stored_frame('test_sources', None, sources=[source])) == 3
+    assert sources_outdated(GeonameIndex.load(tmp_path / 'index').sources)
+
+def test_batch():
+    import pandas as pd
+    from ngogeo.batch import BatchEngine, geocode, reverse_geocode
+    rows = pd.DataFrame({'country': ['FR', 'FRA', 'ES', 'XX'], 'postal_code': ['42153', None, '28001', '1'],
+                         'name': ['Riorges', 'Roanne', None, 'Riorges']}, index=list('abcd'))
+    res = geocode(rows, workers=0, chunk_size=3)
+    assert list(res.index) == list('abcd')
+    assert res.loc['a', 'city'] == 'Riorges' and res.loc['a', 'match'] == 'name+postal'
+    assert res.loc['b', 'admin2code'] == '42' and res.loc['c', 'match'] == 'postal'
+    assert pd.isna(res.loc['d', 'country_code'])
+    with BatchEngine(workers=2, chunk_size=2, max_pending=1) as engine:
+        chunks = list(engine.geocode(rows))
+    pd.testing.assert_frame_equal(pd.concat(chunks), res)
+    points = pd.DataFrame({'longitude': [4.04255, 2.3522], 'latitude': [46.04378, 48.8566]})
+    res = reverse_geocode(points, workers=0)
+    assert list(res['country_code']) == ['FR', 'FR'] and res['distance_km'].max() < 10
+
+
+def test_cmd_geocode(tmp_path):
+    import pandas as pd
+    fn = tmp_path / 'addresses.csv'
+    pd.DataFrame({'cp': ['42153', '01000'], 'city': ['Riorges', None]}).to_csv(fn, index=False)
+    runner = CliRunner()
+    result = runner.invoke(cli, ['geocode', str(fn), str(tmp_path / 'out.csv'), '--country', 'FR',
+                                 '--postal-col', 'cp', '--name-col', 'city', '-w', '0', '--chunk-size', '1'])
+    assert result.exit_code == 0, result.output
+    out = pd.read_csv(tmp_path / 'out.csv', dtype=str)
+    assert list(out['cp']) == ['42153', '01000']
+    assert list(out['geo_match']) == ['name+postal', 'postal'] and out['geo_city'].iloc[0] == 'Riorges'
+
+
+def test_cmd_build_cache(tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['build-cache', 'FR', '--no-admin-grids', '--snapshot', str(tmp_path / 'snap')])
+    assert result.exit_code == 0, result.output
+    assert 'FR postals' in result.output and 'FAILED' not in result.output
+    assert (tmp_path / 'snap' / 'snapshot.json').exists()
+    result = runner.invoke(cli, ['build-cache', 'Atlantis'])
+    assert result.exit_code != 0
+
+
+def test_service():
+    import asyncio
+    import json
+    from ngogeo.service import GeoService
+    service = GeoService(countries=['FR'], max_delay=0.01)
+    service.preload()
+
+    async def get(path, query):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+        await service({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode()}, None, send)
+        return sent[0]['status'], json.loads(sent[1]['body'])
+
+    async def run():
+        points = [get('/nearest', 'lon=4.04255&lat=46.04378') for _ in range(20)]
+        return await asyncio.gather(get('/locate', 'lon=2.3522&lat=48.8566'), get('/postal', 'code=42153&country=FR'),
+                                    get('/name', 'q=Riorges&country=FR'), get('/radius', 'lon=4.04&lat=46.04&limit=3'),
+                                    get('/locate', 'lon=abc&lat=1'), *points)
+
+    located, postal, name, radius, bad, *nearest = asyncio.run(run())
+    assert located == (200, {'country_code': 'FR'})
+    assert postal[1]['match'] == 'postal' and name[1]['city'] == 'Riorges'
+    assert len(radius[1]) == 3 and bad[0] == 400
+    assert all(r == nearest[0] for r in nearest) and nearest[0][1]['city'] == 'Riorges'
+    assert service.batchers['reverse'].sizes.count == 1
+    assert service.latencies['nearest'].count == 20
+
+
+def test_micro_batcher():
+    import asyncio
+    from ngogeo.service import MicroBatcher
+
+    def inverses(items):
+        return [1 / item for item in items]
+
+    async def run():
+        batcher = MicroBatcher(inverses, max_batch=3, max_delay=10)
+        results = await asyncio.gather(*[batcher(item) for item in (1, 0, 4)], return_exceptions=True)
+        # batches are held until done, and closing runs the pending items
+        pending = asyncio.ensure_future(batcher(2))
+        await asyncio.sleep(0)
+        await batcher.close()
+        return results, await pending, batcher._tasks
+
+    (one, zero, four), two, tasks = asyncio.run(run())
+    # a failing item does not fail the others of its batch
+    assert one == 1 and isinstance(zero, ZeroDivisionError) and four == 0.25
+    assert two == 0.5 and not tasks
+
+
+def test_aio():
+    import asyncio
+    from ngogeo import aio
+
+    async def run():
+        countries = await asyncio.gather(*[aio.get_country('FR') for _ in range(10)])
+        ip_lookup = aio.IpLookup()
+        records = await asyncio.gather(*[ip_lookup.lookup('92.184.108.14') for _ in range(10)])
+        return countries, records, ip_lookup
+
+    countries, records, ip_lookup = asyncio.run(run())
+    assert all(c is countries[0] for c in countries) and countries[0].postals_gdf is not None
+    assert records[0]['country_code'] == 'FR' and all(r == records[0] for r in records)
+    assert ip_lookup.ip_utils.cache_info().misses == 1
+
+
+def test_single_flight():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from ngogeo.dataset_cache import get_dataset_cache
+    from ngogeo.single_flight import SingleFlight
+    flights, calls, gate = SingleFlight(), [], threading.Event()
+
+    def load():
+        calls.append(1)
+        gate.wait(5)
+        return object()
+
+    with ThreadPoolExecutor(16) as pool:
+        futures = [pool.submit(flights.do, 'key', load) for _ in range(16)]
+        gate.set()
+        results = [f.result() for f in futures]
+    assert len(calls) == 1 and all(r is results[0] for r in results)
+    assert len(flights) == 0
+    # cold world hammered from many threads
+    dbs = dict(territories._world_dbs)
+    territories._world_dbs.clear()
+    cache = get_dataset_cache()
+    try:
+        with ThreadPoolExecutor(16) as pool:
+            worlds = list(pool.map(lambda i: territories.get_world(), range(32)))
+        assert all(w is worlds[0] for w in worlds)
+        france = worlds[0].get_country('FR')
+        france.with_postals = True
+        key = ('postals', 'FR', str(france.crs))
+        cache.evict(key)
+        misses = cache.stats().misses
+        with ThreadPoolExecutor(16) as pool:
+            gdfs = list(pool.map(lambda i: france.get_postals_gdf(), range(32)))
+        assert cache.stats().misses == misses + 1
+        assert all(g is gdfs[0] for g in gdfs)
+    finally:
+        territories._world_dbs.clear()
+        territories._world_dbs.update(dbs)
+
+
+def test_record_views():
+    from ngogeo.records import RecordViews
+    world = territories.get_world()
+    cities = world.cities_gdf.iloc[:500]
+    views = RecordViews(cities, territories.City, crs=world.crs)
+    assert len(views) == 500
+    assert views[-1].name == cities['name'].iloc[-1]
+    city = views[3]
+    assert city.geonameid == cities['geonameid'].iloc[3]
+    assert city.materialize() is city.materialize()
+    assert city.timezone_details is not None
+    assert [c.geonameid for c in views.materialize()[:5]] == cities['geonameid'].iloc[:5].to_list()
+    # locate methods return cities, unless views are requested
+    france = world.get_country('FR')
+    row = france.search_cities_name('Riorges').iloc[0]
+    admin3 = france.find_admin(row['admin1code'], row['admin2code'], row['admin3code'])
+    found = admin3.locate_city(name='Riorges')
+    assert isinstance(found, territories.City) and found.name == 'Riorges'
+    assert admin3.locate_city(name='Riorges', views=True).name == 'Riorges'
+    around = admin3.locate_cities_around(row.geometry, point_crs=france.crs, limit=3)
+    assert around and all(isinstance(city, territories.City) for distance, city in around)
+
+
+def test_distances():
+    import numpy as np
+    from ngogeo.distances import haversine_km, geodesic_km, distance_matrix_km
+    # Paris - London
+    assert abs(haversine_km(2.3522, 48.8566, -0.1276, 51.5072) - 343.5) < 1
+    assert abs(geodesic_km(2.3522, 48.8566, -0.1276, 51.5072) - 343.9) < 1
+    lons, lats = np.random.uniform(-5, 8, 100), np.random.uniform(42, 51, 100)
+    m = distance_matrix_km(lons, lats, lons[:10], lats[:10], chunk_size=7)
+    assert m.shape == (100, 10)
+    assert np.allclose(m[:10].diagonal(), 0)
+    assert np.allclose(m[42], haversine_km(lons[42], lats[42], lons[:10], lats[:10]))
+
+
+def test_search_radius_wsg84():
+    import numpy as np
+    import geopandas as gpd
+    from ngogeo.distances import haversine_km
+    from ngogeo.point_search import _search_radius
+    lons, lats = np.random.uniform(-180, 180, 10000), np.random.uniform(-89, 89, 10000)
+    gdf = gpd.GeoDataFrame(dict(longitude=lons, latitude=lats), geometry=gpd.points_from_xy(lons, lats), crs='EPSG:4326')
+    for lon, lat in [(4.04, 46.04), (179.9, 10.), (0., 88.9)]:
+        res = _search_radius(gdf, (lon, lat), 500000)
+        assert len(res) == (haversine_km(lon, lat, lons, lats) <= 500.).sum()
+        assert res['distance'].is_monotonic_increasing
+    from ngogeo.point_search import _iter_search_radius
+    res = _search_radius(gdf, (4.04, 46.04), 2000000)
+    top = _search_radius(gdf, (4.04, 46.04), 2000000, limit=5)
+    assert list(top.index) == list(res.index[:5])
+    assert [r.name for d, r in _iter_search_radius(gdf, (4.04, 46.04), 2000000)] == list(res.index)
+
+
+def test_overpass_cache(tmp_path):
+    import pytest
+    from ngogeo.overpass import OverpassCache, OverpassCacheMiss, overpass_query
+    cache = OverpassCache(tmp_path.joinpath('overpass.sqlite'), ttl=3600, max_size=4096)
+    key = cache.make_key('node', {'amenity': 'drinking_water'}, '46.0, 4.0, 46.1, 4.1')
+    assert cache.get(key) is None
+    cache.set(key, b'<osm></osm>')
+    assert overpass_query('ignored', key=key, cache=cache, cache_only=True) == b'<osm></osm>'
+    with pytest.raises(OverpassCacheMiss):
+        overpass_query('ignored', key='unknown', cache=cache, cache_only=True)
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 2 and stats['count'] == 1
+
+
+def test_overpass_cache_evict(tmp_path):
+    import os
+    from ngogeo.overpass import OverpassCache
+    cache = OverpassCache(tmp_path.joinpath('overpass.sqlite'), ttl=3600, max_size=3000)
+    for i in range(5):
+        cache.set(f'k{i}', os.urandom(1000))
+    assert cache.get('k0') is None and cache.get('k4') is not None
+    assert cache.stats()['size'] <= 3000 and cache.evictions == 3
+
+
+def _overpass_stand_in(nodes, fail_first=0):
+    """Local HTTP server answering overpass bbox queries with the given (id, lon, lat) nodes."""
+    import re
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            query = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())['data'][0]
+            server.queries.append(query)
+            if len(server.queries) <= fail_first:
+                self.send_response(429)
+                self.end_headers()
+                return
+            s, w, n, e = [float(c) for c in re.search(r'\(([-\d., ]+)\)', query).group(1).split(',')]
+            found = [(i, lon, lat) for i, lon, lat in nodes if s <= lat <= n and w <= lon <= e]
+            if '[out:json]' in query:
+                body = json.dumps(dict(elements=[dict(type='node', id=i, lon=lon, lat=lat,
+                                                      tags=dict(amenity='drinking_water')) for i, lon, lat in found]))
+            else:
+                body = ''.join(f'<node id="{i}" lat="{lat}" lon="{lon}"><tag k="amenity" v="drinking_water"/></node>'
+                               for i, lon, lat in found)
+                body = f'<?xml version="1.0" encoding="UTF-8"?><osm version="0.6">{body}</osm>'
+            body = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/osm3s+xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.queries = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_overpass_tiles():
+    from ngogeo.overpass import bbox_tiles, overpass_fetch
+    from ngogeo.point_search import _search_elements
+    assert bbox_tiles('46.01, 4.01, 46.3, 4.2', tile_size=0.25) == ['46.000, 4.000, 46.250, 4.250',
+                                                                    '46.250, 4.000, 46.500, 4.250']
+    # node 2 lies on the edge shared by 2 tiles, node 4 is out of the requested bbox
+    nodes = [(1, 4.1, 46.1), (2, 4.1, 46.25), (3, 4.15, 46.28), (4, 4.22, 46.4)]
+    server = _overpass_stand_in(nodes, fail_first=1)
+    url = f'http://127.0.0.1:{server.server_port}/api/interpreter'
+    assert overpass_fetch('[out:xml];node(46.0, 4.0, 46.1, 4.2);out;', url=url, backoff=0.01)
+    res = _search_elements('46.01, 4.01, 46.3, 4.2', element='node', cache=False, tiled=True, tile_size=0.25,
+                           url=url, amenity='drinking_water')
+    assert sorted(res['ids']) == [1, 2, 3]
+    assert len(server.queries) == 4
+    res = _search_elements('46.01, 4.01, 46.3, 4.2', element='node', cache=False, tiled=True, tile_size=0.25,
+                           url=url, output='xml', amenity='drinking_water')
+    assert sorted(res['ids']) == [1, 2, 3]
+    # tiling is opt-in, a bbox is fetched in a single query by default
+    res = _search_elements('46.01, 4.01, 46.3, 4.2', element='node', cache=False, url=url, amenity='drinking_water')
+    assert sorted(res['ids']) == [1, 2, 3]
+    assert len(server.queries) == 7
+    server.shutdown()
+
+
+def test_overpass_json():
+    import json
+    from ngogeo.point_search import _json_elements_gdf
+    raw = json.dumps(dict(elements=[
+        dict(type='node', id=1, lon=4.04, lat=46.04, tags=dict(amenity='drinking_water', name='fontaine')),
+        dict(type='way', id=2, center=dict(lon=4.05, lat=46.05), tags=dict(amenity='parking')),
+        dict(type='way', id=3, bounds=dict(minlon=4., minlat=46., maxlon=4.1, maxlat=46.1),
+             geometry=[dict(lon=4., lat=46.), dict(lon=4.1, lat=46.1)], tags=dict(amenity='parking')),
+        dict(type='relation', id=4, center=dict(lon=4.06, lat=46.06), tags={}),
+    ])).encode()
+    gdf = _json_elements_gdf(raw, geom=True, tag_columns=['amenity', 'name'])
+    assert list(gdf['type']) == ['node', 'way', 'way', 'relation']
+    assert gdf['name'].iloc[0] == 'fontaine' and gdf['name'].isna().sum() == 3
+    assert gdf.geometry.iloc[2].geom_type == 'LineString'
+    assert list(gdf['longitude']) == [4.04, 4.05, 4.05, 4.06]
+
+
+def test_overpass_xml():
+    import overpy
+    from ngogeo.point_search import _elements_gdf
+    raw = ('<?xml version="1.0" encoding="UTF-8"?><osm version="0.6">'
+           '<node id="1" lat="46.04" lon="4.04"><tag k="amenity" v="drinking_water"/><tag k="name" v="fontaine"/>'
+           '</node><way id="2"><center lat="46.05" lon="4.05"/><tag k="amenity" v="parking"/></way>'
+           '<relation id="4"><center lat="46.06" lon="4.06"/></relation></osm>').encode()
+    # ways and relations out center are kept along with the nodes
+    gdf = _elements_gdf(overpy.Overpass().parse_xml(raw), tag_columns=['amenity', 'name'])
+    assert list(gdf['type']) == ['node', 'way', 'relation']
+    assert list(gdf['longitude']) == [4.04, 4.05, 4.06]
+    assert gdf['name'].iloc[0] == 'fontaine' and list(gdf['amenity'][:2]) == ['drinking_water', 'parking']
+
+
+def test_osm_extract(tmp_path):
+    from ngogeo.osm_extract import OsmExtractStore
+    from ngogeo.point_search import _search_elements, search_nodes_radius
+    osm = tmp_path.joinpath('extract.osm')
+    osm.write_text('<?xml version="1.0" encoding="UTF-8"?><osm version="0.6">'
+                   '<node id="1" lat="46.04" lon="4.04"><tag k="amenity" v="drinking_water"/></node>'
+                   '<node id="2" lat="46.05" lon="4.05"><tag k="amenity" v="bench"/></node>'
+                   '<node id="3" lat="46.06" lon="4.06"/><node id="4" lat="46.07" lon="4.07"/>'
+                   '<way id="10"><nd ref="3"/><nd ref="4"/><tag k="amenity" v="parking"/></way></osm>')
+    store = OsmExtractStore(tmp_path.joinpath('osm.sqlite'))
+    assert store.ingest(osm) == 3
+    # ingesting again replaces the elements with their tags and boxes
+    assert store.ingest(osm) == 3 and len(store) == 3
+    cx = store._connect()
+    assert cx.execute('SELECT COUNT(*) FROM tags').fetchone()[0] == 3
+    assert cx.execute('SELECT COUNT(*) FROM pois_rtree').fetchone()[0] == 3
+    res = _search_elements('46.0, 4.0, 46.1, 4.1', element='node', store=store, amenity='drinking_water')
+    assert list(res['ids']) == [1]
+    res = _search_elements('46.0, 4.0, 46.1, 4.1', element='ways', store=store, amenity='parking')
+    assert list(res['ids']) == [10]
+    # several element types, same columns as the overpass json results
+    res = _search_elements('46.0, 4.0, 46.1, 4.1', element=['node', 'way'], store=store)
+    assert sorted(res['ids']) == [1, 2, 10] and set(res.loc[res['ids'] == 10, 'type']) == {'way'}
+    assert {'ids', 'type', 'tags', 'longitude', 'latitude', 'name', 'geometry'} <= set(res.columns)
+    assert not len(search_nodes_radius((4.04, 46.04), 500, store=store, amenity='bench'))
+
+
 if __name__ == '__main__':
     test_ip_utils_country()
     test_ip_utils_city()